@@ -0,0 +1,12 @@
+﻿namespace backend.DTOs;
+
+public class EnqueueJobResponseDto
+{
+    public string? Queue { get; set; }
+    public string? Algorithm { get; set; }
+}
+
+public class ProcessingErrorDto
+{
+    public string? Detail { get; set; }
+}
\ No newline at end of file
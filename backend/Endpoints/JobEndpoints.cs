@@ -65,7 +65,7 @@ public static class JobEndpoints
 
         // get the dzi version of the mosaic
         group.MapGet("/{jobId:guid}/dz/{**filePath}",
-            (string userName, Guid projectId, Guid jobId, string filePath, IImageStorageService storage) =>
+            async (string userName, Guid projectId, Guid jobId, string filePath, IImageStorageService storage) =>
             {
                 if (!storage.DeepZoomExists(userName, projectId, jobId)) // TODO: better check for dz version existence
                 {
@@ -75,7 +75,8 @@ public static class JobEndpoints
                 try
                 {
                     var (absPath, contentType) = storage.GetDeepZoomPath(userName, projectId, jobId, filePath);
-                    return Results.File(absPath, contentType);
+                    var archived = await storage.ReadDeepZoomArchiveEntryAsync(userName, projectId, jobId, filePath);
+                    return archived is null ? Results.File(absPath, contentType) : Results.Bytes(archived, contentType);
                 }
                 catch (FileNotFoundException ex)
                 {
@@ -119,6 +120,22 @@ public static class JobEndpoints
             });
 
 
+        // Abort a running Job
+        group.MapPost("/{jobId:guid}/abort",
+            async (string userName, Guid projectId, Guid jobId, IProcessingService processing) =>
+            {
+                try
+                {
+                    await processing.AbortJobAsync(userName, projectId, jobId);
+                    return Results.Ok();
+                }
+                catch (Exception ex)
+                {
+                    return Results.Problem(ex.Message);
+                }
+            });
+
+
         // Callbacks used by the processing containers
         var jobCallback = routes.MapGroup("/jobs");
 
@@ -140,5 +157,17 @@ public static class JobEndpoints
                     return Results.Problem(ex.Message);
                 }
             });
+
+        jobCallback.MapGet("/{jobId:guid}/status",
+            async (Guid jobId, HttpRequest request, IProcessingService processing) =>
+            {
+                if (
+                    !request.Headers.TryGetValue("X-Job-Secret", out var headerValue) ||
+                    !await processing.IsTokenValid(jobId, Guid.Parse(headerValue!))
+                ) return Results.Unauthorized();
+
+                var status = await processing.GetStatus(jobId);
+                return status == null ? Results.NotFound() : Results.Ok(status);
+            });
     }
 }
\ No newline at end of file
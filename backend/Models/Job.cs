@@ -27,7 +27,7 @@ public class Job
     public double Progress { get; set; }
 
     public int N { get; init; }
-    [MaxLength(64)] public string Algorithm { get; init; } = null!;
+    [MaxLength(64)] public string Algorithm { get; set; } = null!;
     [MaxLength(64)] public string ColorSpace { get; init; } = null!;
     public int Subdivisions { get; init; }
     public int CropCount { get; init; }
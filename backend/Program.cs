@@ -115,6 +115,7 @@ builder.Services.AddCors(options =>
 });
 
 // Custom services
+builder.Services.AddMemoryCache(); // offset indexes of deep zoom archives
 builder.Services.AddScoped<IImageStorageService, ImageStorageService>();
 builder.Services.AddHttpClient<ZipCollectionInstaller>();
 builder.Services.Configure<List<TileCollectionConfig>>(
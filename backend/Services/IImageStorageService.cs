@@ -27,4 +27,6 @@ public interface IImageStorageService
     string CreateAndGetCollectionPath(string id);
 
     (string absPath, string contentType) GetDeepZoomPath(string userName, Guid projectId, Guid jobId, string filePath);
+
+    Task<byte[]?> ReadDeepZoomArchiveEntryAsync(string userName, Guid projectId, Guid jobId, string filePath);
 }
\ No newline at end of file
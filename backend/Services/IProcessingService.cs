@@ -13,6 +13,12 @@ public interface IProcessingService
     
     Task UpdateStatus(Guid jobId, JobStatus status, double? progress);
 
+    Task<JobStatusDto?> GetStatus(Guid jobId);
+
+    Task AbortJobAsync(string userName, Guid projectId, Guid jobId);
+
+    Task RequestCollectionIndexAsync(string collectionId);
+
     Task<bool> IsTokenValid(Guid jobId, Guid token);
     Task DeleteJobAsync(string userName, Guid projectId, Guid jobId);
 }
\ No newline at end of file
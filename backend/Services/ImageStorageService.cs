@@ -1,7 +1,9 @@
-﻿using backend.Data;
+﻿using System.Text.Json;
+using backend.Data;
 using backend.DTOs;
 using backend.Models;
 using Microsoft.EntityFrameworkCore;
+using Microsoft.Extensions.Caching.Memory;
 using SixLabors.ImageSharp;
 using SixLabors.ImageSharp.Formats.Jpeg;
 using SixLabors.ImageSharp.PixelFormats;
@@ -22,14 +24,18 @@ public class ImageStorageService : IImageStorageService
     private const int MaxFileSize = 10 * 1024 * 1024;
     private const int ThumbnailSizePx = 32;
     private const int MaxImageCount = 10000;
+    private const string DeepZoomArchiveName = "dz.jpg.zip";
+    private const string DeepZoomIndexName = "dz.jpg.index.json";
     
 
     private readonly AppDbContext _db;
+    private readonly IMemoryCache _cache;
     private readonly string _uploadPath;
 
-    public ImageStorageService(AppDbContext db, IConfiguration config, IWebHostEnvironment env)
+    public ImageStorageService(AppDbContext db, IMemoryCache cache, IConfiguration config, IWebHostEnvironment env)
     {
         _db = db;
+        _cache = cache;
         var path = config.GetValue<string>("UploadPath")
                    ?? throw new InvalidOperationException("UploadPath missing in config");
         _uploadPath = Path.IsPathRooted(path)
@@ -207,7 +213,9 @@ public class ImageStorageService : IImageStorageService
 
     public bool DeepZoomExists(string userName, Guid projectId, Guid jobId)
     {
-        return File.Exists(GetDeepZoomPath(userName, projectId, jobId, "dz.jpg.dzi").absPath);
+        // the index of an archive is written last
+        return File.Exists(GetDeepZoomPath(userName, projectId, jobId, "dz.jpg.dzi").absPath) ||
+               File.Exists(GetDeepZoomPath(userName, projectId, jobId, DeepZoomIndexName).absPath);
     }
 
     private string GetMosaicDirPath(string userName, Guid projectId, Guid jobId)
@@ -244,6 +252,46 @@ public class ImageStorageService : IImageStorageService
         return (path, contentType);
     }
 
+    // Returns null if the deep zoom image was written as loose files instead of a single archive
+    public async Task<byte[]?> ReadDeepZoomArchiveEntryAsync(string userName, Guid projectId, Guid jobId,
+        string filePath)
+    {
+        var indexPath = GetDeepZoomPath(userName, projectId, jobId, DeepZoomIndexName).absPath;
+        if (!File.Exists(indexPath)) return null;
+
+        var entries = await GetDeepZoomIndexAsync(indexPath);
+        if (!entries.TryGetValue(filePath, out var range))
+            throw new FileNotFoundException($"{filePath} is not part of the deep zoom image.");
+
+        // entries are stored uncompressed, so every file is a single range of the archive
+        var data = new byte[range[1]];
+        var archivePath = GetDeepZoomPath(userName, projectId, jobId, DeepZoomArchiveName).absPath;
+        await using var stream = new FileStream(archivePath, FileMode.Open, FileAccess.Read, FileShare.Read, 1, true);
+        stream.Seek(range[0], SeekOrigin.Begin);
+        await stream.ReadExactlyAsync(data);
+        return data;
+    }
+
+    private async Task<Dictionary<string, long[]>> GetDeepZoomIndexAsync(string indexPath)
+    {
+        var modified = File.GetLastWriteTimeUtc(indexPath);
+        if (_cache.TryGetValue(indexPath, out DeepZoomIndex? cached) && cached!.Modified == modified)
+            return cached.Entries;
+
+        await using var stream = File.OpenRead(indexPath);
+        var index = await JsonSerializer.DeserializeAsync<DeepZoomIndexFile>(stream, JsonSerializerOptions.Web)
+                    ?? throw new InvalidDataException($"Invalid deep zoom index {indexPath}");
+        _cache.Set(indexPath, new DeepZoomIndex(modified, index.Entries), new MemoryCacheEntryOptions
+        {
+            SlidingExpiration = TimeSpan.FromMinutes(10)
+        });
+        return index.Entries;
+    }
+
+    private record DeepZoomIndexFile(Dictionary<string, long[]> Entries);
+
+    private record DeepZoomIndex(DateTime Modified, Dictionary<string, long[]> Entries);
+
     private async Task CheckIfProjectValid(string userName, Guid projectId)
     {
         var userHasProject = await _db.Projects.AnyAsync(p => p.ProjectId == projectId && p.User.UserName == userName);
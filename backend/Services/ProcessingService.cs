@@ -1,4 +1,5 @@
-﻿using backend.Data;
+﻿using System.Net;
+using backend.Data;
 using backend.DTOs;
 using backend.Models;
 using Microsoft.EntityFrameworkCore;
@@ -109,6 +110,14 @@ public class ProcessingService : IProcessingService
         try
         {
             response = await _httpClient.PostAsJsonAsync("/enqueue", payload);
+            if (response.StatusCode == HttpStatusCode.UnprocessableEntity)
+            {
+                // the processing service rejected the job, e.g. because no worker has enough memory for it
+                var rejection = await response.Content.ReadFromJsonAsync<ProcessingErrorDto>();
+                _db.Jobs.Remove(job);
+                await _db.SaveChangesAsync();
+                throw new InvalidOperationException(rejection?.Detail ?? "The processing service rejected the job.");
+            }
             if (!response.IsSuccessStatusCode)
                 throw new HttpRequestException($"Request failed with status {response.StatusCode}");
         }
@@ -121,6 +130,10 @@ public class ProcessingService : IProcessingService
 
         if (!response.IsSuccessStatusCode) throw new HttpRequestException(await response.Content.ReadAsStringAsync());
 
+        // jobs too large for the requested algorithm are switched to one with a smaller memory footprint
+        var enqueued = await response.Content.ReadFromJsonAsync<EnqueueJobResponseDto>();
+        if (enqueued?.Algorithm is not null && enqueued.Algorithm != job.Algorithm)
+            job.Algorithm = enqueued.Algorithm;
         job.Status = JobStatus.Submitted;
         await _db.SaveChangesAsync();
         return job;
@@ -141,6 +154,14 @@ public class ProcessingService : IProcessingService
         var job = await _db.Jobs.FindAsync(jobId);
         if (job is null) throw new InvalidOperationException($"Job {jobId} does not exist.");
 
+        if (status == JobStatus.Processing && job.Status == JobStatus.GeneratedPreview && progress is not null)
+        {
+            // the optimal mosaic is still being computed after a greedy preview, only the progress advances
+            job.Progress = double.Clamp(progress.Value, 0, 1);
+            await _db.SaveChangesAsync();
+            return;
+        }
+
         if (status < job.Status || status != job.Status &&
             job.Status is JobStatus.Finished or JobStatus.Failed or JobStatus.Aborted)
             throw new InvalidOperationException(
@@ -165,6 +186,8 @@ public class ProcessingService : IProcessingService
                 {
                     Console.WriteLine($"Job {jobId} marked as completed.");
                     job.Status = JobStatus.GeneratedPreview;
+                    if (progress is not null)
+                        job.Progress = double.Clamp(progress.Value, 0, 1);
                 }
                 else
                 {
@@ -193,6 +216,37 @@ public class ProcessingService : IProcessingService
         await _db.SaveChangesAsync();
     }
 
+    // Polled by Python worker to detect aborted jobs
+    public async Task<JobStatusDto?> GetStatus(Guid jobId)
+    {
+        return await _db.Jobs
+            .Where(j => j.JobId == jobId)
+            .Select(j => new JobStatusDto { Status = j.Status, Progress = j.Progress })
+            .FirstOrDefaultAsync();
+    }
+
+    public async Task AbortJobAsync(string userName, Guid projectId, Guid jobId)
+    {
+        await CheckIfProjectValid(userName, projectId);
+        var job = await _db.Jobs.FirstOrDefaultAsync(j => j.JobId == jobId && j.ProjectId == projectId);
+        if (job is null) throw new InvalidOperationException($"Job {jobId} does not exist.");
+        if (job.Status is JobStatus.Finished or JobStatus.Aborted or JobStatus.Failed)
+            throw new InvalidOperationException($"Job {jobId} is not active.");
+
+        // the worker stops once it notices the new status
+        job.Status = JobStatus.Aborted;
+        job.FinishedAt = DateTime.UtcNow;
+        await _db.SaveChangesAsync();
+    }
+
+    public async Task RequestCollectionIndexAsync(string collectionId)
+    {
+        // the collection can be used without an index, jobs are just slower to load its images
+        var response = await _httpClient.PostAsync($"/collections/{Uri.EscapeDataString(collectionId)}/index", null);
+        if (!response.IsSuccessStatusCode)
+            throw new HttpRequestException($"Indexing collection {collectionId} failed with status {response.StatusCode}");
+    }
+
     public async Task<JobDto?> GetJobAsync(string userName, Guid projectId, Guid jobId)
     {
         await CheckIfProjectValid(userName, projectId);
@@ -90,6 +90,7 @@ public class TileCollectionService : ITileCollectionService
                     await GenerateSmallImages(dirPath);
                     dbCollection.Status = CollectionStatus.Ready;
                     dbCollection.InstallDate = DateTime.UtcNow;
+                    await RequestIndexAsync(scope, collectionId);
                 }
                 else
                 {
@@ -171,6 +172,19 @@ public class TileCollectionService : ITileCollectionService
         };
     }
 
+    private static async Task RequestIndexAsync(IServiceScope scope, string collectionId)
+    {
+        try
+        {
+            var processing = scope.ServiceProvider.GetRequiredService<IProcessingService>();
+            await processing.RequestCollectionIndexAsync(collectionId);
+        }
+        catch (Exception ex) when (ex is HttpRequestException or TaskCanceledException)
+        {
+            Console.WriteLine($"Unable to request indexing of collection {collectionId}: {ex.Message}");
+        }
+    }
+
     private static async Task GenerateSmallImages(string dirPath)
     {
         var filePaths = Directory.GetFiles(dirPath);
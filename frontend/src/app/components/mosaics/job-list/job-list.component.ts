@@ -108,7 +108,7 @@ export class JobListComponent implements OnDestroy {
         const r = await this.modals.openComponentModal<{
             targetId: string,
             n: number,
-            algorithm: 'LAP',
+            algorithm: 'LAP' | 'AUCTION' | 'ANYTIME' | 'SPARSE_LAP' | 'BLOCK_LAP',
             colorSpace: 'RGB' | 'CIELAB' | 'CIELAB_WEIGHTED',
             subdivisions: number,
             repetitions: number,
@@ -42,11 +42,16 @@ export class JobComponent implements OnDestroy {
     targetImageId = computed(() => this.job()?.target)
     targetImage = signal<{ url: string } | null>(null);
     hasPreview = computed(() => this.job() && [JobStatus.GeneratedPreview, JobStatus.Finished].includes(this.job()!.status))
+    // large jobs show a greedy preview while the optimal mosaic is computed, which replaces it once progress reaches 1
+    isRefining = computed(() => this.job()?.status === JobStatus.GeneratedPreview && this.job()!.progress < 1)
+    mosaicVersion = computed(() => !this.hasPreview() ? 0 : this.isRefining() ? 1 : 2)
     isComplete = computed(() => this.job() && [JobStatus.Finished, JobStatus.Failed, JobStatus.Aborted].includes(this.job()!.status))
     jobRefreshInterval: number;
     mosaic = signal<{ url: string } | null>(null);
 
-    statusText = computed(() => statusTexts[this.job()?.status ?? JobStatus.Created]);
+    statusText = computed(() => this.isRefining()
+        ? 'Refining mosaic...'
+        : statusTexts[this.job()?.status ?? JobStatus.Created]);
 
     protected readonly JobStatus = JobStatus;
 
@@ -69,8 +74,8 @@ export class JobComponent implements OnDestroy {
             }
         });
 
-        effect(() => { // fetch mosaic when job preview exists
-            if (this.hasPreview()) {
+        effect(() => { // fetch mosaic when job preview exists and again once it has been refined
+            if (this.mosaicVersion()) {
                 this.api.getMosaic(this.username()!, this.projectId()!, this.jobId()!).subscribe({
                     next: blob => {
                         this.revokeMosaic();
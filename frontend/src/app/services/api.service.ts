@@ -98,7 +98,7 @@ export class ApiService {
 
 
     // Jobs
-    createJob(userName: string, projectId: string, targetId: string, n: number, algorithm: 'LAP',
+    createJob(userName: string, projectId: string, targetId: string, n: number, algorithm: 'LAP' | 'AUCTION' | 'ANYTIME' | 'SPARSE_LAP' | 'BLOCK_LAP',
               subdivisions: number, repetitions: number, cropCount: number, colorSpace: 'RGB' | 'CIELAB' | 'CIELAB_WEIGHTED') {
         const body = {
             algorithm: algorithm,
@@ -0,0 +1,119 @@
+"""
+admission.py
+
+Estimates the peak memory and the runtime of a job from its request before it is enqueued.
+
+The API uses the estimate to route a job to the queue of suitably sized workers, to switch jobs that would not fit
+any worker to an algorithm with a smaller footprint and to reject jobs that cannot run at all (see api.py).
+The model follows the largest allocations of a job: the warm cache of the worker and the fitted tiles and their feature
+vectors, which live for the whole job, and on top of them either the cost matrix and the temporary arrays of the solver
+or the deep zoom image. The two stages are estimated separately: only the solver stage depends on the algorithm, so
+switching the algorithm cannot help a job whose deep zoom image does not fit.
+The constants were measured with benchmark.py on a single core and are rounded up.
+"""
+
+import math
+from model import EnqueueJobRequest, JobEstimate
+from config import (TILE_RESOLUTION, COST_DTYPE, COST_MEMORY_BUDGET, TILED_COST_LIMIT, SPARSE_CANDIDATE_COUNT,
+                    SPARSE_GAP_CHECK_LIMIT, BLOCK_SIZE, BLOCK_WORKERS, BUILD_WORKERS, LOAD_CONCURRENCY, ANYTIME_TIME_BUDGET,
+                    AUCTION_TOLERANCE, WARM_CACHE_MAX_BYTES)
+
+COST_ITEMSIZES = {'float16': 2, 'float32': 4, 'float64': 8}
+BASE_BYTES = 320 * 1024 ** 2  # interpreter, libraries, target image and job metadata
+DEEPZOOM_BYTES_PER_CELL = 512 * 1024  # pyvips keeps the pipeline of every cell open while saving the pyramid
+SPARSE_BYTES_PER_EDGE = 64  # distances, indices and the sorted and sparse copies of the candidate edges
+LOAD_SECONDS_PER_CROP = 1e-3  # decoding and fitting, for tiles that are not in the feature store yet
+COST_SECONDS_PER_VALUE = 2e-9  # per cell, tile crop and feature value
+LAP_SECONDS_PER_OP = 4e-10  # linear_sum_assignment, times cells² * columns
+AUCTION_SECONDS_PER_ENTRY = 5e-8  # all epsilon phases, per entry of the cost matrix
+GREEDY_SECONDS_PER_ENTRY = 5e-9  # initial assignment and candidates of the ANYTIME solver, per entry of the cost matrix
+LOCAL_SEARCH_BYTES_PER_CELL = 8 * 64  # candidates of every cell and the arrays of a pass over all of them
+SPARSE_SECONDS_PER_EDGE = 2e-6
+RENDER_SECONDS_PER_CELL = 1e-4
+DEEPZOOM_SECONDS_PER_CELL = 0.03
+
+# algorithms with a smaller footprint to switch to if a job does not fit any worker, in order of preference
+FALLBACK_ALGORITHMS = {
+    'LAP': ['BLOCK_LAP', 'SPARSE_LAP'],
+    'AUCTION': ['BLOCK_LAP', 'SPARSE_LAP'],
+    'ANYTIME': ['BLOCK_LAP', 'SPARSE_LAP'],
+    'BLOCK_LAP': ['SPARSE_LAP'],
+    'SPARSE_LAP': [],
+}
+
+
+def estimate_job(request: EnqueueJobRequest, algorithm: str = None) -> JobEstimate:
+    """
+    Estimate the peak memory and runtime of a job, optionally as if it used another algorithm.
+    """
+    algorithm = algorithm or request.algorithm
+    images = max(1, request.tileCount)
+    c, reps, g = max(1, request.crop_count), max(1, request.repetitions), max(1, request.subdivisions)
+    n = max(1, min(request.n, images))  # like worker.get_cell_count
+    itemsize = COST_ITEMSIZES[COST_DTYPE]
+    dense_bytes = n * images * (itemsize + (1 if c > 1 else 0))  # cost matrix and crop choices
+    chunk_bytes = min(COST_MEMORY_BUDGET, 2 * n * images * c * itemsize) * BUILD_WORKERS
+    cost_seconds = COST_SECONDS_PER_VALUE * n * images * c * g * g * 3
+
+    match 'LAP' if algorithm == 'AUCTION' and AUCTION_TOLERANCE <= 0 else algorithm:  # like worker.get_solver
+        case 'LAP':
+            if reps > 1 and n * images * reps * 8 <= TILED_COST_LIMIT:
+                copy_bytes = n * images * reps * 8  # repeated cost matrix
+            else:
+                copy_bytes = n * images * 8 if itemsize != 8 else 0  # conversion to float64
+            solve_bytes = dense_bytes + max(chunk_bytes, copy_bytes)
+            solve_seconds = cost_seconds + LAP_SECONDS_PER_OP * n * n * images * reps
+        case 'AUCTION':
+            solve_bytes = dense_bytes + max(chunk_bytes, COST_MEMORY_BUDGET)
+            solve_seconds = cost_seconds + AUCTION_SECONDS_PER_ENTRY * n * images
+        case 'ANYTIME':
+            time_budget = ANYTIME_TIME_BUDGET if request.time_budget is None else request.time_budget
+            solve_bytes = dense_bytes + max(chunk_bytes, LOCAL_SEARCH_BYTES_PER_CELL * n + 32 * 1024 ** 2)
+            solve_seconds = cost_seconds + GREEDY_SECONDS_PER_ENTRY * n * images + time_budget
+        case 'SPARSE_LAP':
+            # the candidates are doubled while no complete matching exists, usually once or twice
+            edges = n * min(images, 4 * SPARSE_CANDIDATE_COUNT) * reps
+            # the dense problem is only solved as well if gap reports are enabled (benchmarks)
+            gap_check_bytes = 2 * n * images * reps * 8 if n * images * reps <= SPARSE_GAP_CHECK_LIMIT else 0
+            solve_bytes = edges * c * SPARSE_BYTES_PER_EDGE + gap_check_bytes
+            solve_seconds = SPARSE_SECONDS_PER_EDGE * edges + (cost_seconds if gap_check_bytes else 0)
+        case 'BLOCK_LAP':
+            blocks = math.ceil(n / BLOCK_SIZE)
+            cells = math.ceil(n / blocks)
+            block_images = min(images, math.ceil(images * reps / blocks))
+            # every process holds the cost matrix of a block with its columns repeated by capacity
+            block_bytes = cells * block_images * (2 * itemsize + 1) + cells * cells * 8
+            solve_bytes = blocks * images * 8 + min(BLOCK_WORKERS, blocks) * block_bytes + chunk_bytes
+            # shifted blocks and the repair rounds roughly triple the work of the first pass
+            block_ops = blocks * cells * cells * block_images * reps * 3
+            solve_seconds = cost_seconds + LAP_SECONDS_PER_OP * block_ops / min(BLOCK_WORKERS, blocks)
+        case _:
+            raise ValueError(f"Unknown algorithm: {algorithm}")
+
+    tiles_bytes = images * c * (TILE_RESOLUTION * TILE_RESOLUTION * 3 + g * g * 3 * 8)
+    resident_bytes = BASE_BYTES + WARM_CACHE_MAX_BYTES + tiles_bytes
+    solve_peak_bytes = resident_bytes + solve_bytes
+    deepzoom_peak_bytes = resident_bytes + DEEPZOOM_BYTES_PER_CELL * n
+    runtime_seconds = (LOAD_SECONDS_PER_CROP * images * c / max(1, LOAD_CONCURRENCY) + solve_seconds
+                       + (RENDER_SECONDS_PER_CELL + DEEPZOOM_SECONDS_PER_CELL) * n)
+    return JobEstimate(algorithm=algorithm, cells=n, memory_bytes=int(max(solve_peak_bytes, deepzoom_peak_bytes)),
+                       solve_bytes=int(solve_peak_bytes), deepzoom_bytes=int(deepzoom_peak_bytes),
+                       runtime_seconds=round(runtime_seconds, 1))
+
+
+def admit_job(request: EnqueueJobRequest, queue_limits: dict[str, int]) -> JobEstimate:
+    """
+    Return the estimate of the job with the queue whose workers can run it (queue_limits maps the queue names to the
+    memory of their workers, from small to large). If the requested algorithm does not fit any queue, the first
+    fallback algorithm that fits is used instead. Returns the estimate without a queue if nothing fits.
+    """
+    estimate = estimate_job(request)
+    if estimate.deepzoom_bytes > max(queue_limits.values()):
+        return estimate  # the same for every algorithm
+    for algorithm in [request.algorithm] + FALLBACK_ALGORITHMS.get(request.algorithm, []):
+        estimate = estimate_job(request, algorithm)
+        for queue, max_bytes in queue_limits.items():
+            if estimate.memory_bytes <= max_bytes:
+                estimate.queue = queue
+                return estimate
+    return estimate_job(request)
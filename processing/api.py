@@ -1,23 +1,125 @@
 import os
+import re
+import itertools
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import PlainTextResponse
 from redis import Redis, RedisError
 from rq import Queue
-from worker import process_job
-from model import EnqueueJobRequest
+from model import EnqueueJobRequest, EnqueueBatchRequest, JobEstimate, JobSweep
+from metrics import render_metrics
+from admission import admit_job
 
 app = FastAPI()
 REDIS_HOST = os.getenv("REDIS_HOST", "redis")
 REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
+INDEX_JOB_TIMEOUT = int(os.getenv("INDEX_JOB_TIMEOUT", 3600))  # seconds, indexing large collections takes a while
+SMALL_QUEUE = os.getenv("SMALL_QUEUE", "small")
+SMALL_QUEUE_MAX_BYTES = int(os.getenv("SMALL_QUEUE_MAX_BYTES", 3 * 1024 ** 3))  # memory of a job the small workers can run
+LARGE_QUEUE = os.getenv("LARGE_QUEUE", "large")
+LARGE_QUEUE_MAX_BYTES = int(os.getenv("LARGE_QUEUE_MAX_BYTES", 12 * 1024 ** 3))  # memory of a job the large workers can run
+MIN_JOB_TIMEOUT = int(os.getenv("MIN_JOB_TIMEOUT", 600))  # seconds, jobs time out after 3x their estimated runtime or this
+# jobs are enqueued by their import path, so the API does not load the image processing libraries
+PROCESS_JOB = "worker.process_job"
+PROCESS_BATCH = "worker.process_batch"
+INDEX_COLLECTION = "indexer.index_collection"
 redis_conn = Redis(host=REDIS_HOST, port=REDIS_PORT)
-queue = Queue(connection=redis_conn)
+queues = {SMALL_QUEUE: Queue(SMALL_QUEUE, connection=redis_conn), LARGE_QUEUE: Queue(LARGE_QUEUE, connection=redis_conn)}
+queue_limits = {SMALL_QUEUE: SMALL_QUEUE_MAX_BYTES, LARGE_QUEUE: LARGE_QUEUE_MAX_BYTES}
 
 
 @app.post("/enqueue")
 async def enqueue_job(request: EnqueueJobRequest):
+    """
+    Enqueue a job on the queue of the smallest workers it fits, switching to an algorithm with a smaller
+    footprint if it does not fit any worker with the requested one. Jobs that fit no worker at all are rejected.
+    """
+    estimate = admit(request)
     try:
-        queue.enqueue(process_job, request)
-        print(f"Enqueued {request.job_id}")
-        return {"status": "enqueued", "job_id": request.job_id}
+        timeout = max(MIN_JOB_TIMEOUT, int(3 * estimate.runtime_seconds))
+        queues[estimate.queue].enqueue(PROCESS_JOB, request, job_timeout=timeout)
+        print(f"Enqueued {request.job_id} on {estimate.queue}, estimated {estimate.memory_bytes / 1024 ** 2:.0f} MiB "
+              f"and {estimate.runtime_seconds:.0f}s")
+        return {"status": "enqueued", "job_id": request.job_id, "queue": estimate.queue,
+                "algorithm": estimate.algorithm, "estimate": estimate}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/enqueue/batch")
+async def enqueue_batch(request: EnqueueBatchRequest):
+    """
+    Enqueue several jobs with the same target and tiles as a single batch, which loads the tiles only once.
+    The jobs are given as variants or as a sweep over parameters of a base job. Every job is admitted like a single
+    job, the batch runs on the queue of the largest one.
+    """
+    variants = list(request.variants)
+    if request.sweep is not None:
+        variants += expand_sweep(request.sweep)
+    if not variants:
+        raise HTTPException(status_code=422, detail="The batch contains no jobs")
+    first = variants[0]
+    if any((v.username, v.project_id, v.target, v.tiles, v.collections) !=
+           (first.username, first.project_id, first.target, first.tiles, first.collections) for v in variants):
+        raise HTTPException(status_code=422, detail="All jobs of a batch need the same target and tiles")
+    if len({v.job_id for v in variants}) < len(variants):
+        raise HTTPException(status_code=422, detail="The job ids of a batch must be unique")
+
+    estimates = [admit(v) for v in variants]
+    queue = max((e.queue for e in estimates), key=list(queue_limits).index)
+    try:
+        timeout = max(MIN_JOB_TIMEOUT, int(3 * sum(e.runtime_seconds for e in estimates)))
+        job = queues[queue].enqueue(PROCESS_BATCH, variants, job_timeout=timeout)
+        print(f"Enqueued batch {job.id} of {len(variants)} jobs on {queue}")
+        return {"status": "enqueued", "job_id": job.id, "queue": queue,
+                "jobs": [{"job_id": v.job_id, "algorithm": e.algorithm, "estimate": e} for v, e in zip(variants, estimates)]}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+def admit(request: EnqueueJobRequest) -> JobEstimate:
+    """
+    Return the estimate of a job with the queue it fits. Switches the algorithm of the request if necessary and
+    raises an HTTPException if the job cannot run at all.
+    """
+    try:
+        estimate = admit_job(request, queue_limits)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    if estimate.queue is None:
+        stage = "its deep zoom image" if estimate.deepzoom_bytes >= estimate.solve_bytes else "its assignment"
+        raise HTTPException(status_code=422, detail=f"The mosaic is too large to be created: {stage} needs about "
+                                                    f"{estimate.memory_bytes / 1024 ** 3:.1f} GiB of memory")
+    if estimate.algorithm != request.algorithm:
+        print(f"Switching {request.job_id} from {request.algorithm} to {estimate.algorithm}")
+        request.algorithm = estimate.algorithm
+    return estimate
+
+
+def expand_sweep(sweep: JobSweep) -> list[EnqueueJobRequest]:
+    """
+    Return a job for every combination of the swept parameters. Parameters without values keep those of the base job.
+    """
+    names = ['n', 'repetitions', 'crop_count', 'color_space']
+    values = [getattr(sweep, name) or [getattr(sweep.base, name)] for name in names]
+    combinations = list(itertools.product(*values))
+    if len(combinations) != len(sweep.jobs):
+        raise HTTPException(status_code=422, detail=f"The sweep has {len(combinations)} combinations, "
+                                                    f"but {len(sweep.jobs)} jobs were given")
+    return [sweep.base.model_copy(update={'job_id': ref.job_id, 'token': ref.token, **dict(zip(names, combination))})
+            for ref, combination in zip(sweep.jobs, combinations)]
+
+
+@app.post("/collections/{collection_id}/index")
+async def enqueue_index_collection(collection_id: str):
+    """
+    Build the atlas of an installed collection in the background, so that jobs no longer decode its images
+    """
+    if not re.fullmatch(r"[A-Za-z0-9_-]+", collection_id):
+        raise HTTPException(status_code=400, detail="Invalid collection id")
+    try:
+        job = queues[LARGE_QUEUE].enqueue(INDEX_COLLECTION, f"collections/{collection_id}", job_timeout=INDEX_JOB_TIMEOUT)
+        print(f"Enqueued indexing of collection {collection_id}")
+        return {"status": "enqueued", "job_id": job.id}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -42,3 +144,14 @@ async def readyz():
             raise HTTPException(status_code=503, detail="Redis not reachable")
     except RedisError:
         raise HTTPException(status_code=503, detail="Redis not reachable")
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    """
+    Per-stage job metrics pushed by the workers and the state of the queue in the Prometheus text format
+    """
+    try:
+        return PlainTextResponse(render_metrics(redis_conn, list(queues.values())), media_type="text/plain; version=0.0.4")
+    except RedisError:
+        raise HTTPException(status_code=503, detail="Redis not reachable")
@@ -0,0 +1,501 @@
+"""
+assignment.py
+
+Solvers for the assignment of mosaic cells (rows of the cost matrix) to tiles (columns of the cost matrix).
+"""
+
+import time
+import numpy as np
+from scipy import optimize, sparse
+from typing import Callable
+
+
+def capacitated_linear_sum_assignment(C: np.ndarray, capacity) -> tuple[np.ndarray, np.ndarray]:
+    '''
+    Optimally assign every row of C to a column, where column j can be used by at most capacity[j] rows.
+
+    The result is equivalent to solving scipy.optimize.linear_sum_assignment on a cost matrix with every
+    column repeated capacity[j] times, but every column is stored only once.
+    Rows are added one by one along shortest augmenting paths (Jonker-Volgenant style, as in scipy).
+    All copies of a column share the same dual variable, so a full column leads to all rows assigned to it.
+
+    Returns (row_ind, col_ind) like linear_sum_assignment.
+    '''
+    n, m = C.shape
+    capacity = np.broadcast_to(np.asarray(capacity, dtype=np.int64), (m,))
+    if capacity.sum() < n:
+        raise ValueError('cost matrix is infeasible')
+
+    u = C.min(axis=1).astype(np.float64)  # row duals, reduced costs C - u - v are non-negative
+    v = np.zeros(m)  # column duals
+    col4row = np.full(n, -1, dtype=np.int64)
+    load = np.zeros(m, dtype=np.int64)
+    rows4col = [[] for _ in range(m)]
+
+    # greedily assign rows to their cheapest column (tight edges) while capacity is left
+    for i, j in enumerate(C.argmin(axis=1)):
+        if load[j] < capacity[j]:
+            col4row[i] = j
+            load[j] += 1
+            rows4col[j].append(i)
+
+    nd = np.empty(m)
+    better = np.empty(m, dtype=bool)
+    for cur_row in np.flatnonzero(col4row == -1):
+        d = C[cur_row] - u[cur_row] - v  # shortest path distances to all columns
+        pred = np.full(m, cur_row, dtype=np.int64)
+        remaining = np.ones(m, dtype=bool)
+        popped = []  # columns with final distances, in order
+        popped_d = []
+        scanned_rows = [cur_row]
+        scanned_rows_d = [0.0]
+        is_scanned = {cur_row}
+
+        while True:
+            j = int(np.argmin(d))
+            lowest = d[j]
+            if not np.isfinite(lowest):
+                raise ValueError('cost matrix is infeasible')
+            popped.append(j)
+            popped_d.append(lowest)
+            d[j] = np.inf
+            remaining[j] = False
+            if load[j] < capacity[j]:
+                sink = j
+                break
+            # the column is full: continue from all rows assigned to it (their reduced cost is 0)
+            for r in rows4col[j]:
+                if r in is_scanned:
+                    continue
+                is_scanned.add(r)
+                scanned_rows.append(r)
+                scanned_rows_d.append(lowest)
+                np.subtract(C[r], v, out=nd)
+                nd += lowest - u[r]
+                np.less(nd, d, out=better)
+                better &= remaining
+                np.copyto(d, nd, where=better)
+                pred[better] = r
+
+        # update duals
+        u[scanned_rows] += lowest - np.asarray(scanned_rows_d)
+        v[popped] -= lowest - np.asarray(popped_d)
+
+        # augment along the path
+        j = sink
+        load[sink] += 1
+        while True:
+            r = pred[j]
+            prev = col4row[r]
+            col4row[r] = j
+            rows4col[j].append(r)
+            if r == cur_row:
+                break
+            rows4col[prev].remove(r)
+            j = prev
+
+    return np.arange(n), col4row
+
+
+def greedy_assignment(C, capacity, memory_budget: int = 256 * 1024 ** 2) -> tuple[np.ndarray, np.ndarray]:
+    '''
+    Quickly assign every row of C to a cheap column, where column j can be used by at most capacity[j] rows.
+
+    In every round, each unassigned row proposes its cheapest column that is not full yet and every column accepts
+    its cheapest proposals up to its remaining capacity. The result is usually a few percent worse than the optimum,
+    but only needs a handful of passes over C (chunked to memory_budget bytes of temporary arrays).
+    For a sparse C, edges are accepted in the order of their cost. Rows without a free column among their entries
+    are left unassigned (column -1).
+
+    Returns (row_ind, col_ind) like linear_sum_assignment.
+    '''
+    n, m = C.shape
+    remaining = np.broadcast_to(np.asarray(capacity, dtype=np.int64), (m,)).copy()
+    if remaining.sum() < n:
+        raise ValueError('cost matrix is infeasible')
+    col4row = np.full(n, -1, dtype=np.int64)
+
+    if sparse.issparse(C):
+        C = C.tocoo()
+        order = np.argsort(C.data, kind='stable')
+        load = remaining.tolist()
+        assigned = col4row.tolist()
+        for i, j in zip(C.row[order].tolist(), C.col[order].tolist()):
+            if assigned[i] < 0 and load[j] > 0:
+                assigned[i] = j
+                load[j] -= 1
+        return np.arange(n), np.array(assigned, dtype=np.int64)
+
+    penalty = np.zeros(m)  # inf for full columns
+    chunk_rows = max(1, memory_budget // (2 * m * 8))
+    rows = np.arange(n)
+    while rows.size:
+        best = np.empty(rows.size, dtype=np.int64)
+        best_cost = np.empty(rows.size)
+        for start in range(0, rows.size, chunk_rows):
+            costs = C[rows[start:start + chunk_rows]] + penalty
+            best[start:start + chunk_rows] = costs.argmin(axis=1)
+            best_cost[start:start + chunk_rows] = costs[np.arange(len(costs)), best[start:start + chunk_rows]]
+
+        # sort the proposals by column and cost, the first remaining[j] proposals of column j are accepted
+        order = np.lexsort((best_cost, best))
+        cols = best[order]
+        rank = np.arange(cols.size) - np.searchsorted(cols, cols)
+        accepted = rank < remaining[cols]
+        col4row[rows[order[accepted]]] = cols[accepted]
+        remaining -= np.bincount(cols[accepted], minlength=m)
+        penalty[remaining == 0] = np.inf
+        rows = np.sort(rows[order[~accepted]])
+    return np.arange(n), col4row
+
+
+class AssignmentSolver:
+    '''
+    Assigns every row (cell) of a cost matrix to a column (tile), where every column may be used at most
+    capacity times.
+    '''
+    def solve(self, C: np.ndarray, capacity: int, initial_assignment: np.ndarray = None) -> tuple[np.ndarray, np.ndarray]:
+        '''
+        Return (row_ind, col_ind) like scipy.optimize.linear_sum_assignment, with col_ind indexing the columns of C.
+        Solvers that support warm starts use the column of every row in initial_assignment as starting point.
+        '''
+        raise NotImplementedError
+
+    def cache_key(self) -> str:
+        '''
+        Identify the solver and all parameters that influence its result (see MosaicBuilder.set_result_cache).
+        '''
+        return type(self).__name__
+
+
+class HungarianSolver(AssignmentSolver):
+    '''
+    Optimal solver based on scipy's linear_sum_assignment.
+    Problems with capacity > 1 whose repeated cost matrix would exceed tiled_cost_limit bytes are solved
+    with capacitated_linear_sum_assignment instead.
+    '''
+    def __init__(self, tiled_cost_limit: int = 256 * 1024 ** 2):
+        self.tiled_cost_limit = tiled_cost_limit
+
+    def solve(self, C, capacity, initial_assignment=None):
+        n, m = C.shape
+        if capacity > 1 and n * m * capacity * np.dtype(np.float64).itemsize > self.tiled_cost_limit:
+            # repetitions become column capacities instead of copies of the cost matrix
+            return capacitated_linear_sum_assignment(C, capacity)
+        if capacity > 1:
+            C = np.tile(C, (1, capacity))
+        row_ind, col_ind = optimize.linear_sum_assignment(C)
+        return row_ind, col_ind % m
+
+
+class AuctionSolver(AssignmentSolver):
+    '''
+    Vectorized forward auction algorithm with epsilon scaling (Bertsekas).
+
+    Every column offers capacity slots with individual prices. In each round, all unassigned rows bid for the
+    cheapest slot of their best column and the highest bid per column wins. Epsilon is divided by
+    scaling_factor after each phase until the final epsilon is reached.
+    The final epsilon guarantees a total cost of at most (1 + tolerance) times the optimum, as n * epsilon is
+    bounded by tolerance times the sum of the row minima (a lower bound of the optimal cost).
+    Larger tolerances therefore finish faster. The tolerance must be positive: the number of phases grows with
+    log(1 / tolerance), and each phase takes longer than the one before. Use HungarianSolver for the optimum.
+
+    Prices are kept after solving, so a subsequent solve of a problem with the same shape starts close to
+    the previous equilibrium.
+    '''
+    def __init__(self, tolerance: float = 1e-2, scaling_factor: float = 8.0, memory_budget: int = 256 * 1024 ** 2):
+        if tolerance <= 0 or scaling_factor <= 1:
+            raise ValueError('Invalid auction parameters.')
+        self.tolerance = tolerance
+        self.scaling_factor = scaling_factor
+        self.memory_budget = memory_budget
+        self.prices = None  # (columns, capacity), kept for warm starts
+
+    def solve(self, C, capacity, initial_assignment=None):
+        n, m = C.shape
+        if m * capacity < n:
+            raise ValueError('cost matrix is infeasible')
+        cost_range = float(C.max() - C.min()) if C.size else 0.0
+        lower_bound = float(C.min(axis=1).sum())
+        eps_final = max(self.tolerance * lower_bound / n, 1e-9 * max(cost_range, 1.0))
+
+        warm_prices = self.prices is not None and self.prices.shape == (m, capacity)
+        prices = self.prices.copy() if warm_prices else np.zeros((m, capacity))
+        owner = np.full((m, capacity), -1, dtype=np.int64)  # row that occupies each slot
+        col4row = np.full(n, -1, dtype=np.int64)
+        slot4row = np.full(n, -1, dtype=np.int64)
+        if initial_assignment is not None:
+            self._assign_initial(initial_assignment, owner, col4row, slot4row)
+
+        # with known prices only the last phases are necessary
+        eps = eps_final * self.scaling_factor ** 2 if warm_prices else max(cost_range / 4, eps_final)
+        while True:
+            self._run_phase(C, prices, owner, col4row, slot4row, eps, cost_range)
+            if eps <= eps_final:
+                break
+            eps = max(eps / self.scaling_factor, eps_final)
+
+        self.prices = prices
+        return np.arange(n), col4row
+
+    def cache_key(self):
+        return f'{type(self).__name__}-{self.tolerance}-{self.scaling_factor}'
+
+    def _assign_initial(self, initial_assignment, owner, col4row, slot4row):
+        load = np.zeros(owner.shape[0], dtype=np.int64)
+        for i, j in enumerate(initial_assignment):
+            if 0 <= j < owner.shape[0] and load[j] < owner.shape[1]:
+                owner[j, load[j]] = i
+                col4row[i], slot4row[i] = j, load[j]
+                load[j] += 1
+
+    def _run_phase(self, C, prices, owner, col4row, slot4row, eps, cost_range):
+        n, m = C.shape
+        chunk_rows = max(1, self.memory_budget // (2 * m * C.itemsize))
+
+        # keep only assignments that satisfy epsilon-complementary slackness. All free slots get the lowest
+        # price, which is required for the optimality bound when there are more slots than rows
+        while True:
+            min_price = prices.min()
+            prices[owner == -1] = min_price
+            assigned = np.flatnonzero(col4row >= 0)
+            best = self._best_costs(C, assigned, prices.min(axis=1), chunk_rows)
+            current = C[assigned, col4row[assigned]] + prices[col4row[assigned], slot4row[assigned]]
+            violating = assigned[current > best + eps]
+            if violating.size == 0:
+                break
+            owner[col4row[violating], slot4row[violating]] = -1
+            col4row[violating] = -1
+            slot4row[violating] = -1
+
+        unassigned = np.flatnonzero(col4row == -1)
+        while unassigned.size:
+            cheapest_slot = prices.argmin(axis=1)
+            p1 = prices[np.arange(m), cheapest_slot]
+            p2 = np.partition(prices, 1, axis=1)[:, 1] if prices.shape[1] > 1 else np.full(m, np.inf)
+
+            bid_cols = np.empty(unassigned.size, dtype=np.int64)
+            bids = np.empty(unassigned.size)
+            for start in range(0, unassigned.size, chunk_rows):
+                rows = unassigned[start:start + chunk_rows]
+                costs = C[rows] + p1
+                r = np.arange(len(rows))
+                j1 = costs.argmin(axis=1)
+                c1 = costs[r, j1]
+                costs[r, j1] = np.inf
+                # the second best option is either another column or the next slot of the same column
+                c2 = np.minimum(costs.min(axis=1), C[rows, j1] + p2[j1])
+                c2 = np.where(np.isfinite(c2), c2, c1 + cost_range)  # only a single slot exists
+                bid_cols[start:start + len(rows)] = j1
+                bids[start:start + len(rows)] = p1[j1] + (c2 - c1) + eps
+
+            # the highest bid for each column wins its cheapest slot
+            order = np.lexsort((-bids, bid_cols))
+            first = np.ones(order.size, dtype=bool)
+            first[1:] = bid_cols[order][1:] != bid_cols[order][:-1]
+            winners = order[first]
+            win_rows, win_cols = unassigned[winners], bid_cols[winners]
+            win_slots = cheapest_slot[win_cols]
+
+            evicted = owner[win_cols, win_slots]
+            evicted = evicted[evicted >= 0]
+            col4row[evicted] = -1
+            slot4row[evicted] = -1
+            owner[win_cols, win_slots] = win_rows
+            prices[win_cols, win_slots] = bids[winners]
+            col4row[win_rows] = win_cols
+            slot4row[win_rows] = win_slots
+
+            losers = np.delete(unassigned, winners)
+            unassigned = np.concatenate((losers, evicted))
+
+    @staticmethod
+    def _best_costs(C, rows, col_prices, chunk_rows):
+        best = np.empty(rows.size)
+        for start in range(0, rows.size, chunk_rows):
+            chunk = rows[start:start + chunk_rows]
+            best[start:start + len(chunk)] = (C[chunk] + col_prices).min(axis=1)
+        return best
+
+
+class LocalSearchSolver(AssignmentSolver):
+    '''
+    Anytime solver with a time budget. Starts from initial_assignment (or greedy_assignment) and improves it by
+    local search until time_budget seconds have passed since the start of solve, then returns the best assignment
+    found so far. The search ends earlier if a round does not improve the assignment anymore.
+
+    Every row only considers its candidate_count cheapest columns. A round consists of two kinds of moves:
+    - Pairwise: every row moves to a candidate column with capacity left or swaps columns with a row assigned to it.
+      The gains of all these moves are evaluated at once and a subset of improving moves without shared rows is applied.
+    - Cyclic: neighbourhoods of random rows, the rows assigned to their candidates and the free slots of these are
+      reassigned optimally with linear_sum_assignment. Any permutation of their columns is a combination of cyclic
+      swaps, so this applies the best cycles of any length within a neighbourhood.
+    Swaps keep the load of every column, and rows only move to columns with capacity left, so the capacity is never
+    exceeded.
+
+    After every pass, (elapsed seconds, total cost) is appended to trajectory and passed to progress_callback.
+    '''
+    def __init__(self, time_budget: float = 60.0, candidate_count: int = 8, neighbourhood_size: int = 1024,
+                 seed: int = 0, memory_budget: int = 256 * 1024 ** 2,
+                 progress_callback: Callable[[float, float], None] = None):
+        if time_budget < 0 or candidate_count < 1 or neighbourhood_size < 2:
+            raise ValueError('Invalid local search parameters.')
+        self.time_budget = time_budget
+        self.candidate_count = candidate_count
+        self.neighbourhood_size = neighbourhood_size
+        self.seed = seed
+        self.memory_budget = memory_budget
+        self.progress_callback = progress_callback
+        self.trajectory: list[tuple[float, float]] = []
+
+    def solve(self, C, capacity, initial_assignment=None):
+        start = time.perf_counter()
+        deadline = start + self.time_budget
+        n, m = C.shape
+        if m * capacity < n:
+            raise ValueError('cost matrix is infeasible')
+        if self._is_feasible(initial_assignment, n, m, capacity):
+            col4row = np.asarray(initial_assignment, dtype=np.int64).copy()
+        else:
+            _, col4row = greedy_assignment(C, capacity, self.memory_budget)
+        load = np.bincount(col4row, minlength=m)
+        rng = np.random.default_rng(self.seed)
+
+        self.trajectory = []
+        cost = float(C[np.arange(n), col4row].sum(dtype=np.float64))
+        self._report(start, cost)
+        candidates = self._get_candidates(C, deadline)
+        while candidates is not None and time.perf_counter() < deadline:
+            round_start = cost
+            while time.perf_counter() < deadline:
+                gain = self._pairwise_pass(C, candidates, col4row, load, capacity)
+                cost -= gain
+                self._report(start, cost)
+                if gain <= 1e-9 * abs(cost):
+                    break
+            cost = self._cyclic_pass(C, candidates, col4row, load, capacity, rng, start, deadline, cost)
+            self._report(start, cost)
+            if round_start - cost <= 1e-9 * abs(cost):
+                break
+        return np.arange(n), col4row
+
+    def cache_key(self):
+        # the result depends on the speed of the machine, so it is only reproducible for a budget that is never used up
+        return f'{type(self).__name__}-{self.time_budget}-{self.candidate_count}-{self.neighbourhood_size}-{self.seed}'
+
+    @staticmethod
+    def _is_feasible(assignment, n, m, capacity) -> bool:
+        if assignment is None or len(assignment) != n:
+            return False
+        assignment = np.asarray(assignment)
+        return bool(np.all((assignment >= 0) & (assignment < m))
+                    and np.bincount(assignment, minlength=m).max(initial=0) <= capacity)
+
+    def _report(self, start, cost):
+        elapsed = time.perf_counter() - start
+        self.trajectory.append((elapsed, cost))
+        if self.progress_callback is not None:
+            self.progress_callback(elapsed, cost)
+
+    def _get_candidates(self, C, deadline) -> np.ndarray:
+        '''
+        Return the candidate_count cheapest columns of every row, or None if the deadline passes in the meantime.
+        '''
+        n, m = C.shape
+        k = min(self.candidate_count, m)
+        candidates = np.empty((n, k), dtype=np.int64)
+        chunk_rows = max(1, self.memory_budget // (2 * m * 8))
+        for start in range(0, n, chunk_rows):
+            if time.perf_counter() >= deadline:
+                return None
+            chunk = np.asarray(C[start:start + chunk_rows])
+            candidates[start:start + len(chunk)] = np.argpartition(chunk, k - 1, axis=1)[:, :k] if k < m else np.arange(m)
+        return candidates
+
+    @staticmethod
+    def _get_owners(col4row, m) -> np.ndarray:
+        '''
+        Return a row assigned to every column, -1 for unused columns.
+        '''
+        owner = np.full(m, -1, dtype=np.int64)
+        owner[col4row] = np.arange(col4row.size)
+        return owner
+
+    def _pairwise_pass(self, C, candidates, col4row, load, capacity) -> float:
+        '''
+        Apply improving moves and swaps to candidate columns and return the gain.
+        '''
+        n, k = candidates.shape
+        owner = self._get_owners(col4row, C.shape[1])
+        current = C[np.arange(n), col4row].astype(np.float64)
+        rows = np.repeat(np.arange(n), k)
+        cols = candidates.ravel()
+        keep = cols != col4row[rows]
+        rows, cols = rows[keep], cols[keep]
+
+        move = load[cols] < capacity
+        partners = np.where(move, -1, owner[cols])
+        delta = C[rows, cols] - current[rows]
+        swap = np.flatnonzero(~move)
+        delta[swap] += C[partners[swap], col4row[rows[swap]]] - current[partners[swap]]
+        improving = np.flatnonzero(delta < 0)
+        if improving.size == 0:
+            return 0.0
+
+        # in the order of their gain, a move is applied if it is the best one of all its rows
+        order = improving[np.argsort(delta[improving], kind='stable')]
+        rows, cols, partners, move, delta = rows[order], cols[order], partners[order], move[order], delta[order]
+        index = np.arange(order.size)
+        first = np.full(n, order.size)
+        np.minimum.at(first, rows, index)
+        np.minimum.at(first, partners[~move], index[~move])
+        accepted = (first[rows] == index) & (move | (first[np.maximum(partners, 0)] == index))
+
+        # moves to the same column are accepted up to its remaining capacity
+        moves = np.flatnonzero(accepted & move)
+        by_col = moves[np.argsort(cols[moves], kind='stable')]
+        sorted_cols = cols[by_col]
+        rank = np.arange(by_col.size) - np.searchsorted(sorted_cols, sorted_cols)
+        accepted[by_col[rank >= capacity - load[sorted_cols]]] = False
+
+        rows, cols, partners, move = rows[accepted], cols[accepted], partners[accepted], move[accepted]
+        np.subtract.at(load, col4row[rows[move]], 1)
+        np.add.at(load, cols[move], 1)
+        col4row[partners[~move]] = col4row[rows[~move]]
+        col4row[rows] = cols
+        return float(-delta[accepted].sum())
+
+    def _cyclic_pass(self, C, candidates, col4row, load, capacity, rng, start, deadline, cost) -> float:
+        '''
+        Reassign the columns of neighbourhoods around every row optimally and return the new cost.
+        Long passes report their progress about once per second.
+        '''
+        n, k = candidates.shape
+        owner = self._get_owners(col4row, C.shape[1])
+        seed_count = max(1, self.neighbourhood_size // (k + 1))
+        last_report = time.perf_counter()
+        for seeds in np.array_split(rng.permutation(n), max(1, n // seed_count)):
+            now = time.perf_counter()
+            if now >= deadline:
+                break
+            if now - last_report >= 1.0:
+                self._report(start, cost)
+                last_report = now
+            cols = np.unique(candidates[seeds])
+            owners = owner[cols]
+            owners = owners[(owners >= 0) & (col4row[np.maximum(owners, 0)] == cols)]  # skip outdated owners
+            rows = np.union1d(seeds, owners)
+            free = cols[load[cols] < capacity]
+            slots = np.concatenate((col4row[rows], free))
+            sub = np.asarray(C[rows[:, None], slots[None, :]], dtype=np.float64)
+            before = sub[np.arange(rows.size), np.arange(rows.size)].sum()
+            _, sub_cols = optimize.linear_sum_assignment(sub)
+            after = sub[np.arange(rows.size), sub_cols].sum()
+            if after >= before:
+                continue
+            np.subtract.at(load, col4row[rows], 1)
+            col4row[rows] = slots[sub_cols]
+            np.add.at(load, col4row[rows], 1)
+            owner[col4row[rows]] = rows
+            cost -= before - after
+        return float(cost)
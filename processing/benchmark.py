@@ -0,0 +1,280 @@
+"""
+benchmark.py
+
+Reproducible benchmark of the processing pipeline of a job (read_images, the builder, save_result and save_deepzoom) on
+synthetic data.
+
+The target and the tiles are generated deterministically from a seed, so results are comparable between runs and machines.
+Starting from a base configuration, one parameter is varied at a time. Every configuration runs in a fresh process,
+so the reported peak memory only belongs to that configuration.
+
+Usage:
+    python benchmark.py --preset quick --output results.json
+    python benchmark.py --preset full --output results.json --baseline baseline.json --tolerance 0.25
+    python benchmark.py --preset quick --output parallel.json --baseline results.json --workers 4
+
+If a baseline is given, configurations whose total time or peak memory grew by more than the tolerance are reported
+and the exit code is 1.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import resource
+import tempfile
+import multiprocessing
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable
+import numpy as np
+from PIL import Image, ImageDraw
+from metrics import BUILD_STAGES, read_peak_rss, reset_peak_rss
+
+TARGET_SIZE = (1200, 900)
+TILE_SIZES = [(160, 120), (120, 160), (140, 140)]  # several aspect ratios, so that cropping is exercised
+GAP_CHECK_LIMIT = 4_000_000  # SPARSE_GAP_CHECK_LIMIT of the benchmark, production workers do not solve the dense problem
+
+BASE_CONFIG = {
+    'n': 800,
+    'tiles': 1600,  # the worker never uses more cells than images
+    'subdivisions': 2,
+    'crop_count': 1,
+    'repetitions': 1,
+    'color_space': 'RGB',
+    'algorithm': 'LAP',
+}
+
+PRESETS = {
+    'quick': {
+        'n': [400, 1600],
+        'tiles': [800],
+        'subdivisions': [4],
+        'crop_count': [3],
+        'repetitions': [2],
+        'color_space': ['CIELAB'],
+    },
+    'full': {
+        'n': [400, 1600, 3200, 6400],
+        'tiles': [400, 3200, 6400],
+        'subdivisions': [1, 4, 8],
+        'crop_count': [2, 3, 5],
+        'repetitions': [2, 5],
+        'color_space': ['CIELAB', 'CIELAB_WEIGHTED'],
+        'algorithm': ['AUCTION', 'ANYTIME', 'SPARSE_LAP', 'BLOCK_LAP'],
+    },
+}
+
+
+def get_configs(preset: str) -> list[dict]:
+    """
+    Return the base configuration and every configuration that differs from it in exactly one parameter.
+    """
+    configs = [dict(BASE_CONFIG)]
+    for key, values in PRESETS[preset].items():
+        configs += [{**BASE_CONFIG, key: value} for value in values if value != BASE_CONFIG[key]]
+    return configs
+
+
+def get_config_name(config: dict) -> str:
+    return ",".join(f"{k}={v}" for k, v in config.items())
+
+
+def generate_target(path: str, seed: int):
+    """
+    Draw a smooth gradient with random shapes, which resembles a photo closely enough for matching.
+    """
+    rng = np.random.default_rng(seed)
+    w, h = TARGET_SIZE
+    y, x = np.mgrid[0:h, 0:w] / max(w, h)
+    base = np.stack([128 + 100 * np.sin(2 * np.pi * (f * x + g * y)) for f, g in rng.uniform(0.3, 2, (3, 2))], axis=-1)
+    img = Image.fromarray(np.clip(base, 0, 255).astype(np.uint8))
+    draw = ImageDraw.Draw(img)
+    for _ in range(40):
+        x0, y0 = rng.integers(0, w), rng.integers(0, h)
+        size = rng.integers(20, 200)
+        draw.ellipse((x0, y0, x0 + size, y0 + size), fill=tuple(int(c) for c in rng.integers(0, 256, 3)))
+    img.save(path, quality=90)
+
+
+def generate_tile(path: str, seed: int, index: int):
+    """
+    Draw a tile with a random base color, a gradient and some noise.
+    """
+    rng = np.random.default_rng([seed, index])
+    w, h = TILE_SIZES[index % len(TILE_SIZES)]
+    color = rng.integers(0, 256, 3)
+    gradient = np.linspace(-40, 40, w)[None, :, None] * rng.uniform(-1, 1, 3)
+    noise = rng.normal(0, 12, (h, w, 3))
+    Image.fromarray(np.clip(color + gradient + noise, 0, 255).astype(np.uint8)).save(path, quality=90)
+
+
+def prepare_data(data_dir: str, tile_count: int, seed: int) -> tuple[str, list[str]]:
+    """
+    Generate the target and the tiles below data_dir (if they do not exist yet).
+    Return their paths relative to data_dir.
+    """
+    target = os.path.join("bench", f"seed{seed}", "target.jpg")
+    if not os.path.exists(os.path.join(data_dir, target)):
+        os.makedirs(os.path.dirname(os.path.join(data_dir, target)), exist_ok=True)
+        generate_target(os.path.join(data_dir, target), seed)
+
+    tiles = []
+    for i in range(tile_count):
+        tile = os.path.join("bench", f"seed{seed}", "tiles", f"t{i:06d}.jpg")
+        if not os.path.exists(os.path.join(data_dir, tile)):
+            os.makedirs(os.path.dirname(os.path.join(data_dir, tile)), exist_ok=True)
+            generate_tile(os.path.join(data_dir, tile), seed, i)
+        tiles.append(tile)
+    return target, tiles
+
+
+def run_config(config: dict, data_dir: str, seed: int, workers: int = 1) -> dict:
+    """
+    Build and save a mosaic for one configuration and return the measurements.
+    Must run in a fresh process, as the worker module reads its configuration from the environment on import.
+    """
+    os.environ["BASE_PATH"] = data_dir
+    os.environ["CACHE_PATH"] = os.path.join(data_dir, "cache")
+    shutil.rmtree(os.environ["CACHE_PATH"], ignore_errors=True)  # every configuration starts cold
+    os.environ.setdefault("SPARSE_GAP_CHECK_LIMIT", str(GAP_CHECK_LIMIT))  # log the quality gap of SPARSE_LAP
+    os.environ["BUILD_WORKERS"] = str(workers)
+    import worker
+    from model import EnqueueJobRequest
+    from mosaic_creator import MosaicProgress, MosaicTimer
+    from status_reporter import NullReporter
+
+    target_path, tile_paths = prepare_data(data_dir, config['tiles'], seed)
+    request = EnqueueJobRequest(job_id=get_config_name(config), username="benchmark", project_id="benchmark", token="",
+                                n=config['n'], algorithm=config['algorithm'], subdivisions=config['subdivisions'],
+                                crop_count=config['crop_count'], repetitions=config['repetitions'], target=target_path,
+                                tiles=tile_paths, collections=[], tileCount=len(tile_paths),
+                                color_space=config['color_space'])
+    stages_ms = {}
+    stage_peak_rss = {}
+
+    def measure(stage: str, run: Callable, *args):
+        reset_peak_rss()
+        start = time.perf_counter()
+        returned = run(*args)
+        stages_ms[stage] = int((time.perf_counter() - start) * 1000)
+        stage_peak_rss[stage] = read_peak_rss()
+        return returned
+
+    # the same loading, builder and stages as a job of the worker (see process_job and create_mosaic)
+    target, tiles, tile_vals, _, _ = measure("load", worker.read_images, request, NullReporter())
+    builder = worker.init_builder(request, target, tiles, tile_vals)
+    timer = MosaicTimer()
+
+    def on_progress(p: MosaicProgress):
+        timer.measure(p.value)
+        if p.value > 0:
+            stage_peak_rss[BUILD_STAGES[p.value - 1]] = read_peak_rss()
+        reset_peak_rss()
+
+    result = builder.build(on_progress)
+    stages_ms.update({stage: timer.get_delta(i, i + 1) for i, stage in enumerate(BUILD_STAGES)})
+
+    job_dir = os.path.join(data_dir, "jobs", get_config_name(config))
+    shutil.rmtree(job_dir, ignore_errors=True)
+    path_list = measure("save", worker.save_result, tile_paths, result, job_dir)
+    dz_dir = os.path.join(job_dir, "dz")
+    measure("deepzoom", worker.save_deepzoom, path_list, result.shape[1], result.crop_count, dz_dir)
+    dz_files = [os.path.join(root, name) for root, _, names in os.walk(dz_dir) for name in names]
+    dz_bytes = sum(os.path.getsize(p) for p in dz_files)
+    shutil.rmtree(job_dir, ignore_errors=True)
+
+    return {
+        'name': get_config_name(config),
+        'config': config,
+        'shape': list(result.shape),
+        'stages_ms': stages_ms,
+        'total_ms': sum(stages_ms.values()),
+        'stage_peak_rss_bytes': stage_peak_rss,
+        'peak_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        'cost_matrix_bytes': builder.cost_bytes,
+        'deepzoom_files': len(dz_files),  # DZ_CONTAINER=zip writes a single archive with its index
+        'deepzoom_bytes': dz_bytes,
+        'score': float(result.get_score()),
+    }
+
+
+def run_benchmark(configs: list[dict], data_dir: str, seed: int, repeat: int, workers: int = 1) -> list[dict]:
+    """
+    Run every configuration repeat times and keep the fastest run.
+    """
+    results = []
+    context = multiprocessing.get_context("spawn")
+    for config in configs:
+        runs = []
+        for _ in range(repeat):
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                runs.append(executor.submit(run_config, config, data_dir, seed, workers).result())
+        best = min(runs, key=lambda r: r['total_ms'])
+        print(f"{best['name']}: {best['total_ms']} ms, peak RSS {best['peak_rss_bytes'] / 1024 ** 2:.0f} MiB, "
+              f"cost matrix {best['cost_matrix_bytes'] / 1024 ** 2:.1f} MiB", flush=True)
+        results.append(best)
+    return results
+
+
+def compare(results: list[dict], baseline: dict, tolerance: float) -> list[str]:
+    """
+    Return a description of every configuration whose time or memory regressed by more than tolerance.
+    """
+    previous = {r['name']: r for r in baseline['results']}
+    regressions = []
+    for r in results:
+        if r['name'] not in previous:
+            continue
+        for metric in ('total_ms', 'peak_rss_bytes'):
+            old, new = previous[r['name']][metric], r[metric]
+            if old > 0 and new > old * (1 + tolerance):
+                regressions.append(f"{r['name']}: {metric} {old} -> {new} (+{(new / old - 1) * 100:.0f}%)")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the mosaic processing pipeline on synthetic data.")
+    parser.add_argument("--preset", choices=PRESETS.keys(), default="quick")
+    parser.add_argument("--output", default="benchmark.json", help="path of the JSON file with the results")
+    parser.add_argument("--baseline", help="JSON file of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative regression (default: 0.25)")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per configuration, the fastest one is kept")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=1, help="processes per build (BUILD_WORKERS), BLOCK_LAP uses BLOCK_WORKERS")
+    parser.add_argument("--data-dir", help="directory for the generated images (default: temporary directory)")
+    args = parser.parse_args()
+
+    data_dir = args.data_dir or os.path.join(tempfile.gettempdir(), "mosaic-benchmark")
+    results = run_benchmark(get_configs(args.preset), os.path.abspath(data_dir), args.seed, args.repeat, args.workers)
+    report = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'preset': args.preset,
+        'seed': args.seed,
+        'workers': args.workers,
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'cpu_count': os.cpu_count(),
+        },
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+collection_atlas.py
+
+Packed, memory-mapped index of an installed tile collection.
+
+Collections are immutable once installed, so their tiles are fitted and their feature vectors computed once by the
+indexer (see indexer.py) instead of in every job. The atlas is a directory inside the collection containing
+- manifest.json: the image file names in atlas order, an id of the build and the names of the arrays,
+- one uint8 array of fitted thumbnails per crop count, named like the thumbnail groups of the feature store,
+- one array of feature vectors per crop count, subdivisions and color space, named like the feature groups.
+All arrays are in the layout expected by MosaicBuilder.set_prepared_tiles and are memory-mapped when read,
+so jobs use them without listing the collection, decoding images or copying the arrays.
+An atlas is written to a temporary directory and renamed, so readers never see a partial one.
+"""
+
+import os
+import json
+import uuid
+import shutil
+import numpy as np
+
+ATLAS_DIR = ".atlas"
+MANIFEST_FILE = "manifest.json"
+ARRAY_SUFFIX = ".npy"
+
+
+class CollectionAtlas:
+    def __init__(self, path: str, manifest: dict):
+        self.path = path
+        self.id: str = manifest['id']
+        self.names: list[str] = manifest['names']  # image file names relative to the collection directory
+        self.arrays: set[str] = set(manifest['arrays'])
+
+    @staticmethod
+    def open(collection_dir: str) -> 'CollectionAtlas':
+        """
+        Return the atlas of a collection, or None if it was not indexed (yet).
+        """
+        path = os.path.join(collection_dir, ATLAS_DIR)
+        try:
+            with open(os.path.join(path, MANIFEST_FILE)) as f:
+                return CollectionAtlas(path, json.load(f))
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def has(self, group: str) -> bool:
+        return group in self.arrays
+
+    def get(self, group: str) -> np.ndarray:
+        """
+        Return the read-only, memory-mapped array of a group, or None if the atlas does not contain it.
+        """
+        if group not in self.arrays:
+            return None
+        try:
+            return np.load(os.path.join(self.path, group + ARRAY_SUFFIX), mmap_mode='r')
+        except (OSError, ValueError):
+            return None  # replaced by a new build in the meantime
+
+
+class AtlasWriter:
+    """
+    Builds a new atlas of a collection. Arrays are created as memory-mapped files and filled in place,
+    so collections of any size are indexed with little memory. The atlas only becomes visible with commit.
+    """
+    def __init__(self, collection_dir: str, names: list[str]):
+        self.collection_dir = collection_dir
+        self.names = names
+        self.tmp_path = os.path.join(collection_dir, f"{ATLAS_DIR}.{uuid.uuid4().hex}.tmp")
+        self.arrays: list[str] = []
+        os.makedirs(self.tmp_path)
+
+    def create(self, group: str, shape: tuple, dtype) -> np.ndarray:
+        self.arrays.append(group)
+        return np.lib.format.open_memmap(os.path.join(self.tmp_path, group + ARRAY_SUFFIX), mode='w+',
+                                         dtype=dtype, shape=shape)
+
+    def commit(self, **params) -> CollectionAtlas:
+        """
+        Write the manifest and replace the previous atlas of the collection, if any.
+        Jobs still reading the previous atlas keep their memory maps.
+        """
+        manifest = {'id': uuid.uuid4().hex, 'names': self.names, 'arrays': self.arrays, **params}
+        with open(os.path.join(self.tmp_path, MANIFEST_FILE), 'w') as f:
+            json.dump(manifest, f)
+
+        path = os.path.join(self.collection_dir, ATLAS_DIR)
+        old_path = f"{path}.{uuid.uuid4().hex}.old"
+        if os.path.isdir(path):
+            os.rename(path, old_path)
+        os.rename(self.tmp_path, path)
+        shutil.rmtree(old_path, ignore_errors=True)
+        return CollectionAtlas(path, manifest)
+
+    def discard(self):
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
@@ -0,0 +1,43 @@
+"""
+config.py
+
+Configuration of the workers from the environment.
+
+Kept separate from worker.py, so that the API can estimate jobs (see admission.py) without importing numpy, scipy,
+scikit-image, Pillow and pyvips. The API enqueues the jobs by their import path.
+"""
+
+import os
+
+BASE_PATH = os.getenv("BASE_PATH", "/app/images")
+BACKEND_CALLBACK_URL = os.getenv("BACKEND_CALLBACK_URL", "http://host.docker.internal:5243/jobs")
+ABORT_POLL_INTERVAL = float(os.getenv("ABORT_POLL_INTERVAL", 5))  # seconds between checks whether a job was aborted
+TILE_RESOLUTION = 32
+DZ_TILE_RESOLUTION = 512
+LOAD_PROGRESS_FRACTION = 0.4  # how much of the progress indicator is used for (typically lazily) loading images
+DOWNSCALED_IMAGE_SUFFIX = "_sm.jpg"
+LOAD_CONCURRENCY = int(os.getenv("LOAD_CONCURRENCY", 2))  # number of threads decoding tiles, should match the CPU limit
+LOAD_OVERSAMPLING = 2  # tiles are decoded with at least this multiple of TILE_RESOLUTION as shorter side
+CACHE_PATH = os.getenv("CACHE_PATH", os.path.join(BASE_PATH, "cache"))
+FEATURE_STORE_MAX_BYTES = int(os.getenv("FEATURE_STORE_MAX_BYTES", 2 * 1024 ** 3))
+DZ_CACHE_MAX_BYTES = int(os.getenv("DZ_CACHE_MAX_BYTES", 2 * 1024 ** 3))
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", 4 * 1024 ** 3))
+DZ_SHARED_TILE_BUDGET = int(os.getenv("DZ_SHARED_TILE_BUDGET", 512 * 1024 ** 2))  # memory for decoded tiles used by several cells
+DZ_CONTAINER = os.getenv("DZ_CONTAINER", "fs")  # "fs" writes the deep zoom tiles as files, "zip" into a single indexed archive
+DZ_CONCURRENCY = int(os.getenv("DZ_CONCURRENCY", 0))  # threads used by libvips to write the deep zoom image, 0 keeps its default
+DZ_JPEG_QUALITY = int(os.getenv("DZ_JPEG_QUALITY", 75))  # quality of the deep zoom tiles, 75 is the libvips default
+COST_DTYPE = os.getenv("COST_DTYPE", "float64")
+COST_MEMORY_BUDGET = int(os.getenv("COST_MEMORY_BUDGET", 256 * 1024 ** 2))
+COLOR_LUT_BITS = int(os.getenv("COLOR_LUT_BITS", 0))  # convert colors with a lookup table of 2^bits levels per channel, 0 is exact
+TILED_COST_LIMIT = int(os.getenv("TILED_COST_LIMIT", 256 * 1024 ** 2))
+AUCTION_TOLERANCE = float(os.getenv("AUCTION_TOLERANCE", 1e-2))  # max. relative suboptimality of the auction solver
+ANYTIME_TIME_BUDGET = float(os.getenv("ANYTIME_TIME_BUDGET", 60))  # seconds for the ANYTIME assignment of jobs without a time budget
+SPARSE_CANDIDATE_COUNT = int(os.getenv("SPARSE_CANDIDATE_COUNT", 16))  # initial number of candidate tiles per cell
+SPARSE_GAP_CHECK_LIMIT = int(os.getenv("SPARSE_GAP_CHECK_LIMIT", 0))  # max. dense cost matrix entries for gap reports, 0 disables them
+BUILD_WORKERS = int(os.getenv("BUILD_WORKERS", 1))  # processes used by a single LAP, AUCTION or SPARSE_LAP build, 1 is serial
+BLOCK_SIZE = int(os.getenv("BLOCK_SIZE", 2048))  # cells per independently solved block
+BLOCK_WORKERS = int(os.getenv("BLOCK_WORKERS", 2))  # processes solving blocks, should match the CPU limit
+PREVIEW_MIN_CELLS = int(os.getenv("PREVIEW_MIN_CELLS", 2000))  # jobs with at least this many cells save a greedy preview first, 0 disables it
+WARM_CACHE_MAX_BYTES = int(os.getenv("WARM_CACHE_MAX_BYTES", 512 * 1024 ** 2))  # in-memory caches of a warm worker, 0 disables them
+WARM_WORKER_MAX_JOBS = int(os.getenv("WARM_WORKER_MAX_JOBS", 100))  # a warm worker exits after this many jobs, 0 disables the limit
+WARM_WORKER_MAX_RSS_BYTES = int(os.getenv("WARM_WORKER_MAX_RSS_BYTES", 2 * 1024 ** 3))  # ... or once it holds this much memory after a job, 0 disables the limit
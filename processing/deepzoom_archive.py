@@ -0,0 +1,60 @@
+"""
+deepzoom_archive.py
+
+Deep zoom images stored as a single archive instead of thousands of loose tile files (see save_deepzoom in worker.py).
+
+libvips writes the pyramid into an uncompressed zip file, so every tile is stored as a contiguous byte range.
+write_index stores the offset and size of every entry in a small JSON file next to the archive. With it, a reader
+serves a tile with a single range read and does not have to parse the zip directory (the backend does the same).
+Entry names are the paths of the loose layout, e.g. "dz.jpg.dzi" and "dz.jpg_files/12/3_4.jpeg".
+"""
+
+import os
+import json
+import struct
+import zipfile
+
+LOCAL_HEADER_SIZE = 30  # fixed part of a zip local file header, followed by the name and the extra field
+
+
+def get_index_path(archive_path: str) -> str:
+    return os.path.splitext(archive_path)[0] + ".index.json"
+
+
+def write_index(archive_path: str) -> str:
+    """
+    Write the offset index of an uncompressed zip archive and return its path.
+    """
+    entries = {}
+    with open(archive_path, "rb") as f, zipfile.ZipFile(f) as archive:
+        for info in archive.infolist():
+            if info.is_dir():
+                continue
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError(f"{info.filename} in {archive_path} is compressed")
+            # the extra field of the local header may differ from the one in the central directory
+            f.seek(info.header_offset + 26)
+            name_size, extra_size = struct.unpack("<HH", f.read(4))
+            offset = info.header_offset + LOCAL_HEADER_SIZE + name_size + extra_size
+            entries[info.filename] = [offset, info.file_size]
+
+    index_path = get_index_path(archive_path)
+    with open(index_path + ".tmp", "w") as f:
+        json.dump({"archive": os.path.basename(archive_path), "entries": entries}, f, separators=(",", ":"))
+    os.replace(index_path + ".tmp", index_path)
+    return index_path
+
+
+def read_index(archive_path: str) -> dict[str, list[int]]:
+    with open(get_index_path(archive_path)) as f:
+        return json.load(f)["entries"]
+
+
+def read_entry(archive_path: str, name: str, index: dict[str, list[int]] = None) -> bytes:
+    """
+    Return the content of an entry with a single range read. Raises KeyError if the archive has no such entry.
+    """
+    offset, size = (index or read_index(archive_path))[name]
+    with open(archive_path, "rb") as f:
+        f.seek(offset)
+        return f.read(size)
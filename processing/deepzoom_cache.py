@@ -0,0 +1,72 @@
+"""
+deepzoom_cache.py
+
+Persistent cache of the square tile crops used to assemble the deep zoom version of a mosaic.
+Every crop is stored once as JPEG on the shared storage volume, keyed by the source image file (see
+feature_store.image_key), the crop index and the crop count. Later jobs only decode the small cached crop
+instead of the full resolution original.
+"""
+
+import os
+import hashlib
+from typing import Callable
+import pyvips
+from feature_store import image_key
+
+CACHED_TILE_QUALITY = 95
+
+
+class DeepZoomTileCache:
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+
+    def get_path(self, abs_path: str, crop_idx: int, crop_count: int, tile_res: int,
+                 create: Callable[[], pyvips.Image]) -> str:
+        """
+        Return the path of the cached crop. If it does not exist yet, it is created from the image returned by create.
+        """
+        key = hashlib.sha1(f"{image_key(abs_path)}|{crop_idx}|{crop_count}|{tile_res}".encode()).hexdigest()
+        path = os.path.join(self.root, key[:2], key + ".jpg")
+        if os.path.exists(path):
+            try:
+                os.utime(path)  # mark as recently used for eviction
+                return path
+            except FileNotFoundError:
+                pass  # evicted in the meantime by another worker
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp.jpg"
+        create().jpegsave(tmp_path, Q=CACHED_TILE_QUALITY)
+        os.replace(tmp_path, path)
+        return path
+
+    def evict(self):
+        """
+        Delete the least recently used crops until the cache is no larger than max_bytes.
+        """
+        files = []
+        total = 0
+        if not os.path.isdir(self.root):
+            return
+        for sub_dir in os.scandir(self.root):
+            if not sub_dir.is_dir():
+                continue
+            for entry in os.scandir(sub_dir.path):
+                if not entry.name.endswith(".jpg") or entry.name.endswith(".tmp.jpg"):
+                    continue
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((st.st_mtime, st.st_size, entry.path))
+                total += st.st_size
+
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
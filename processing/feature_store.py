@@ -0,0 +1,152 @@
+"""
+feature_store.py
+
+Persistent, content-addressed store for fitted tile thumbnails and tile feature vectors.
+
+Entries are grouped by the parameters that produced them (see thumbnail_group and feature_group).
+Within a group, entries are appended in immutable shards: one .npy file holding the stacked arrays
+and one .json file listing the image keys in the same order. Shards are memory-mapped when read,
+so any worker sharing the storage volume can reuse the results of another worker without decoding images.
+"""
+
+import os
+import json
+import uuid
+import hashlib
+import numpy as np
+
+SHARD_SUFFIX = ".npy"
+KEYS_SUFFIX = ".json"
+
+
+def image_key(abs_path: str) -> str:
+    """
+    Identify an image file by its path, size and modification time.
+    Re-uploading or modifying a file therefore invalidates all cached entries derived from it.
+    """
+    st = os.stat(abs_path)
+    return hashlib.sha1(f"{abs_path}|{st.st_size}|{st.st_mtime_ns}".encode()).hexdigest()
+
+
+def thumbnail_group(tile_res: int, crop_count: int) -> str:
+    return f"thumbs-r{tile_res}-c{crop_count}"
+
+
+def feature_group(tile_res: int, crop_count: int, granularity: int, color_space: str, version: int = 1,
+                  lut_bits: int = 0) -> str:
+    group = f"vals-r{tile_res}-c{crop_count}-g{granularity}-{color_space.upper()}"
+    if version > 1:
+        group += f"-v{version}"
+    if lut_bits:
+        group += f"-lut{lut_bits}"
+    return group
+
+
+class TileFeatureStore:
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._manifests: dict[str, dict[str, list[str]]] = {}  # group -> shard -> keys
+
+    def lookup(self, group: str, keys: list[str]) -> dict[str, np.ndarray]:
+        """
+        Return the cached array of every key that is present in the given group.
+        The arrays are read-only views into memory-mapped shards.
+        """
+        wanted = set(keys)
+        found = {}
+        for shard, shard_keys in self._get_manifest(group).items():
+            hits = [(i, k) for i, k in enumerate(shard_keys) if k in wanted and k not in found]
+            if not hits:
+                continue
+            try:
+                arr = np.load(self._shard_path(group, shard), mmap_mode='r')
+                os.utime(self._shard_path(group, shard))  # mark as recently used for eviction
+            except (OSError, ValueError):
+                continue  # evicted in the meantime by another worker
+            for i, k in hits:
+                found[k] = arr[i]
+        return found
+
+    def add(self, group: str, keys: list[str], arrays: np.ndarray):
+        """
+        Store a new shard with arrays[i] belonging to keys[i].
+        """
+        if len(keys) == 0:
+            return
+        group_dir = os.path.join(self.root, group)
+        os.makedirs(group_dir, exist_ok=True)
+        shard = uuid.uuid4().hex
+
+        # write to temporary files first so that readers never see partial shards
+        shard_path = self._shard_path(group, shard)
+        tmp_path = shard_path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            np.save(f, np.ascontiguousarray(arrays))
+        os.replace(tmp_path, shard_path)
+
+        keys_path = os.path.join(group_dir, shard + KEYS_SUFFIX)
+        with open(keys_path + ".tmp", 'w') as f:
+            json.dump(list(keys), f)
+        os.replace(keys_path + ".tmp", keys_path)
+
+        self._get_manifest(group)[shard] = list(keys)
+        self.evict()
+
+    def evict(self):
+        """
+        Delete the least recently used shards until the store is no larger than max_bytes.
+        """
+        shards = []
+        total = 0
+        if not os.path.isdir(self.root):
+            return
+        for group in os.listdir(self.root):
+            group_dir = os.path.join(self.root, group)
+            if not os.path.isdir(group_dir):
+                continue
+            for entry in os.listdir(group_dir):
+                if not entry.endswith(SHARD_SUFFIX):
+                    continue
+                try:
+                    st = os.stat(os.path.join(group_dir, entry))
+                except FileNotFoundError:
+                    continue
+                shards.append((st.st_mtime, st.st_size, group, entry[:-len(SHARD_SUFFIX)]))
+                total += st.st_size
+
+        for _, size, group, shard in sorted(shards):
+            if total <= self.max_bytes:
+                break
+            for path in (os.path.join(self.root, group, shard + KEYS_SUFFIX), self._shard_path(group, shard)):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            self._manifests.get(group, {}).pop(shard, None)
+            total -= size
+
+    def _get_manifest(self, group: str) -> dict[str, list[str]]:
+        """
+        Return the keys of all shards in a group. Only manifests not seen before are read from disk.
+        """
+        manifest = self._manifests.setdefault(group, {})
+        group_dir = os.path.join(self.root, group)
+        if not os.path.isdir(group_dir):
+            manifest.clear()
+            return manifest
+
+        present = {e[:-len(KEYS_SUFFIX)] for e in os.listdir(group_dir) if e.endswith(KEYS_SUFFIX)}
+        for shard in list(manifest):
+            if shard not in present:
+                del manifest[shard]
+        for shard in present - manifest.keys():
+            try:
+                with open(os.path.join(group_dir, shard + KEYS_SUFFIX)) as f:
+                    manifest[shard] = json.load(f)
+            except (OSError, ValueError):
+                continue
+        return manifest
+
+    def _shard_path(self, group: str, shard: str) -> str:
+        return os.path.join(self.root, group, shard + SHARD_SUFFIX)
@@ -0,0 +1,121 @@
+"""
+indexer.py
+
+Builds the atlas of an installed tile collection (see collection_atlas.py), so that jobs using the collection neither
+list its directory nor decode a single one of its images.
+
+Every image is decoded once and fitted at all crop positions of every crop count. The feature vectors are computed
+from the fitted thumbnails for every combination of crop count, subdivisions and color space.
+Jobs fall back to the feature store for collections without an atlas and compute feature vectors missing from
+an atlas (e.g. after FEATURE_VERSION changed) from its thumbnails.
+
+Usage:
+    python indexer.py collections/<id> [collections/<id> ...]
+    python indexer.py collections/<id> --crop-counts 1 2 3 --subdivisions 4 7 --color-spaces CIELAB
+
+The API enqueues index_collection as an RQ job (POST /collections/{collection_id}/index), which the backend calls
+once a collection is installed.
+"""
+
+import os
+import time
+import argparse
+from datetime import datetime
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, ImageOps
+from collection_atlas import AtlasWriter, CollectionAtlas
+from feature_store import thumbnail_group, feature_group
+from mosaic_creator import FEATURE_VERSION, compute_tile_vals, crop_positions
+from worker import (BASE_PATH, TILE_RESOLUTION, LOAD_CONCURRENCY, LOAD_OVERSAMPLING, COLOR_LUT_BITS, get_image,
+                    list_collection_images)
+
+CROP_COUNTS = [1, 2, 3, 4, 5]  # all crop counts accepted by the backend
+SUBDIVISIONS = [1, 2, 3, 4, 5, 6, 7]  # all subdivisions offered by the frontend
+COLOR_SPACES = ['RGB', 'CIELAB', 'CIELAB_WEIGHTED']
+CHUNK_SIZE = 4096  # crops whose feature vectors are computed at once
+
+
+def index_collection(collection: str, crop_counts: list[int] = None, subdivisions: list[int] = None,
+                     color_spaces: list[str] = None) -> dict:
+    """
+    Build (or rebuild) the atlas of a collection given relative to BASE_PATH, e.g. "collections/<id>".
+    Returns a summary of the new atlas.
+    """
+    crop_counts = sorted(set(crop_counts or CROP_COUNTS))
+    subdivisions = sorted(set(subdivisions or SUBDIVISIONS))
+    color_spaces = color_spaces or COLOR_SPACES
+    collection_dir = os.path.join(BASE_PATH, collection)
+    paths = list_collection_images(collection)
+    start = time.perf_counter()
+    log(f"Indexing {len(paths)} images of {collection}")
+
+    writer = AtlasWriter(collection_dir, [os.path.basename(p) for p in paths])
+    try:
+        r = TILE_RESOLUTION
+        thumbs = {c: writer.create(thumbnail_group(r, c), (len(paths), c, r, r, 3), np.uint8) for c in crop_counts}
+        # Pillow releases the GIL while decoding and resizing, so threads decode images concurrently
+        with ThreadPoolExecutor(max_workers=LOAD_CONCURRENCY) as executor:
+            crops = executor.map(lambda p: fit_tile_crops(p, crop_counts), paths)
+            for i, image_crops in enumerate(crops):
+                for c in crop_counts:
+                    thumbs[c][i] = image_crops[c]
+                if (i + 1) % 1000 == 0:
+                    log(f"Fitted {i + 1} / {len(paths)} images")
+
+        for c in crop_counts:
+            tiles = thumbs[c].reshape(-1, r, r, 3)
+            for g in subdivisions:
+                for color_space in color_spaces:
+                    group = feature_group(r, c, g, color_space, FEATURE_VERSION, COLOR_LUT_BITS)
+                    vals = writer.create(group, (len(tiles), g, g, 3), np.float64)
+                    for s in range(0, len(tiles), CHUNK_SIZE):
+                        vals[s:s + CHUNK_SIZE] = compute_tile_vals(tiles[s:s + CHUNK_SIZE], g, color_space, COLOR_LUT_BITS)
+                    vals.flush()
+            thumbs[c].flush()
+        del thumbs
+        atlas = writer.commit(tile_res=r, crop_counts=crop_counts, subdivisions=subdivisions, color_spaces=color_spaces,
+                              feature_version=FEATURE_VERSION, lut_bits=COLOR_LUT_BITS)
+    except BaseException:
+        writer.discard()
+        raise
+
+    size = sum(os.path.getsize(os.path.join(atlas.path, e)) for e in os.listdir(atlas.path))
+    log(f"Indexed {collection} in {time.perf_counter() - start:.1f}s, atlas {atlas.id} has {size / 1024 ** 2:.0f} MiB")
+    return {'collection': collection, 'atlas': atlas.id, 'images': len(atlas.names), 'bytes': size}
+
+
+def fit_tile_crops(path: str, crop_counts: list[int]) -> dict[int, np.ndarray]:
+    """
+    Return the fitted crops of an image for every crop count, like fit_tile. Crop positions shared by several
+    crop counts (e.g. the center) are only fitted once.
+    """
+    img = get_image(path, prefer_small=True, min_size=TILE_RESOLUTION * LOAD_OVERSAMPLING)
+    size = (TILE_RESOLUTION, TILE_RESOLUTION)
+    fitted = {}
+    for pos in {float(pos) for c in crop_counts for pos in crop_positions(c)}:
+        fitted[pos] = np.asarray(ImageOps.fit(img, size, Image.LANCZOS, centering=(pos, pos)))
+    return {c: np.stack([fitted[float(pos)] for pos in crop_positions(c)]) for c in crop_counts}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the memory-mapped atlas of installed tile collections.")
+    parser.add_argument("collections", nargs="+", help="collection directories relative to BASE_PATH, e.g. collections/<id>")
+    parser.add_argument("--crop-counts", type=int, nargs="+", default=CROP_COUNTS)
+    parser.add_argument("--subdivisions", type=int, nargs="+", default=SUBDIVISIONS)
+    parser.add_argument("--color-spaces", nargs="+", choices=COLOR_SPACES, default=COLOR_SPACES)
+    parser.add_argument("--missing-only", action="store_true", help="skip collections that already have an atlas")
+    args = parser.parse_args()
+
+    for collection in args.collections:
+        if args.missing_only and CollectionAtlas.open(os.path.join(BASE_PATH, collection)) is not None:
+            continue
+        index_collection(collection, args.crop_counts, args.subdivisions, args.color_spaces)
+
+
+def log(message: str):
+    print(f"[{datetime.now().isoformat(sep=' ', timespec='milliseconds')}] {message}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+"""
+memory_cache.py
+
+Least recently used cache in process memory with a size limit in bytes.
+
+Workers keep state across jobs only if they run the jobs in their own process (see warm_worker.py). With the default
+forking worker, every job starts with an empty cache.
+"""
+
+import threading
+from collections import OrderedDict
+from typing import Any, Hashable
+
+
+class MemoryCache:
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._entries: OrderedDict[Hashable, tuple[Any, int]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key: Hashable, value, nbytes: int):
+        """
+        Add an entry of about nbytes and evict the least recently used entries until the cache fits its limit.
+        Cached values are shared, so callers must not modify them. Values larger than the limit are not cached.
+        """
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                _, (_, evicted_bytes) = self._entries.popitem(last=False)
+                self.nbytes -= evicted_bytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,197 @@
+"""
+metrics.py
+
+Per-stage metrics of processing jobs.
+
+Workers aggregate the measurements of every job directly into histograms stored in Redis (one hash per metric with
+a counter per bucket, the sum and the count of observations), so the storage does not grow with the number of jobs.
+The API renders these histograms together with the state of the RQ queues in the Prometheus text format.
+"""
+
+import re
+import time
+import resource
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from redis import Redis
+from rq import Queue
+
+KEY_PREFIX = "mosaic:metrics:"
+
+# name -> (help, upper bounds of the buckets)
+HISTOGRAMS = {
+    'mosaic_stage_duration_seconds': (
+        "Wall time of the stages of a processing job.",
+        [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800]),
+    'mosaic_job_peak_rss_bytes': (
+        "Peak resident memory of a processing job.",
+        [2 ** k * 1024 ** 2 for k in range(6, 15)]),  # 64 MiB to 16 GiB
+    'mosaic_cost_matrix_rows': (
+        "Number of cells (rows of the cost matrix) of a processing job, of the largest block for BLOCK_LAP.",
+        [100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000]),
+    'mosaic_cost_matrix_columns': (
+        "Number of tile images (columns of the cost matrix) of a processing job, of the largest block for BLOCK_LAP.",
+        [100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000]),
+}
+COUNTERS = {
+    'mosaic_jobs_total': "Number of processed jobs by outcome.",
+}
+
+BUILD_STAGES = ['tile_prep', 'cost_matrix', 'assignment', 'render']  # between the MosaicProgress events
+
+
+def read_peak_rss() -> int:
+    """
+    Return the peak resident set size in bytes since the last reset_peak_rss (Linux) or since the process start.
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def read_rss() -> int:
+    """
+    Return the current resident set size in bytes (Linux), or 0 if it is unknown.
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def reset_peak_rss():
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass  # not supported, the peak since the process start is reported instead
+
+
+class JobMetrics:
+    """
+    Collects the measurements of a single job.
+    """
+    def __init__(self, algorithm: str):
+        self.algorithm = re.sub(r"[^A-Za-z0-9_]", "_", algorithm)[:32]
+        self.stages: dict[str, float] = {}  # stage -> seconds
+        self.cost_shape: tuple[int, int] = None
+        reset_peak_rss()
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        yield
+        self.stages[name] = time.perf_counter() - start
+
+    def add_build_stages(self, timer, preview_seconds: float = 0.0):
+        """
+        Add the stages of MosaicBuilder.build measured by a completed MosaicTimer. The preview is built between the
+        cost matrix and the assignment, so its time (MosaicBuilder.preview_seconds) is moved to a stage of its own.
+        """
+        for i, stage in enumerate(BUILD_STAGES):
+            self.stages[stage] = timer.get_delta(i, i + 1) / 1000
+        if preview_seconds > 0:
+            self.stages['assignment'] = max(0.0, self.stages['assignment'] - preview_seconds)
+            self.stages['preview'] = preview_seconds
+
+    def push(self, connection: Redis, outcome: str):
+        """
+        Add the measurements to the histograms in Redis. Without a connection, they are only printed.
+        """
+        peak_rss = read_peak_rss()
+        stages = ", ".join(f"{stage} {seconds:.2f}s" for stage, seconds in self.stages.items())
+        print(f"[{datetime.now().isoformat(sep=' ', timespec='milliseconds')}] Job {outcome}: {stages}, "
+              f"peak RSS {peak_rss / 1024 ** 2:.0f} MiB")
+        if connection is None:
+            return
+
+        pipe = connection.pipeline(transaction=False)
+        for stage, seconds in self.stages.items():
+            observe(pipe, 'mosaic_stage_duration_seconds', seconds, stage=stage, algorithm=self.algorithm)
+        observe(pipe, 'mosaic_job_peak_rss_bytes', peak_rss, algorithm=self.algorithm)
+        if self.cost_shape is not None:
+            observe(pipe, 'mosaic_cost_matrix_rows', self.cost_shape[0], algorithm=self.algorithm)
+            observe(pipe, 'mosaic_cost_matrix_columns', self.cost_shape[1], algorithm=self.algorithm)
+        pipe.hincrby(KEY_PREFIX + 'mosaic_jobs_total', format_labels(outcome=outcome, algorithm=self.algorithm), 1)
+        try:
+            pipe.execute()
+        except Exception as e:
+            print(f"[{datetime.now().isoformat(sep=' ', timespec='milliseconds')}] Failed to push metrics: {e}")
+
+
+def format_labels(**labels) -> str:
+    return ",".join(f'{k}="{v}"' for k, v in sorted(labels.items()))
+
+
+def observe(pipe, name: str, value: float, **labels):
+    """
+    Add an observation to a histogram. Buckets are stored non-cumulatively and accumulated when rendering.
+    """
+    key = KEY_PREFIX + name
+    label_str = format_labels(**labels)
+    bounds = HISTOGRAMS[name][1]
+    bucket = next((str(b) for b in bounds if value <= b), "+Inf")
+    pipe.hincrby(key, f"{label_str}|{bucket}", 1)
+    pipe.hincrbyfloat(key, f"{label_str}|sum", value)
+    pipe.hincrby(key, f"{label_str}|count", 1)
+
+
+def render_metrics(connection: Redis, queues: list[Queue]) -> str:
+    """
+    Return all job histograms and counters and the state of the queues in the Prometheus text format.
+    """
+    lines = []
+    for name, (help_text, bounds) in HISTOGRAMS.items():
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+        series = {}
+        for field, value in connection.hgetall(KEY_PREFIX + name).items():
+            label_str, _, suffix = field.decode().rpartition("|")
+            series.setdefault(label_str, {})[suffix] = float(value)
+        for label_str, values in sorted(series.items()):
+            cumulative = 0
+            for bound in [str(b) for b in bounds] + ["+Inf"]:
+                cumulative += values.get(bound, 0)
+                le = format_labels(le=bound)
+                lines.append(f"{name}_bucket{{{join_labels(label_str, le)}}} {int(cumulative)}")
+            lines.append(f"{name}_sum{{{label_str}}} {values.get('sum', 0)}")
+            lines.append(f"{name}_count{{{label_str}}} {int(values.get('count', 0))}")
+
+    for name, help_text in COUNTERS.items():
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+        for field, value in sorted(connection.hgetall(KEY_PREFIX + name).items()):
+            lines.append(f"{name}{{{field.decode()}}} {int(value)}")
+
+    now = datetime.now(timezone.utc)
+    gauges = {
+        'mosaic_queue_depth': ("Number of jobs waiting in the queue.", lambda q: q.count),
+        'mosaic_queue_running_jobs': ("Number of jobs currently processed.", lambda q: q.started_job_registry.count),
+        'mosaic_queue_oldest_job_age_seconds': ("Time the oldest waiting job has spent in the queue.",
+                                                lambda q: get_oldest_job_age(q, now)),
+    }
+    for name, (help_text, get_value) in gauges.items():
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+        for queue in queues:
+            lines.append(f"{name}{{{format_labels(queue=queue.name)}}} {get_value(queue)}")
+    return "\n".join(lines) + "\n"
+
+
+def join_labels(*label_strs: str) -> str:
+    return ",".join(s for s in label_strs if s)
+
+
+def get_oldest_job_age(queue: Queue, now: datetime) -> float:
+    job_ids = queue.get_job_ids(0, 1)
+    job = queue.fetch_job(job_ids[0]) if job_ids else None
+    if job is None or job.enqueued_at is None:
+        return 0
+    enqueued_at = job.enqueued_at if job.enqueued_at.tzinfo else job.enqueued_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (now - enqueued_at).total_seconds())
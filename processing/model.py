@@ -16,6 +16,36 @@ class EnqueueJobRequest(BaseModel):
     collections: list[str]
     tileCount: int
     color_space: str
+    time_budget: float | None = None  # seconds for the assignment of the ANYTIME algorithm
+
+
+class JobRef(BaseModel):
+    job_id: str
+    token: str
+
+
+class JobSweep(BaseModel):
+    base: EnqueueJobRequest
+    jobs: list[JobRef]  # one per combination of the values below, in the order of itertools.product
+    n: list[int] = []
+    repetitions: list[int] = []
+    crop_count: list[int] = []
+    color_space: list[str] = []
+
+
+class EnqueueBatchRequest(BaseModel):
+    variants: list[EnqueueJobRequest] = []
+    sweep: JobSweep | None = None
+
+
+class JobEstimate(BaseModel):
+    algorithm: str
+    cells: int
+    memory_bytes: int  # peak of the job, the larger of the two stages below
+    solve_bytes: int  # peak while computing the costs and the assignment
+    deepzoom_bytes: int  # peak while saving the deep zoom image
+    runtime_seconds: float
+    queue: str | None = None
 
 
 class JobStatus(Enum):
@@ -9,27 +9,48 @@ License: MIT
 
 Usage:
     P = Image.open(target_path)
-    T = ...  # Load tiles as list of PIL Images
+    T = ...  # Tiles as list of PIL Images or paths, or a generator that opens them lazily to keep memory usage low
     params = {
         'resolution': tile_res,
         'granularity': r,  # number of subdivisions
         'tile_count': n,  # number of tiles in target image
         'repetitions': 1,
-        'crop_count': 1
+        'crop_count': 1,
+        'color_space': 'RGB',
+        'cost_dtype': 'float64',  # optional, float32 halves the size of the cost matrix
+        'cost_memory_budget': 256 * 1024 ** 2,  # optional, bytes used for temporary arrays when computing costs
+        'solver': HungarianSolver(),  # optional, see assignment.py
+        'color_lut_bits': 0,  # optional, convert colors with a lookup table of 2^bits levels per channel
+        'workers': 1  # optional, processes used by the build (see set_workers)
     }
     builder = MosaicBuilder(photo=P, tile_images=T, params=params)
     generated = builder.build()
     mosaic = generated.mosaic
 """
 
+import os
 import time
+import hashlib
+import functools
+import multiprocessing
+from collections import deque
+from contextlib import contextmanager
+from itertools import islice, repeat
+from concurrent.futures import Executor, ProcessPoolExecutor
 from PIL import Image, ImageOps
 import numpy as np
-from scipy import optimize
+from scipy import optimize, sparse, spatial
+from scipy.sparse import csgraph
+from assignment import AssignmentSolver, HungarianSolver, capacitated_linear_sum_assignment, greedy_assignment
+from result_cache import ResultCache
+from shared_arrays import SharedArrays, SharedArrayRef, attach
 import math
 from enum import Enum
 from skimage import color
-from typing import Callable
+from typing import Callable, Iterable, Iterator
+
+DEFAULT_COST_MEMORY_BUDGET = 256 * 1024 ** 2
+FEATURE_VERSION = 2  # increase whenever the feature vectors change, so that cached ones are not reused
 
 class MosaicProgress(Enum):
     """
@@ -72,9 +93,23 @@ class Mosaic:
 
 
 class MosaicBuilder:
+    cache_costs = True  # whether the result of _get_best_C can be cached (see set_result_cache)
+
     def __init__(self, photo=None, tile_images=(), params=None):
         self.tile_images = tile_images
         self.photo: Image = photo
+        self.tiles: np.ndarray = None  # optional precomputed fitted tiles (see set_prepared_tiles)
+        self.tile_vals: np.ndarray = None
+        self.result_cache: ResultCache = None
+        self.input_key: str = None
+        self.cost_bytes = 0  # size of the cost matrix of the last build
+        self.cost_shape: tuple[int, int] = None
+        self.workers = 1
+        self.preview_callback: Callable[['Mosaic'], None] = None
+        self.initial_assignment: np.ndarray = None  # column of every row of the preview, where the solver starts
+        self.preview_seconds = 0.0  # time of the preview of the last build, part of the assignment stage
+        self._pool: Executor = None  # process pool and shared memory of a running parallel build
+        self._shared: SharedArrays = None
         if params:
             self.set_tile_res(params['resolution'])
             self.set_granularity(params['granularity'])
@@ -82,6 +117,11 @@ class MosaicBuilder:
             self.set_crop_count(params['crop_count'])
             self.set_tile_count(params['tile_count'])
             self.set_color_space(params['color_space'])
+            self.set_cost_dtype(params.get('cost_dtype', 'float64'))
+            self.set_cost_memory_budget(params.get('cost_memory_budget', DEFAULT_COST_MEMORY_BUDGET))
+            self.set_solver(params.get('solver', HungarianSolver()))
+            self.set_color_lut_bits(params.get('color_lut_bits', 0))
+            self.set_workers(params.get('workers', 1))
         else:
             self.shape = (1, 1)  # (vertical no. of tiles, horizontal no. of tiles)
             self.tile_res: int = 64
@@ -90,15 +130,34 @@ class MosaicBuilder:
             self.crop_count = 1
             self.tile_count = 0
             self.color_space = 'RGB'
+            self.cost_dtype = np.float64
+            self.cost_memory_budget = DEFAULT_COST_MEMORY_BUDGET
+            self.solver: AssignmentSolver = HungarianSolver()
+            self.color_lut_bits = 0
 
     def set_tile_images(self, images):
         self.tile_images = images
         return self
 
     def set_photo(self, photo: Image):
+        '''
+        Set the target image. It may be reduced to the resolution the build needs, if it keeps the size of the original
+        in info['original_size'] (see get_original_size).
+        '''
         self.photo = photo
         return self
 
+    def set_prepared_tiles(self, tiles: np.ndarray, tile_vals: np.ndarray = None):
+        '''
+        Use already fitted tiles (and optionally their feature vectors) instead of fitting tile_images.
+        The layout must match _get_tiles: shape (images * crop_count, tile_res, tile_res, 3), crop index varies fastest.
+        tiles are only read with integer index arrays, so they may be memory-mapped (e.g. a collection atlas) or a
+        TileSet joining several such arrays. Neither is copied to memory as a whole.
+        '''
+        self.tiles = tiles
+        self.tile_vals = tile_vals
+        return self
+
     def set_tile_count(self, max_tiles: int):
         if max_tiles < 1:
             raise ValueError('Invalid tile count.')
@@ -125,120 +184,281 @@ class MosaicBuilder:
         self.color_space = color_space
         return self
 
+    def set_cost_dtype(self, dtype):
+        '''
+        Set the precision of the cost matrix. float32 halves its memory footprint.
+        '''
+        self.cost_dtype = np.dtype(dtype)
+        return self
+
+    def set_cost_memory_budget(self, budget_bytes: int):
+        '''
+        Set the approximate number of bytes used for temporary arrays while computing the cost matrix.
+        '''
+        self.cost_memory_budget = budget_bytes
+        return self
+
+    def set_color_lut_bits(self, bits: int):
+        '''
+        Convert colors with a lookup table of 2^bits levels per channel instead of exactly (0 disables the table).
+        6 bits need 3 MiB and are accurate to about 1 delta E.
+        '''
+        self.color_lut_bits = bits
+        return self
+
+    def set_solver(self, solver: AssignmentSolver):
+        '''
+        Set the solver used to assign tiles to cells (see assignment.py).
+        '''
+        self.solver = solver
+        return self
+
+    def set_workers(self, workers: int):
+        '''
+        Set the number of processes used by a build. With more than one, fitting the tiles, computing their feature
+        vectors and the cost matrix and assembling the mosaic are spread across a process pool. Large arrays are
+        passed through shared memory. The result is identical to the serial build, which is the default.
+        '''
+        self.workers = max(1, workers)
+        return self
+
+    def set_result_cache(self, cache: ResultCache, input_key: str):
+        '''
+        Reuse the cost matrix and the assignment of earlier builds (see result_cache.py).
+        input_key has to identify the target image and the ordered tiles, the builder adds all other parameters.
+        '''
+        self.result_cache = cache
+        self.input_key = input_key
+        return self
+
+    def set_preview_callback(self, callback: Callable[['Mosaic'], None]):
+        '''
+        Pass a preview of the mosaic to callback before the optimal assignment is solved. The preview is rendered
+        from a greedy assignment (see greedy_assignment) that respects the repetitions, which takes a fraction of the
+        time of the optimal solver. Builds that reuse a cached assignment skip the preview.
+        Solvers that support warm starts start from the preview assignment.
+        '''
+        self.preview_callback = callback
+        return self
+
     def build(self, progress_callback=None) -> Mosaic:
-        if not all([self.tile_images, self.photo]):
+        if not self.photo or (self.tiles is None and self.tile_images is None):
             raise ValueError("Not all required attributes have been specified. Cannot build the mosaic.")
 
         if self.tile_count > 0:
             self.shape = shape_from_count(self.photo, self.tile_count)
         else:
-            w, h = self.photo.size
+            w, h = get_original_size(self.photo)
             self.shape = (int(h // self.tile_res), int(w // self.tile_res))
 
-        mosaic, assignment = self._build_mosaic(progress_callback)
+        with self._parallel():
+            mosaic, assignment = self._build_mosaic(progress_callback)
         return Mosaic(self.photo, mosaic, self.shape, self.crop_count, assignment)
 
+    @contextmanager
+    def _parallel(self):
+        '''
+        Provide the process pool and the shared memory used by the stages of a parallel build.
+        Shared memory is released after the pool has shut down, so no worker process uses it anymore.
+        The processes are spawned instead of forked: builds run inside long-lived workers with other threads (e.g. the
+        status reporter), and a forked child could inherit a lock held by one of them.
+        '''
+        if self.workers <= 1:
+            yield
+            return
+        context = multiprocessing.get_context("spawn")
+        try:
+            with SharedArrays() as self._shared, ProcessPoolExecutor(max_workers=self.workers, mp_context=context) as self._pool:
+                yield
+        finally:
+            self._pool, self._shared = None, None
+
     def _build_mosaic(self, progress_callback=None):
         progress_callback(MosaicProgress.STARTED) if progress_callback else None
-        tiles = self._get_tiles()
-        tile_vals = self._get_tile_vals(tiles)
+        tiles, tile_vals = self._get_tiles()
+        if len(tiles) == 0:
+            raise ValueError("No tile images have been specified. Cannot build the mosaic.")
         progress_callback(MosaicProgress.PREPARED_TILES) if progress_callback else None
-        C, C_choice = self._get_best_C(tile_vals)
-        progress_callback(MosaicProgress.COMPUTED_COSTS) if progress_callback else None
-        col_ind, choices = self._get_assignment(C, C_choice)
+        self.initial_assignment = None
+        self.preview_seconds = 0.0
+        cached = self._get_cached('assignment')
+        if cached is not None:
+            print('Reusing cached assignment')
+            progress_callback(MosaicProgress.COMPUTED_COSTS) if progress_callback else None
+            col_ind, choices = cached['col_ind'], cached.get('choices')
+        else:
+            C, C_choice = self._get_cached_best_C(tile_vals)
+            self.cost_bytes = get_nbytes(C) + get_nbytes(C_choice)
+            self.cost_shape = C.shape
+            progress_callback(MosaicProgress.COMPUTED_COSTS) if progress_callback else None
+            if self.preview_callback is not None:
+                self._preview(tiles, C, C_choice)
+            col_ind, choices = self._get_assignment(C, C_choice)
+            self._put_cached('assignment', {'col_ind': col_ind, 'choices': choices})
         progress_callback(MosaicProgress.FOUND_ASSIGNMENT) if progress_callback else None
         mosaic = self._get_mosaic(tiles, col_ind)
         progress_callback(MosaicProgress.FINISHED) if progress_callback else None
         return mosaic, self._get_input_tiles_assignment(col_ind, choices)
 
-    def _get_tiles(self):
-        size = (self.tile_res, self.tile_res)
-        if self.crop_count > 1:
-            tiles = []
-            positions = np.linspace(0.0, 1.0, self.crop_count)
-            for img in self.tile_images:
-                tiles += [ImageOps.fit(img, size, Image.LANCZOS, centering=(pos, pos)) for pos in positions]
-            return tiles
+    def _get_tiles(self) -> tuple[np.ndarray, np.ndarray]:
+        '''
+        Return the fitted tiles as one uint8 array together with their feature vectors.
+        Tile images are streamed through the pipeline one by one, so only the compact results are kept alive
+        if tile_images is a generator. Note that a generator can only be consumed by a single build.
+        '''
+        if self.tiles is not None:
+            return self.tiles, self._get_tile_vals(self.tiles) if self.tile_vals is None else self.tile_vals
+
+        tiles, tile_vals = [], []
+        if self._pool is not None:
+            # images are fitted in batches by the worker processes, paths are even opened by them
+            fit = functools.partial(fit_tile_batch, tile_res=self.tile_res, crop_count=self.crop_count,
+                                    granularity=self.granularity, color_space=self.color_space,
+                                    lut_bits=self.color_lut_bits)
+            batches = bounded_map(self._pool, fit, iter_batches(self.tile_images, 64), 2 * self.workers)
         else:
-            return [ImageOps.fit(img, size, Image.LANCZOS, centering=(0.5, 0.5)) for img in self.tile_images]
-
-    def _get_tile_vals(self, tiles) -> np.ndarray:
-        converter = self._get_color_space_converter()
-        size = (self.granularity, self.granularity)
-        tile_vals = np.zeros((len(tiles), self.granularity, self.granularity, 3))
-        for i, img in enumerate(tiles):
-            tile_vals[i] = converter(np.asarray(img.resize(size, resample=Image.Resampling.BILINEAR)))
-        return tile_vals
+            batches = stream_tiles(self.tile_images, self.tile_res, self.crop_count, self.granularity,
+                                   self.color_space, self.color_lut_bits)
+        for fitted, vals in batches:
+            tiles.append(fitted)
+            tile_vals.append(vals)
+        if not tiles:
+            return np.zeros((0, self.tile_res, self.tile_res, 3), dtype=np.uint8), np.zeros((0, self.granularity, self.granularity, 3))
+        return self._concatenate_shared(tiles), np.concatenate(tile_vals)
+
+    def _concatenate_shared(self, arrays: list[np.ndarray]) -> np.ndarray:
+        '''
+        Concatenate arrays into shared memory during a parallel build, so that later stages can pass them to the pool.
+        '''
+        if self._shared is not None:
+            try:
+                return np.concatenate(arrays, out=self._shared.create((sum(len(a) for a in arrays), *arrays[0].shape[1:]), arrays[0].dtype))
+            except MemoryError as e:
+                print(f'{e}, keeping the tiles in private memory')
+        return np.concatenate(arrays)
+
+    def _get_tile_vals(self, tiles: np.ndarray) -> np.ndarray:
+        if isinstance(tiles, TileSet):
+            return np.concatenate([self._get_tile_vals(part) for part in tiles.parts])
+        if self._pool is not None and len(tiles) > 0:
+            try:
+                return self._get_tile_vals_parallel(tiles)
+            except MemoryError as e:
+                print(f'{e}, computing the tile features serially')
+        return compute_tile_vals(tiles, self.granularity, self.color_space, self.color_lut_bits)
+
+    def _get_tile_vals_parallel(self, tiles: np.ndarray) -> np.ndarray:
+        g = self.granularity
+        dtype = compute_tile_vals(tiles[:1], g, self.color_space, self.color_lut_bits).dtype
+        vals = self._shared.create((len(tiles), g, g, 3), dtype)
+        tiles_ref, vals_ref = self._shared.share(tiles), self._shared.get_ref(vals)
+        bounds = np.linspace(0, len(tiles), 4 * self.workers + 1).astype(int)
+        self._map(tile_vals_rows, repeat(tiles_ref), repeat(vals_ref), bounds[:-1], bounds[1:], repeat(g),
+                  repeat(self.color_space), repeat(self.color_lut_bits))
+        return vals
     
     def _get_color_space_converter(self) -> Callable[[np.ndarray], np.ndarray]:
-        match self.color_space.upper():
-            case 'CIELAB':
-                return lambda arr: color.rgb2lab(arr / 255.0)
-            case 'CIELAB_WEIGHTED': # emphasize lightness
-                return lambda arr: weighted_lab_converter(arr, 5)
-            case _: # basic RGB
-                return lambda arr: arr
+        return get_color_space_converter(self.color_space, self.color_lut_bits)
     
-    def _get_C(self, tile_vals):
+    def _get_photo_vals(self) -> np.ndarray:
+        '''
+        Return the feature vector of every cell of the target image as an array of shape (n, granularity² * 3).
+        '''
         g = self.granularity
+        rows, cols = self.shape
 
-        if self.shape[0] * g == self.photo.size[1] and self.shape[1] * g == self.photo.size[0]:
+        if rows * g == self.photo.size[1] and cols * g == self.photo.size[0]:
             print('Detected maximum granularity')
             photo_arr = np.asarray(self.photo)
         else:
             photo_arr = np.asarray(self.photo.resize(
-                (self.shape[1] * g, self.shape[0] * g),
-                resample=Image.Resampling.BILINEAR))
+                (cols * g, rows * g),
+                resample=Image.Resampling.BOX))  # area average, like the tile features
         photo_arr = self._get_color_space_converter()(photo_arr)
 
-        n = self.shape[0] * self.shape[1]
-        rows, cols = self.shape
+        # split the image into cells of g x g pixels and flatten each cell in (y, x, channel) order
+        return photo_arr.reshape(rows, g, cols, g, 3).swapaxes(1, 2).reshape(rows * cols, g * g * 3)
 
-        C = np.zeros((n, len(tile_vals)))
-        photo_crops = np.zeros((n, g * g * 3))
+    def _get_C(self, tile_vals):
+        return best_cost_matrix(self._get_photo_vals(), tile_vals, 1, self.cost_dtype, self.cost_memory_budget)[0]
 
-        for i in range(n):
-            row = i // cols
-            col = i % cols
-            photo_crops[i] = photo_arr[row * g:row * g + g, col * g:col * g + g, :].flatten()
-        
-        # we think about feature vectors, not images, so we flatten each one
-        tile_vals = tile_vals.reshape(tile_vals.shape[0], -1)
+    def _get_best_C(self, tile_vals):
+        photo_vals = self._get_photo_vals()
+        if self._pool is not None:
+            try:
+                return self._get_best_C_parallel(photo_vals, tile_vals)
+            except MemoryError as e:
+                print(f'{e}, computing the cost matrix serially')
+        return best_cost_matrix(photo_vals, tile_vals, self.crop_count, self.cost_dtype, self.cost_memory_budget)
 
-        # This is the slow part:
-        photo_crops = photo_crops.astype('int64')  # 16 enough for rgb
+    def _get_best_C_parallel(self, photo_vals, tile_vals):
+        '''
+        Compute the row chunks of the serial best_cost_matrix on the pool, writing into a shared cost matrix.
+        Every process uses up to cost_memory_budget for its chunk. Since the chunks are the same as in the serial
+        computation, the cost matrix is bit for bit identical.
+        '''
+        n, m = len(photo_vals), len(tile_vals) // self.crop_count
+        chunk_rows = cost_chunk_rows(len(tile_vals), self.cost_dtype, self.cost_memory_budget)
+        if n <= chunk_rows:
+            return best_cost_matrix(photo_vals, tile_vals, self.crop_count, self.cost_dtype, self.cost_memory_budget)
+        C = self._shared.create((n, m), self.cost_dtype)
+        C_choice = self._shared.create((n, m), np.min_scalar_type(self.crop_count - 1)) if self.crop_count > 1 else None
+        starts = np.arange(0, n, chunk_rows)
+        self._map(cost_rows, repeat(self._shared.share(photo_vals)), repeat(self._shared.share(tile_vals)),
+                  repeat(self._shared.get_ref(C)), repeat(None if C_choice is None else self._shared.get_ref(C_choice)),
+                  starts, np.minimum(starts + chunk_rows, n), repeat(self.crop_count), repeat(self.cost_dtype.str),
+                  repeat(self.cost_memory_budget))
+        return C, C_choice
 
-        for i in range(n):
-            diffs = tile_vals - photo_crops[i]
-            C[i] = np.linalg.norm(diffs, axis=-1)
-        return C
+    def _get_cached_best_C(self, tile_vals):
+        cached = self._get_cached('costs')
+        if cached is not None:
+            print('Reusing cached cost matrix')
+            return cached['C'], cached.get('C_choice')
+        C, C_choice = self._get_best_C(tile_vals)
+        self._put_cached('costs', {'C': C, 'C_choice': C_choice})
+        return C, C_choice
 
-    def _get_best_C(self, tile_vals):
-        if self.crop_count <= 1:
-            return self._get_C(tile_vals), None
+    def _get_cache_key(self, kind: str) -> str:
+        '''
+        Return the key of the cached cost matrix ('costs') or assignment ('assignment') of this build.
+        The target may be loaded at different sizes (see worker.load_target), which changes its feature vectors.
+        '''
+        key = (f'{self.input_key}|{FEATURE_VERSION}|{self.photo.size}|{self.shape}|{self.tile_res}|{self.granularity}|'
+               f'{self.color_space}|{self.color_lut_bits}|{self.crop_count}|{self.cost_dtype}')
+        if kind == 'assignment':
+            key += f'|{self.repetitions}|{self._get_assignment_key()}'
+        return hashlib.sha1(f'{kind}|{key}'.encode()).hexdigest()
 
-        n = self.shape[0] * self.shape[1]
-        Cs = np.zeros((self.crop_count, n, len(self.tile_images)))
+    def _get_assignment_key(self) -> str:
+        '''
+        Identify the method and parameters used to find the assignment.
+        '''
+        return self.solver.cache_key()
 
-        for i in range(self.crop_count):
-            Cs[i] = self._get_C(tile_vals[i::self.crop_count])
+    def _get_cached(self, kind: str) -> dict[str, np.ndarray]:
+        if self.result_cache is None or (kind == 'costs' and not self.cache_costs):
+            return None
+        return self.result_cache.get(self._get_cache_key(kind))
 
-        return np.min(Cs, axis=0), np.argmin(Cs, axis=0)
+    def _put_cached(self, kind: str, arrays: dict[str, np.ndarray]):
+        if self.result_cache is None or (kind == 'costs' and not self.cache_costs):
+            return
+        self.result_cache.put(self._get_cache_key(kind), arrays)
 
-    def _get_assignment(self, C, C_choice):
-        C = np.copy(C)
-        n_images = C.shape[1]
-        n = C.shape[0]
+    def _get_repetitions(self, n, n_images):
         reps = self.repetitions
         if n_images * reps < n:
             print(f'Not enough images ({n_images * reps} / {n}).')
             reps = math.ceil(n / n_images)
             print(f'Increasing repetitions to {reps}.')
-        if reps > 1:
-            C = np.tile(C, (1, reps))
+        return reps
 
-        row_ind, col_ind = optimize.linear_sum_assignment(C)
-        col_ind %= n_images
+    def _get_assignment(self, C, C_choice):
+        n_images = C.shape[1]
+        n = C.shape[0]
+        reps = self._get_repetitions(n, n_images)
+        row_ind, col_ind = self.solver.solve(C, reps, self.initial_assignment)
         if C_choice is None:
             return col_ind, None
         
@@ -246,22 +466,418 @@ class MosaicBuilder:
         col_ind = col_ind * self.crop_count + choices
         return col_ind, choices
     
+    def _preview(self, tiles, C, C_choice):
+        start = time.perf_counter()
+        col_ind, choices = self._get_preview_assignment(C, C_choice)
+        self.initial_assignment = col_ind if choices is None else col_ind // self.crop_count
+        mosaic = self._get_mosaic(tiles, col_ind)
+        self.preview_callback(Mosaic(self.photo, mosaic, self.shape, self.crop_count,
+                                     self._get_input_tiles_assignment(col_ind, choices)))
+        self.preview_seconds = time.perf_counter() - start
+
+    def _get_preview_assignment(self, C, C_choice):
+        '''
+        Like _get_assignment, but greedy.
+        '''
+        n, n_images = C.shape
+        reps = max(self.repetitions, math.ceil(n / n_images))
+        row_ind, col_ind = greedy_assignment(C, reps, self.cost_memory_budget)
+        if C_choice is None:
+            return col_ind, None
+        choices = C_choice[row_ind, col_ind]
+        return col_ind * self.crop_count + choices, choices
+
     def _get_input_tiles_assignment(self, col_ind, choices):
         if choices is None:
             return col_ind
         return np.column_stack((col_ind // self.crop_count, choices))
 
-    def _get_mosaic(self, tiles, col_ind):
-        canvas = Image.new('RGB', (self.tile_res * self.shape[1], self.tile_res * self.shape[0]))
+    def _get_mosaic(self, tiles: np.ndarray, col_ind):
+        rows, cols = self.shape
+        r = self.tile_res
+        # only tiles fitted by a parallel build are in shared memory, copying others costs more than the assembly
+        if self._pool is not None and self._shared.get_ref(tiles) is not None:
+            try:
+                canvas = self._shared.create((rows * r, cols * r, 3), np.uint8)
+                bounds = np.linspace(0, rows, min(rows, 2 * self.workers) + 1).astype(int)
+                self._map(assemble_rows, repeat(self._shared.get_ref(tiles)), repeat(self._shared.get_ref(canvas)),
+                          [col_ind[r0 * cols:r1 * cols] for r0, r1 in zip(bounds[:-1], bounds[1:])], bounds[:-1])
+                return Image.fromarray(canvas)  # Pillow copies RGB data, so the image outlives the shared memory
+            except MemoryError as e:
+                print(f'{e}, assembling the mosaic serially')
+        # (rows, cols, r, r, 3) -> (rows, r, cols, r, 3) lays the tiles out row by row on the canvas
+        canvas = tiles[col_ind[:rows * cols]].reshape(rows, cols, r, r, 3).swapaxes(1, 2)
+        return Image.fromarray(np.ascontiguousarray(canvas).reshape(rows * r, cols * r, 3))
 
-        for i in range(self.shape[1]):
-            for j in range(self.shape[0]):
-                img = tiles[col_ind[j * self.shape[1] + i]]
-                x, y = i * self.tile_res, j * self.tile_res
-                canvas.paste(img, (x, y))
-        return canvas
+    def _map(self, fn, *iterables) -> list:
+        '''
+        Apply fn on the process pool of a parallel build, or serially.
+        '''
+        if self._pool is None:
+            return list(map(fn, *iterables))
+        return list(self._pool.map(fn, *iterables))
     
 
+class SparseMosaicBuilder(MosaicBuilder):
+    '''
+    Only considers the k most similar tiles of every cell as candidates, found with a KD-tree over the tile features.
+    The resulting sparse assignment problem is much cheaper to solve than the dense one for large numbers of
+    cells and tiles. If no assignment exists using only the candidates, k is doubled until one is found.
+    '''
+    cache_costs = False  # _get_assignment depends on the state prepared by _get_best_C
+
+    def __init__(self, photo=None, tile_images=(), params=None):
+        super().__init__(photo, tile_images, params)
+        self.candidate_count = 16
+        self.gap_check_limit = 0
+        self.quality_gap = None
+        self._photo_vals = None
+        self._tile_vals = None
+        self._tree = None
+        if params:
+            self.set_candidate_count(params.get('candidate_count', self.candidate_count))
+            self.set_gap_check_limit(params.get('gap_check_limit', self.gap_check_limit))
+
+    def set_candidate_count(self, k: int):
+        if k < 1:
+            raise ValueError('Invalid candidate count.')
+        self.candidate_count = k
+        return self
+
+    def set_gap_check_limit(self, limit: int):
+        '''
+        Additionally solve the dense problem to report the quality gap, if its (repeated) cost matrix has
+        at most limit entries. A limit of 0 disables the comparison.
+        '''
+        self.gap_check_limit = limit
+        return self
+
+    def _get_assignment_key(self):
+        return f'sparse-{self.candidate_count}'
+
+    def _get_best_C(self, tile_vals):
+        self._photo_vals = self._get_photo_vals()
+        self._tile_vals = tile_vals
+        self._tree = spatial.cKDTree(tile_vals.reshape(len(tile_vals), -1))
+        return self._get_candidates(self.candidate_count)
+
+    def _get_candidates(self, k):
+        '''
+        Return the sparse (n, n_images) matrix of distances to the k nearest images of every cell and
+        a matrix with the same structure containing the index of the best crop (or None if crop_count is 1).
+        '''
+        n_images = len(self._tile_vals) // self.crop_count
+        n = len(self._photo_vals)
+        k_variants = min(k * self.crop_count, len(self._tile_vals))
+        dists, idx = self._tree.query(self._photo_vals, k=k_variants, workers=-1)
+        dists, idx = dists.reshape(n, -1), idx.reshape(n, -1)
+        images, crops = idx // self.crop_count, idx % self.crop_count
+
+        # neighbours are sorted by distance, so the first occurrence of an image is its best crop
+        order = np.argsort(images, axis=1, kind='stable')
+        images, crops, dists = (np.take_along_axis(a, order, axis=1) for a in (images, crops, dists))
+        first = np.ones_like(images, dtype=bool)
+        first[:, 1:] = images[:, 1:] != images[:, :-1]
+
+        rows = np.repeat(np.arange(n), first.sum(axis=1))
+        C = sparse.csr_matrix((dists[first], (rows, images[first])), shape=(n, n_images))
+        if self.crop_count <= 1:
+            return C, None
+        C_choice = sparse.csr_matrix((crops[first], (rows, images[first])), shape=(n, n_images))
+        return C, C_choice
+
+    def _get_assignment(self, C, C_choice):
+        n, n_images = C.shape
+        reps = self._get_repetitions(n, n_images)
+        k = self.candidate_count
+        while True:
+            # shift all weights, as the matching ignores edges with weight 0. This does not change the optimum
+            weights = C.copy()
+            weights.data += 1.0
+            try:
+                row_ind, col_ind = csgraph.min_weight_full_bipartite_matching(sparse.hstack([weights] * reps).tocsr())
+                break
+            except ValueError:
+                if k >= n_images:
+                    raise
+                k = min(2 * k, n_images)
+                print(f'No full matching found. Increasing the number of candidates to {k}.')
+                C, C_choice = self._get_candidates(k)
+
+        col_ind = col_ind[np.argsort(row_ind)] % n_images
+        self._report_quality_gap(C, col_ind, reps)
+
+        if C_choice is None:
+            return col_ind, None
+        choices = np.asarray(C_choice[np.arange(n), col_ind]).ravel().astype(C_choice.dtype)
+        return col_ind * self.crop_count + choices, choices
+
+    def _get_preview_assignment(self, C, C_choice):
+        '''
+        Assign the cells greedily to their candidates. Cells whose candidates are all used up are assigned greedily
+        to the remaining tiles afterwards.
+        '''
+        n, n_images = C.shape
+        reps = max(self.repetitions, math.ceil(n / n_images))
+        _, tile4cell = greedy_assignment(C, reps)
+        choice4cell = np.zeros(n, dtype=np.int64)
+        if C_choice is not None:
+            choice4cell[:] = np.asarray(C_choice[np.arange(n), tile4cell]).ravel()
+
+        left = np.flatnonzero(tile4cell < 0)
+        if left.size:
+            capacity = reps - np.bincount(tile4cell[tile4cell >= 0], minlength=n_images)
+            tiles = np.flatnonzero(capacity)
+            vals = self._tile_vals.reshape(n_images, self.crop_count, -1)[tiles].reshape(-1, *self._tile_vals.shape[1:])
+            left_C, left_choice = best_cost_matrix(self._photo_vals[left], vals, self.crop_count, self.cost_dtype,
+                                                   self.cost_memory_budget)
+            row_ind, col_ind = greedy_assignment(left_C, capacity[tiles], self.cost_memory_budget)
+            tile4cell[left[row_ind]] = tiles[col_ind]
+            if left_choice is not None:
+                choice4cell[left[row_ind]] = left_choice[row_ind, col_ind]
+
+        if C_choice is None:
+            return tile4cell, None
+        return tile4cell * self.crop_count + choice4cell, choice4cell
+
+    def _report_quality_gap(self, C, col_ind, reps):
+        n, n_images = C.shape
+        if n * n_images * reps > self.gap_check_limit:
+            return
+        dense_C, dense_choice = super()._get_best_C(self._tile_vals)
+        dense_col_ind, _ = super()._get_assignment(dense_C, dense_choice)
+        if dense_choice is not None:
+            dense_col_ind = dense_col_ind // self.crop_count
+        rows = np.arange(n)
+        sparse_cost = dense_C[rows, col_ind].sum()
+        dense_cost = dense_C[rows, dense_col_ind].sum()
+        self.quality_gap = sparse_cost / dense_cost - 1 if dense_cost > 0 else 0.0
+        print(f'Sparse assignment cost: {sparse_cost:.1f}, dense LAP cost: {dense_cost:.1f} (gap: {self.quality_gap:.4%})')
+
+
+class BlockMosaicBuilder(MosaicBuilder):
+    '''
+    Splits the grid into spatial blocks whose assignment problems are solved independently on a process pool.
+
+    Every block receives a share of the tile copies that is proportional to its number of cells. Copies are
+    allocated greedily, preferring the blocks that contain the best matching cell of a tile. Afterwards, blocks that
+    are shifted by half a block are solved again with the tiles of their cells. Finally, a global repair pass assigns
+    the cells along the block borders and the cells that are furthest from their best possible tile again, together
+    with the tiles they use and all unused copies. Both steps can only improve the result and the repetitions limit
+    holds across all blocks.
+    '''
+    cache_costs = False  # _get_assignment depends on the state prepared by _get_best_C
+
+    def __init__(self, photo=None, tile_images=(), params=None):
+        super().__init__(photo, tile_images, params)
+        self.block_size = 2048
+        self.workers = os.cpu_count() or 1
+        self.repair_size = None  # defaults to the block size
+        self.repair_rounds = 2
+        self._photo_vals = None
+        self._tile_vals = None
+        self._blocks = None
+        self._best_cell_costs = None
+        if params:
+            self.set_block_size(params.get('block_size', self.block_size))
+            self.set_workers(params.get('workers', self.workers))
+            self.set_repair(params.get('repair_size', self.repair_size), params.get('repair_rounds', self.repair_rounds))
+
+    def set_block_size(self, cells: int):
+        if cells < 1:
+            raise ValueError('Invalid block size.')
+        self.block_size = cells
+        return self
+
+    def set_repair(self, cells: int = None, rounds: int = 2):
+        '''
+        Set the number of cells with the highest regret that are assigned again in each round of the repair pass.
+        '''
+        self.repair_size = cells
+        self.repair_rounds = rounds
+        return self
+
+    def _get_assignment_key(self):
+        return f'block-{self.block_size}-{self.repair_size}-{self.repair_rounds}'
+
+    def _get_best_C(self, tile_vals):
+        '''
+        Instead of the full cost matrix, return the cost of the best matching cell of every block for every tile.
+        '''
+        self._photo_vals = self._get_photo_vals()
+        self._tile_vals = tile_vals
+        self._blocks = self._get_blocks()
+        results = self._map(block_tile_costs, [self._photo_vals[b] for b in self._blocks],
+                            *self._repeat(tile_vals, self.crop_count, self.cost_dtype, self.cost_memory_budget))
+        self._best_cell_costs = np.empty(len(self._photo_vals))
+        for cells, (_, cell_costs) in zip(self._blocks, results):
+            self._best_cell_costs[cells] = cell_costs
+        return np.stack([tile_costs for tile_costs, _ in results]), None
+
+    def _get_assignment(self, block_costs, _):
+        n = len(self._photo_vals)
+        n_images = block_costs.shape[1]
+        reps = self._get_repetitions(n, n_images)
+        allocation = allocate_tiles(block_costs, np.array([len(b) for b in self._blocks]), reps)
+        print(f'Solving {len(self._blocks)} blocks of about {n // len(self._blocks)} cells on {self.workers} processes')
+
+        block_tiles = [np.flatnonzero(copies) for copies in allocation]
+        # the largest problem that is solved, instead of the block costs of _get_best_C
+        self.cost_shape = (max(len(cells) for cells in self._blocks), max(len(tiles) for tiles in block_tiles))
+        results = self._map(solve_block, [self._photo_vals[b] for b in self._blocks],
+                            [self._get_tile_subset(tiles) for tiles in block_tiles],
+                            [copies[tiles] for copies, tiles in zip(allocation, block_tiles)],
+                            *self._repeat(self.crop_count, self.cost_dtype, self.cost_memory_budget))
+
+        tile4cell = np.empty(n, dtype=np.int64)
+        choice4cell = np.zeros(n, dtype=np.int64)
+        self._apply_block_results(self._blocks, block_tiles, results, tile4cell, choice4cell)
+        if len(self._blocks) > 1:  # a single block is already optimal
+            self._refine_shifted_blocks(tile4cell, choice4cell)
+            border = self._get_border_cells()
+            for i in range(self.repair_rounds):
+                self._repair(tile4cell, choice4cell, reps, border if i == 0 else None)
+
+        if self.crop_count <= 1:
+            return tile4cell, None
+        return tile4cell * self.crop_count + choice4cell, choice4cell
+
+    def _get_preview_assignment(self, block_costs, _):
+        '''
+        Assign the cells of every block greedily to the tile copies allocated to the block.
+        '''
+        n = len(self._photo_vals)
+        reps = max(self.repetitions, math.ceil(n / block_costs.shape[1]))
+        allocation = allocate_tiles(block_costs, np.array([len(b) for b in self._blocks]), reps)
+        tile4cell = np.empty(n, dtype=np.int64)
+        choice4cell = np.zeros(n, dtype=np.int64)
+        for cells, copies in zip(self._blocks, allocation):
+            tiles = np.flatnonzero(copies)
+            C, C_choice = best_cost_matrix(self._photo_vals[cells], self._get_tile_subset(tiles), self.crop_count,
+                                           self.cost_dtype, self.cost_memory_budget)
+            row_ind, col_ind = greedy_assignment(C, copies[tiles], self.cost_memory_budget)
+            tile4cell[cells[row_ind]] = tiles[col_ind]
+            if C_choice is not None:
+                choice4cell[cells[row_ind]] = C_choice[row_ind, col_ind]
+        if self.crop_count <= 1:
+            return tile4cell, None
+        return tile4cell * self.crop_count + choice4cell, choice4cell
+
+    def _refine_shifted_blocks(self, tile4cell, choice4cell):
+        '''
+        Solve blocks that are shifted by half a block again, each using only the tiles currently assigned to its cells.
+        Cells near the original block borders can thereby exchange tiles across them.
+        '''
+        blocks = self._get_blocks(shifted=True)
+        block_tiles, capacities = [], []
+        for cells in blocks:
+            tiles, counts = np.unique(tile4cell[cells], return_counts=True)
+            block_tiles.append(tiles)
+            capacities.append(counts)
+        results = self._map(solve_block, [self._photo_vals[b] for b in blocks],
+                            [self._get_tile_subset(tiles) for tiles in block_tiles], capacities,
+                            *self._repeat(self.crop_count, self.cost_dtype, self.cost_memory_budget))
+        self._apply_block_results(blocks, block_tiles, results, tile4cell, choice4cell)
+
+    @staticmethod
+    def _apply_block_results(blocks, block_tiles, results, tile4cell, choice4cell):
+        for cells, tiles, (col_ind, choices) in zip(blocks, block_tiles, results):
+            tile4cell[cells] = tiles[col_ind]
+            if choices is not None:
+                choice4cell[cells] = choices
+
+    def _repair(self, tile4cell, choice4cell, reps, include: np.ndarray = None):
+        '''
+        Optimally assign the cells with the highest regret (and the included cells) again, using their current tiles
+        and all unused copies.
+        '''
+        n_images = len(self._tile_vals) // self.crop_count
+        flat_vals = self._tile_vals.reshape(len(self._tile_vals), -1)
+        current = np.linalg.norm(self._photo_vals - flat_vals[tile4cell * self.crop_count + choice4cell], axis=-1)
+        regret = current - self._best_cell_costs
+        repair_size = self.repair_size or self.block_size
+        cells = np.argsort(regret)[-repair_size:]
+        if include is not None:
+            cells = np.union1d(cells, include)
+
+        capacity = reps - np.bincount(tile4cell, minlength=n_images) + np.bincount(tile4cell[cells], minlength=n_images)
+        tiles = np.flatnonzero(capacity)
+        C, C_choice = best_cost_matrix(self._photo_vals[cells], self._get_tile_subset(tiles), self.crop_count,
+                                       self.cost_dtype, self.cost_memory_budget)
+        row_ind, col_ind = capacitated_linear_sum_assignment(C, capacity[tiles])
+        print(f'Repaired {cells.size} cells: cost {current[cells].sum():.1f} -> {C[row_ind, col_ind].sum():.1f}')
+        tile4cell[cells] = tiles[col_ind]
+        if C_choice is not None:
+            choice4cell[cells] = C_choice[row_ind, col_ind]
+
+    def _get_blocks(self, shifted=False) -> list[np.ndarray]:
+        '''
+        Return the cell indices of every block. The grid is split into roughly square blocks of about block_size cells.
+        Shifted blocks are offset by half a block in both directions.
+        '''
+        rows, cols = self.shape
+        count = math.ceil(rows * cols / self.block_size)
+        block_rows = min(rows, max(1, round(math.sqrt(count * rows / cols))))
+        block_cols = min(cols, math.ceil(count / block_rows))
+        row_bounds = np.linspace(0, rows, block_rows + 1).astype(int)
+        col_bounds = np.linspace(0, cols, block_cols + 1).astype(int)
+        if shifted:
+            row_bounds = np.unique(np.concatenate(([0], (row_bounds[:-1] + row_bounds[1:]) // 2, [rows])))
+            col_bounds = np.unique(np.concatenate(([0], (col_bounds[:-1] + col_bounds[1:]) // 2, [cols])))
+        cells = np.arange(rows * cols).reshape(rows, cols)
+        return [cells[r0:r1, c0:c1].ravel() for r0, r1 in zip(row_bounds[:-1], row_bounds[1:])
+                for c0, c1 in zip(col_bounds[:-1], col_bounds[1:])]
+
+    def _get_border_cells(self) -> np.ndarray:
+        block_ids = np.empty(self.shape[0] * self.shape[1], dtype=np.int64)
+        for i, cells in enumerate(self._blocks):
+            block_ids[cells] = i
+        grid = block_ids.reshape(self.shape)
+        border = np.zeros(self.shape, dtype=bool)
+        vertical = grid[1:] != grid[:-1]
+        border[1:] |= vertical
+        border[:-1] |= vertical
+        horizontal = grid[:, 1:] != grid[:, :-1]
+        border[:, 1:] |= horizontal
+        border[:, :-1] |= horizontal
+        return np.flatnonzero(border)
+
+    def _get_tile_subset(self, tiles: np.ndarray) -> np.ndarray:
+        '''
+        Return the feature vectors of all crops of the given tiles.
+        '''
+        vals = self._tile_vals.reshape(-1, self.crop_count, *self._tile_vals.shape[1:])
+        return vals[tiles].reshape(-1, *self._tile_vals.shape[1:])
+
+    def _repeat(self, *args):
+        return [[arg] * len(self._blocks) for arg in args]
+
+
+class TileSet:
+    '''
+    Read-only concatenation of several arrays of fitted tiles (e.g. memory-mapped collection atlases) without copying them.
+    Supports len() and indexing with integer arrays, which is all MosaicBuilder needs of prepared tiles.
+    '''
+    def __init__(self, parts: list[np.ndarray]):
+        self.parts = parts
+        self.offsets = np.cumsum([0] + [len(part) for part in parts])
+        self.shape = (int(self.offsets[-1]), *parts[0].shape[1:])
+        self.dtype = parts[0].dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, idx) -> np.ndarray:
+        idx = np.asarray(idx)
+        out = np.empty((*idx.shape, *self.shape[1:]), dtype=self.dtype)
+        part_of = np.searchsorted(self.offsets, idx, side='right') - 1
+        for k, part in enumerate(self.parts):
+            mask = part_of == k
+            if mask.any():
+                out[mask] = part[idx[mask] - self.offsets[k]]
+        return out
+
+
 class MosaicTimer:
     def __init__(self):
         self.timings = [0, 0, 0, 0, 0]
@@ -296,14 +912,312 @@ class MosaicTimer:
         '''
         return self.get_delta(2, 3)
 
+def get_nbytes(arr) -> int:
+    '''
+    Return the number of bytes of a dense or sparse array (0 for None).
+    '''
+    if arr is None:
+        return 0
+    if sparse.issparse(arr):
+        return arr.data.nbytes + arr.indices.nbytes + arr.indptr.nbytes
+    return arr.nbytes
+
+
 def shape_from_count(img: Image, n: int):
-    w, h = img.size
+    return shape_from_size(get_original_size(img), n)
+
+
+def shape_from_size(size: tuple[int, int], n: int):
+    w, h = size
     no_px = h * w
     px_per_tile = no_px / n
     tile_side = math.sqrt(px_per_tile)
     return int(h // tile_side), int(w // tile_side)
 
 
+def get_original_size(img: Image) -> tuple[int, int]:
+    '''
+    Return the size of an image before it was reduced on load, which is kept in img.info['original_size']
+    (see load_target in worker.py). The grid of a mosaic is derived from it, so it does not depend on the reduction.
+    '''
+    return img.info.get('original_size', img.size)
+
+
+def crop_positions(crop_count: int) -> np.ndarray:
+    if crop_count > 1:
+        return np.linspace(0.0, 1.0, crop_count)
+    return np.array([0.5])
+
+
+def open_tile_image(image) -> Image:
+    '''
+    Open a tile image given as path. Paths let the worker processes of a parallel build open the images themselves.
+    '''
+    if isinstance(image, (str, os.PathLike)):
+        image = Image.open(image)
+        return image if image.mode == 'RGB' else image.convert('RGB')
+    return image
+
+
+def fit_tile(img: Image, tile_res: int, crop_count: int) -> np.ndarray:
+    '''
+    Return the square crops of a single tile image as an array of shape (crop_count, tile_res, tile_res, 3).
+    '''
+    size = (tile_res, tile_res)
+    return np.stack([np.asarray(ImageOps.fit(img, size, Image.LANCZOS, centering=(pos, pos)))
+                     for pos in crop_positions(crop_count)])
+
+
+def stream_tiles(images: Iterable[Image], tile_res: int, crop_count: int, granularity: int, color_space: str,
+                 lut_bits: int = 0, batch_size: int = 256) -> Iterator[tuple[np.ndarray, np.ndarray]]:
+    '''
+    Fit one tile image after the other and yield batches of crops together with their feature vectors.
+    The feature vectors of a batch are computed at once. No reference to an image is kept after it has been fitted.
+    '''
+    batch = []
+    for img in images:
+        batch.append(fit_tile(open_tile_image(img), tile_res, crop_count))
+        del img
+        if len(batch) == batch_size:
+            tiles = np.concatenate(batch)
+            batch = []
+            yield tiles, compute_tile_vals(tiles, granularity, color_space, lut_bits)
+    if batch:
+        tiles = np.concatenate(batch)
+        yield tiles, compute_tile_vals(tiles, granularity, color_space, lut_bits)
+
+
+def fit_tile_batch(images: list, tile_res: int, crop_count: int, granularity: int, color_space: str,
+                   lut_bits: int = 0) -> tuple[np.ndarray, np.ndarray]:
+    '''
+    Fit a batch of tile images (or paths) and return the crops together with their feature vectors.
+    '''
+    tiles = np.concatenate([fit_tile(open_tile_image(img), tile_res, crop_count) for img in images])
+    return tiles, compute_tile_vals(tiles, granularity, color_space, lut_bits)
+
+
+def tile_vals_rows(tiles_ref: SharedArrayRef, vals_ref: SharedArrayRef, start: int, stop: int, granularity: int,
+                   color_space: str, lut_bits: int):
+    '''
+    Compute the feature vectors of the shared tiles [start, stop) into the shared output array (parallel builds).
+    '''
+    attach(vals_ref)[start:stop] = compute_tile_vals(attach(tiles_ref)[start:stop], granularity, color_space, lut_bits)
+
+
+def assemble_rows(tiles_ref: SharedArrayRef, canvas_ref: SharedArrayRef, col_ind: np.ndarray, row: int):
+    '''
+    Lay out the tiles of consecutive grid rows starting at row on the shared canvas (parallel builds).
+    '''
+    tiles, canvas = attach(tiles_ref), attach(canvas_ref)
+    r = tiles.shape[1]
+    cols = canvas.shape[1] // r
+    rows = len(col_ind) // cols
+    canvas[row * r:(row + rows) * r] = tiles[col_ind].reshape(rows, cols, r, r, 3).swapaxes(1, 2).reshape(rows * r, cols * r, 3)
+
+
+def compute_tile_vals(tiles: np.ndarray, granularity: int, color_space: str, lut_bits: int = 0) -> np.ndarray:
+    '''
+    Return the feature vectors of fitted tiles as an array of shape (len(tiles), granularity, granularity, 3).
+    All tiles are area-averaged and converted to the color space at once.
+    '''
+    return get_color_space_converter(color_space, lut_bits)(area_average(tiles, granularity))
+
+
+def area_average(tiles: np.ndarray, size: int, chunk_size: int = 4096) -> np.ndarray:
+    '''
+    Downscale square tiles of shape (n, res, res, 3) to (n, size, size, 3), where every output pixel is the mean
+    of the area it covers.
+    '''
+    res = tiles.shape[1]
+    # output pixel a covers [a * res / size, (a + 1) * res / size), input pixels are weighted by their overlap
+    edges = np.arange(size + 1) * res / size
+    pixels = np.arange(res)
+    overlap = np.minimum(edges[1:, None], pixels + 1) - np.maximum(edges[:-1, None], pixels)
+    weights = np.clip(overlap, 0, None) * size / res
+    f = res // size
+    # chunks bound the temporary memory and only read a part of memory-mapped tiles at a time
+    out = np.empty((len(tiles), size, size, 3))
+    for start in range(0, len(tiles), chunk_size):
+        chunk = tiles[start:start + chunk_size]
+        if res % size == 0:
+            # sum the rows of every block first, which reduces over contiguous memory
+            rows = chunk.reshape(len(chunk), size, f, res * 3).sum(axis=2, dtype=np.uint32)
+            out[start:start + len(chunk)] = rows.reshape(len(chunk), size, size, f, 3).sum(axis=3) / (f * f)
+        else:
+            out[start:start + len(chunk)] = np.einsum('ay,nyxc,bx->nabc', weights, chunk, weights, optimize=True)
+    return out
+
+
+def iter_cost_chunks(photo_vals: np.ndarray, tile_vals: np.ndarray, dtype=np.float64,
+                     memory_budget: int = DEFAULT_COST_MEMORY_BUDGET) -> Iterator[tuple[int, int, np.ndarray]]:
+    '''
+    Yield the euclidean distances between all photo cells and all tiles as row chunks (start, stop, distances).
+    The distances are computed as sqrt(||a||² + ||b||² - 2ab), so most of the work is done by a single
+    matrix multiplication per chunk. The number of rows per chunk is chosen to stay within memory_budget.
+    '''
+    dtype = np.dtype(dtype)
+    a = photo_vals.reshape(len(photo_vals), -1).astype(dtype, copy=False)
+    b = tile_vals.reshape(len(tile_vals), -1).astype(dtype, copy=False)
+    a_sq = np.einsum('ij,ij->i', a, a)
+    b_sq = np.einsum('ij,ij->i', b, b)
+
+    chunk_rows = cost_chunk_rows(len(b), dtype, memory_budget)
+    for start in range(0, len(a), chunk_rows):
+        stop = min(start + chunk_rows, len(a))
+        d = a[start:stop] @ b.T
+        d *= -2
+        d += a_sq[start:stop, np.newaxis]
+        d += b_sq
+        np.maximum(d, 0, out=d)  # rounding errors can lead to tiny negative values
+        yield start, stop, np.sqrt(d, out=d)
+
+
+def cost_chunk_rows(n_cols: int, dtype, memory_budget: int) -> int:
+    '''
+    Return the number of cost matrix rows computed at once by iter_cost_chunks.
+    '''
+    bytes_per_row = 2 * n_cols * np.dtype(dtype).itemsize  # product and result
+    return max(1, memory_budget // max(1, bytes_per_row))
+
+
+def best_cost_matrix(photo_vals: np.ndarray, tile_vals: np.ndarray, crop_count: int, dtype=np.float64,
+                     memory_budget: int = DEFAULT_COST_MEMORY_BUDGET, out: tuple = None) -> tuple[np.ndarray, np.ndarray]:
+    '''
+    Return the cost matrix of the best crop of every tile and the index of that crop (None if crop_count is 1).
+    All crop variants are compared in a single pass and reduced chunk by chunk. The results are written to
+    out = (C, C_choice) if given.
+    '''
+    n, m = len(photo_vals), len(tile_vals) // crop_count
+    if out is not None:
+        C, C_choice = out
+    else:
+        C = np.empty((n, m), dtype=dtype)
+        C_choice = np.empty((n, m), dtype=np.min_scalar_type(crop_count - 1)) if crop_count > 1 else None
+    for start, stop, chunk in iter_cost_chunks(photo_vals, tile_vals, dtype, memory_budget):
+        if crop_count <= 1:
+            C[start:stop] = chunk
+            continue
+        chunk = chunk.reshape(stop - start, m, crop_count)
+        choice = np.argmin(chunk, axis=-1)
+        C_choice[start:stop] = choice
+        C[start:stop] = np.take_along_axis(chunk, choice[..., np.newaxis], axis=-1)[..., 0]
+    return C, C_choice
+
+
+def cost_rows(photo_ref: SharedArrayRef, tile_vals_ref: SharedArrayRef, C_ref: SharedArrayRef, C_choice_ref: SharedArrayRef,
+              start: int, stop: int, crop_count: int, dtype: str, memory_budget: int):
+    '''
+    Compute the rows [start, stop) of the shared cost matrix and crop choices (parallel builds).
+    '''
+    out = (attach(C_ref)[start:stop], None if C_choice_ref is None else attach(C_choice_ref)[start:stop])
+    best_cost_matrix(attach(photo_ref)[start:stop], attach(tile_vals_ref), crop_count, dtype, memory_budget, out)
+
+
+def block_tile_costs(photo_vals: np.ndarray, tile_vals: np.ndarray, crop_count: int, dtype,
+                     memory_budget: int) -> tuple[np.ndarray, np.ndarray]:
+    '''
+    Return the cost of the best matching cell of a block for every tile and the cost of the best tile for every cell.
+    '''
+    C = best_cost_matrix(photo_vals, tile_vals, crop_count, dtype, memory_budget)[0]
+    return C.min(axis=0), C.min(axis=1)
+
+
+def solve_block(photo_vals: np.ndarray, tile_vals: np.ndarray, capacity: np.ndarray, crop_count: int, dtype,
+                memory_budget: int) -> tuple[np.ndarray, np.ndarray]:
+    '''
+    Optimally assign the cells of a block to its tiles, where tile j may be used capacity[j] times.
+    Returns the tile index and the crop index (None if crop_count is 1) for every cell.
+    '''
+    C, C_choice = best_cost_matrix(photo_vals, tile_vals, crop_count, dtype, memory_budget)
+    columns = np.repeat(np.arange(C.shape[1]), capacity)
+    row_ind, col_ind = optimize.linear_sum_assignment(C[:, columns])
+    col_ind = columns[col_ind]
+    return col_ind, None if C_choice is None else C_choice[row_ind, col_ind]
+
+
+def iter_batches(items: Iterable, size: int) -> Iterator[list]:
+    it = iter(items)
+    while batch := list(islice(it, size)):
+        yield batch
+
+
+def bounded_map(executor: Executor, fn, iterable: Iterable, max_pending: int) -> Iterator:
+    '''
+    Like executor.map, but only consumes the iterable while fewer than max_pending tasks are unfinished,
+    so lazily opened images are not all loaded at once.
+    '''
+    pending = deque()
+    for item in iterable:
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+        pending.append(executor.submit(fn, item))
+    while pending:
+        yield pending.popleft().result()
+
+
+def allocate_tiles(block_costs: np.ndarray, block_cells: np.ndarray, capacity: int) -> np.ndarray:
+    '''
+    Distribute the capacity copies of every tile among the blocks, proportionally to their number of cells.
+    Copies are handed out in the order of increasing block costs. Each pass gives at most one more copy of a tile
+    to a block, so blocks first receive many different tiles.
+    Returns the number of copies of every tile per block (blocks x tiles).
+    '''
+    n_blocks, n_images = block_costs.shape
+    demand = np.floor(block_cells * (n_images * capacity) / block_cells.sum()).astype(np.int64)
+    remaining = np.full(n_images, capacity, dtype=np.int64)
+    allocation = np.zeros((n_blocks, n_images), dtype=np.int64)
+    order = np.argsort(block_costs, axis=None, kind='stable')
+    for _ in range(capacity):
+        for b, j in zip(*np.unravel_index(order, block_costs.shape)):
+            if demand[b] > 0 and remaining[j] > 0:
+                allocation[b, j] += 1
+                demand[b] -= 1
+                remaining[j] -= 1
+        if not demand.any():
+            break
+    return allocation
+
+
+def get_color_space_converter(color_space: str, lut_bits: int = 0) -> Callable[[np.ndarray], np.ndarray]:
+    '''
+    Return a function converting RGB arrays of shape (..., 3) with values in [0, 255] to the color space.
+    If lut_bits is set, values are quantized to lut_bits per channel and looked up in a precomputed table instead.
+    '''
+    match color_space.upper():
+        case 'CIELAB':
+            convert = lambda arr: color.rgb2lab(arr / 255.0)
+        case 'CIELAB_WEIGHTED': # emphasize lightness
+            convert = lambda arr: weighted_lab_converter(arr, 5)
+        case _: # basic RGB
+            return lambda arr: arr
+    if not lut_bits:
+        return convert
+
+    lut = get_color_lut(color_space.upper(), lut_bits)
+    shift = 8 - lut_bits
+
+    def lookup(arr):
+        if arr.dtype != np.uint8:
+            arr = np.clip(np.rint(arr), 0, 255).astype(np.uint8)
+        q = arr >> shift
+        return lut[q[..., 0], q[..., 1], q[..., 2]]
+    return lookup
+
+
+@functools.lru_cache(maxsize=4)
+def get_color_lut(color_space: str, bits: int) -> np.ndarray:
+    '''
+    Return the converted color of every RGB bin of a grid with 2^bits levels per channel (taken at the bin centers)
+    as float32 array of shape (2^bits, 2^bits, 2^bits, 3). 8 bits are exact for uint8 input but take 192 MiB.
+    '''
+    if not 1 <= bits <= 8:
+        raise ValueError('Invalid number of bits for the color lookup table.')
+    step = 256 / 2 ** bits
+    centers = (np.arange(2 ** bits) + 0.5) * step - 0.5
+    grid = np.stack(np.meshgrid(centers, centers, centers, indexing='ij'), axis=-1)
+    return get_color_space_converter(color_space)(grid).astype(np.float32)
+
+
 def blend_images(img1, img2, opacity):
     resized2 = img2.resize(img1.size, Image.Resampling.LANCZOS)
     return Image.blend(img1, resized2, opacity)
@@ -311,5 +1225,5 @@ def blend_images(img1, img2, opacity):
 
 def weighted_lab_converter(rgb_arr: np.ndarray, l_weight) -> np.ndarray:
         lab_arr = color.rgb2lab(rgb_arr / 255.0)
-        lab_arr[:, :, 0] *= l_weight
+        lab_arr[..., 0] *= l_weight
         return lab_arr
\ No newline at end of file
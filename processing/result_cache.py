@@ -0,0 +1,86 @@
+"""
+result_cache.py
+
+Persistent cache of intermediate build results (cost matrices and assignments) of MosaicBuilder.
+
+Every entry is a directory containing one .npy file per array, which is memory-mapped when read. Entries are
+written to a temporary directory first and renamed, so concurrent workers never see partial entries.
+The keys are built by MosaicBuilder from the inputs that determine the cached arrays (see set_result_cache).
+"""
+
+import os
+import shutil
+import uuid
+import numpy as np
+
+ARRAY_SUFFIX = ".npy"
+
+
+class ResultCache:
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+
+    def get(self, key: str) -> dict[str, np.ndarray]:
+        """
+        Return the read-only arrays stored under key, or None if there is no such entry.
+        """
+        entry_dir = self._entry_dir(key)
+        try:
+            arrays = {e[:-len(ARRAY_SUFFIX)]: np.load(os.path.join(entry_dir, e), mmap_mode='r')
+                      for e in os.listdir(entry_dir) if e.endswith(ARRAY_SUFFIX)}
+            os.utime(entry_dir)  # mark as recently used for eviction
+        except (OSError, ValueError):
+            return None  # missing or evicted in the meantime by another worker
+        return arrays
+
+    def put(self, key: str, arrays: dict[str, np.ndarray]):
+        """
+        Store the given arrays under key. Arrays that are None are skipped, entries larger than max_bytes as well.
+        """
+        arrays = {name: arr for name, arr in arrays.items() if arr is not None}
+        if sum(arr.nbytes for arr in arrays.values()) > self.max_bytes:
+            return
+        entry_dir = self._entry_dir(key)
+        if os.path.isdir(entry_dir):
+            return
+
+        tmp_dir = f"{entry_dir}.{uuid.uuid4().hex}.tmp"
+        os.makedirs(tmp_dir)
+        try:
+            for name, arr in arrays.items():
+                np.save(os.path.join(tmp_dir, name + ARRAY_SUFFIX), np.ascontiguousarray(arr))
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            shutil.rmtree(tmp_dir, ignore_errors=True)  # another worker stored the same entry first
+        self.evict()
+
+    def evict(self):
+        """
+        Delete the least recently used entries until the cache is no larger than max_bytes.
+        """
+        entries = []
+        total = 0
+        if not os.path.isdir(self.root):
+            return
+        for sub_dir in os.scandir(self.root):
+            if not sub_dir.is_dir():
+                continue
+            for entry in os.scandir(sub_dir.path):
+                if not entry.is_dir() or entry.name.endswith(".tmp"):
+                    continue
+                try:
+                    size = sum(f.stat().st_size for f in os.scandir(entry.path))
+                    entries.append((entry.stat().st_mtime, size, entry.path))
+                except FileNotFoundError:
+                    continue
+                total += size
+
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+    def _entry_dir(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], key)
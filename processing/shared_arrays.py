@@ -0,0 +1,101 @@
+"""
+shared_arrays.py
+
+Numpy arrays in shared memory for the parallel mode of MosaicBuilder (see MosaicBuilder.set_workers).
+
+Worker processes receive a small SharedArrayRef instead of a pickled copy of an array and attach to the same memory,
+so large inputs are never copied between processes and results are written directly into the output arrays.
+All blocks of a build belong to one SharedArrays instance in the parent process, which releases them when closed.
+"""
+
+import os
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+from typing import NamedTuple
+
+SHM_PATH = "/dev/shm"
+SHM_RESERVE = 16 * 1024 ** 2  # free space left in SHM_PATH for other users
+
+_attached: dict[str, shared_memory.SharedMemory] = {}  # blocks a worker process has attached to
+
+
+class SharedArrayRef(NamedTuple):
+    name: str
+    shape: tuple
+    dtype: str
+
+
+class SharedArrays:
+    def __init__(self):
+        self._blocks: list[shared_memory.SharedMemory] = []
+        self._refs: dict[int, SharedArrayRef] = {}  # address of the data -> reference
+        resource_tracker.ensure_running()  # shared by all processes started later, which keeps blocks alive until closed
+
+    def create(self, shape: tuple, dtype) -> np.ndarray:
+        """
+        Return a new, uninitialized array in shared memory.
+        Raises MemoryError if the shared memory file system cannot hold it, as writing to it would crash the process.
+        """
+        dtype = np.dtype(dtype)
+        nbytes = max(1, int(np.prod(shape)) * dtype.itemsize)
+        if nbytes > available_bytes() - SHM_RESERVE:
+            raise MemoryError(f"Not enough shared memory for {nbytes / 1024 ** 2:.0f} MiB")
+        shm = shared_memory.SharedMemory(create=True, size=nbytes)
+        self._blocks.append(shm)
+        arr = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        self._refs[arr.ctypes.data] = SharedArrayRef(shm.name, tuple(shape), dtype.str)
+        return arr
+
+    def share(self, arr: np.ndarray) -> SharedArrayRef:
+        """
+        Return a reference to arr for worker processes. Arrays that are not in shared memory yet are copied once.
+        """
+        ref = self.get_ref(arr)
+        if ref is None:
+            shared = self.create(arr.shape, arr.dtype)
+            shared[...] = arr
+            ref = self.get_ref(shared)
+        return ref
+
+    def get_ref(self, arr: np.ndarray) -> SharedArrayRef:
+        """
+        Return the reference to an array created by this instance, or None for any other array.
+        """
+        if not isinstance(arr, np.ndarray) or not arr.flags.c_contiguous:
+            return None
+        ref = self._refs.get(arr.ctypes.data)
+        return ref if ref is not None and ref.shape == arr.shape and ref.dtype == arr.dtype.str else None
+
+    def close(self):
+        for shm in self._blocks:
+            try:
+                shm.close()
+            except BufferError:
+                pass  # still referenced by an array, the memory is released once that is garbage collected
+            shm.unlink()
+        self._blocks = []
+        self._refs = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def attach(ref: SharedArrayRef) -> np.ndarray:
+    """
+    Return the array of a reference in a worker process. Blocks stay attached until the process exits.
+    """
+    shm = _attached.get(ref.name)
+    if shm is None:
+        shm = _attached[ref.name] = shared_memory.SharedMemory(name=ref.name)
+    return np.ndarray(ref.shape, dtype=np.dtype(ref.dtype), buffer=shm.buf)
+
+
+def available_bytes() -> int:
+    try:
+        st = os.statvfs(SHM_PATH)
+    except (OSError, AttributeError):
+        return 2 ** 62  # no size limit known on this platform
+    return st.f_bavail * st.f_frsize
@@ -0,0 +1,189 @@
+"""
+status_reporter.py
+
+Reports the status of a job to the backend from a background thread, so that the compute path never waits for HTTP.
+
+Only one request is in flight at a time. Progress updates that are queued while a request is running are coalesced,
+so only the latest value is sent. Status changes are never dropped and are retried if the backend is unreachable.
+Between updates, the job status is polled so that jobs aborted by the user can be stopped early (see check_aborted).
+"""
+
+import threading
+import time
+import requests
+from datetime import datetime
+from requests.adapters import HTTPAdapter
+from model import JobStatus
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session() -> requests.Session:
+    """
+    Return the session shared by all jobs of this process, which keeps the connections to the backend alive.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            _session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=4))
+            _session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=4))
+        return _session
+
+
+class JobAborted(Exception):
+    pass
+
+
+class StatusReporter:
+    def __init__(self, callback_url: str, job_id: str, token: str, abort_poll_interval: float = 5.0,
+                 timeout: float = 10.0, retries: int = 3):
+        self.url = f"{callback_url}/{job_id}/status"
+        self.job_id = job_id
+        self.headers = {
+            "X-Job-Secret": token,
+            "Content-Type": "application/json"
+        }
+        self.abort_poll_interval = abort_poll_interval
+        self.timeout = timeout
+        self.retries = retries
+        self.aborted = False
+        self._pending: list[tuple[JobStatus, float]] = []
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name=f"status-{job_id}", daemon=True)
+        self._thread.start()
+
+    def update(self, status: JobStatus, progress: float = None):
+        """
+        Queue a status update without blocking. A queued progress update is replaced by a newer one.
+        """
+        with self._cond:
+            if self._pending and self._pending[-1][0] == status == JobStatus.Processing:
+                self._pending[-1] = (status, progress)
+            else:
+                self._pending.append((status, progress))
+            self._cond.notify()
+
+    def check_aborted(self):
+        """
+        Raise JobAborted if the job was aborted in the backend.
+        """
+        if self.aborted:
+            raise JobAborted(f"Job {self.job_id} was aborted")
+
+    def close(self, timeout: float = 60.0):
+        """
+        Wait until all queued updates are delivered and stop the background thread.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            log(f"Status updates of job {self.job_id} were not delivered within {timeout}s")
+
+    def _run(self):
+        next_poll = time.monotonic() + self.abort_poll_interval
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed and time.monotonic() < next_poll:
+                    self._cond.wait(next_poll - time.monotonic())
+                if not self._pending and self._closed:
+                    return
+                update = self._pending.pop(0) if self._pending else None
+
+            if update is not None:
+                self._send(*update)
+            if not self.aborted and not self._closed and time.monotonic() >= next_poll:
+                self._poll()
+                next_poll = time.monotonic() + self.abort_poll_interval
+
+    def _send(self, status: JobStatus, progress: float = None):
+        if self.aborted:
+            return  # the backend rejects all updates of aborted jobs
+        payload = {
+            "status": status.value
+        }
+        if progress is not None:
+            payload["progress"] = progress
+
+        # intermediate progress values are superseded anyway, status changes must arrive
+        attempts = 1 if status == JobStatus.Processing else self.retries
+        for attempt in range(attempts):
+            try:
+                result = get_session().post(self.url, json=payload, headers=self.headers, timeout=self.timeout)
+            except requests.exceptions.RequestException as e:
+                log(f"Failed to notify backend: {e}")
+                if attempt + 1 < attempts:
+                    time.sleep(2 ** attempt)
+                continue
+
+            if not result.ok:
+                log("Request failed. Server response:")
+                # Attempt to print the response body, which may contain error details
+                try:
+                    log(f"Response Body (JSON): {result.json()}")
+                except requests.exceptions.JSONDecodeError:
+                    log(f"Response Body (Text): {result.text}")
+                self._poll()  # updates are rejected if the job was aborted in the meantime
+            return
+
+    def _poll(self):
+        try:
+            result = get_session().get(self.url, headers=self.headers, timeout=self.timeout)
+            if result.ok and JobStatus(result.json()["status"]) == JobStatus.Aborted:
+                log(f"Job {self.job_id} was aborted")
+                self.aborted = True
+        except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+            log(f"Failed to poll job status: {e}")
+
+
+class ReporterGroup:
+    """
+    Reports the shared stages of a batch of jobs (see process_batch in worker.py) to all of its jobs that are neither
+    done nor aborted. The group only counts as aborted once every remaining job was aborted.
+    """
+    def __init__(self, reporters: list[StatusReporter]):
+        self.reporters = list(reporters)
+
+    @property
+    def aborted(self) -> bool:
+        return all(r.aborted for r in self.reporters)
+
+    def discard(self, reporter: StatusReporter):
+        """
+        Stop reporting to the job of reporter, e.g. because it is done.
+        """
+        if reporter in self.reporters:
+            self.reporters.remove(reporter)
+
+    def update(self, status: JobStatus, progress: float = None):
+        for reporter in self.reporters:
+            if not reporter.aborted:
+                reporter.update(status, progress)
+
+    def check_aborted(self):
+        if self.aborted:
+            raise JobAborted("All jobs of the batch were aborted")
+
+
+class NullReporter:
+    """
+    Reporter of a job without a backend (see benchmark.py), which drops all updates and is never aborted.
+    """
+    aborted = False
+
+    def update(self, status: JobStatus, progress: float = None):
+        pass
+
+    def check_aborted(self):
+        pass
+
+    def close(self, timeout: float = 60.0):
+        pass
+
+
+def log(message: str):
+    print(f"[{datetime.now().isoformat(sep=' ', timespec='milliseconds')}] {message}")
@@ -0,0 +1,41 @@
+from admission import estimate_job, admit_job
+from model import EnqueueJobRequest
+
+QUEUE_LIMITS = {'small': 3 * 1024 ** 3, 'large': 12 * 1024 ** 3}
+
+
+def make_request(n: int, tile_count: int, algorithm: str = 'LAP') -> EnqueueJobRequest:
+    return EnqueueJobRequest(job_id='job', username='user', project_id='project', token='token', n=n,
+                             algorithm=algorithm, subdivisions=4, crop_count=1, repetitions=1, target='target.jpg',
+                             tiles=[], collections=['collection'], tileCount=tile_count, color_space='CIELAB')
+
+
+def test_deepzoom_does_not_depend_on_algorithm():
+    request = make_request(20000, 20000)
+    estimates = [estimate_job(request, algorithm) for algorithm in ['LAP', 'AUCTION', 'BLOCK_LAP', 'SPARSE_LAP']]
+    assert len({e.deepzoom_bytes for e in estimates}) == 1
+    assert len({e.solve_bytes for e in estimates}) > 1
+
+
+def test_fallback_admits_job_the_dense_solver_cannot_run():
+    # a large collection: the dense cost matrix does not fit any worker, the deep zoom image does
+    request = make_request(20000, 100000)
+    dense = estimate_job(request)
+    assert dense.solve_bytes > QUEUE_LIMITS['large'] >= dense.deepzoom_bytes
+
+    estimate = admit_job(request, QUEUE_LIMITS)
+    assert estimate.algorithm == 'BLOCK_LAP'
+    assert estimate.queue == 'large'
+    assert estimate.memory_bytes <= QUEUE_LIMITS['large']
+
+
+def test_small_job_keeps_algorithm():
+    estimate = admit_job(make_request(1000, 3000), QUEUE_LIMITS)
+    assert (estimate.algorithm, estimate.queue) == ('LAP', 'small')
+
+
+def test_job_with_too_large_deepzoom_is_rejected():
+    estimate = admit_job(make_request(40000, 40000), QUEUE_LIMITS)
+    assert estimate.queue is None
+    assert estimate.algorithm == 'LAP'
+    assert estimate.deepzoom_bytes > QUEUE_LIMITS['large']
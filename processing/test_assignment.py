@@ -0,0 +1,86 @@
+import numpy as np
+import pytest
+from scipy.optimize import linear_sum_assignment
+from assignment import AuctionSolver, HungarianSolver, capacitated_linear_sum_assignment
+
+SEEDS = range(10)
+
+
+def random_costs(seed: int, n: int, m: int, integer: bool = False) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    if integer:  # many ties
+        return rng.integers(0, 5, (n, m)).astype(np.float64)
+    return rng.random((n, m)) * 100
+
+
+def optimal_cost(C: np.ndarray, capacity: int) -> float:
+    repeated = np.tile(C, (1, capacity))
+    row_ind, col_ind = linear_sum_assignment(repeated)
+    return float(repeated[row_ind, col_ind].sum())
+
+
+def check_assignment(C: np.ndarray, capacity: int, row_ind: np.ndarray, col_ind: np.ndarray):
+    n, m = C.shape
+    assert np.array_equal(np.sort(row_ind), np.arange(n))
+    assert np.all((col_ind >= 0) & (col_ind < m))
+    assert np.bincount(col_ind, minlength=m).max() <= capacity
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+@pytest.mark.parametrize('integer', [False, True])
+@pytest.mark.parametrize('n, m, capacity', [(40, 40, 1), (50, 70, 1), (60, 25, 3), (30, 12, 5), (45, 30, 2)])
+def test_capacitated_matches_repeated_columns(seed, integer, n, m, capacity):
+    C = random_costs(seed, n, m, integer)
+    row_ind, col_ind = capacitated_linear_sum_assignment(C, capacity)
+    check_assignment(C, capacity, row_ind, col_ind)
+    assert C[row_ind, col_ind].sum() == pytest.approx(optimal_cost(C, capacity))
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_capacitated_per_column_capacity(seed):
+    C = random_costs(seed, 40, 20, integer=True)
+    capacity = np.random.default_rng(seed).integers(1, 4, 20)
+    capacity[:10] = np.maximum(capacity[:10], 3)  # at least 40 slots, some columns with a single one
+    row_ind, col_ind = capacitated_linear_sum_assignment(C, capacity)
+    assert np.all(np.bincount(col_ind, minlength=20) <= capacity)
+    repeated = np.repeat(C, capacity, axis=1)
+    opt_rows, opt_cols = linear_sum_assignment(repeated)
+    assert C[row_ind, col_ind].sum() == pytest.approx(repeated[opt_rows, opt_cols].sum())
+
+
+def test_hungarian_uses_capacities_above_tiled_cost_limit():
+    C = random_costs(0, 60, 25)
+    row_ind, col_ind = HungarianSolver(tiled_cost_limit=0).solve(C, 3)
+    check_assignment(C, 3, row_ind, col_ind)
+    assert C[row_ind, col_ind].sum() == pytest.approx(optimal_cost(C, 3))
+
+
+def test_capacitated_rejects_infeasible():
+    with pytest.raises(ValueError):
+        capacitated_linear_sum_assignment(np.zeros((10, 3)), 3)
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+@pytest.mark.parametrize('tolerance', [1e-2, 0.1])
+@pytest.mark.parametrize('n, m, capacity', [(40, 40, 1), (60, 25, 3), (30, 50, 2)])
+def test_auction_within_tolerance(seed, tolerance, n, m, capacity):
+    C = random_costs(seed, n, m)
+    row_ind, col_ind = AuctionSolver(tolerance).solve(C, capacity)
+    check_assignment(C, capacity, row_ind, col_ind)
+    assert C[row_ind, col_ind].sum() <= (1 + tolerance) * optimal_cost(C, capacity) + 1e-6
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_auction_warm_start(seed):
+    C = random_costs(seed, 60, 25)
+    solver = AuctionSolver(1e-2)
+    solver.solve(random_costs(seed + 100, 60, 25), 3)  # prices of another problem of the same shape
+    initial = np.arange(60) % 25
+    row_ind, col_ind = solver.solve(C, 3, initial)
+    check_assignment(C, 3, row_ind, col_ind)
+    assert C[row_ind, col_ind].sum() <= 1.01 * optimal_cost(C, 3) + 1e-6
+
+
+def test_auction_rejects_zero_tolerance():
+    with pytest.raises(ValueError):
+        AuctionSolver(0)
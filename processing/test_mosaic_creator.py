@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+from PIL import Image
+from mosaic_creator import MosaicBuilder, BlockMosaicBuilder
+
+TILE_SIZES = [(40, 30), (30, 40), (35, 35)]  # several aspect ratios, so that cropping is exercised
+
+
+@pytest.fixture(scope='module')
+def images(tmp_path_factory):
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[0:90, 0:120] / 120
+    target = Image.fromarray(np.stack([128 + 100 * np.sin(2 * np.pi * (f * x + g * y))
+                                       for f, g in rng.uniform(0.3, 2, (3, 2))], axis=-1).astype(np.uint8))
+    tile_dir = tmp_path_factory.mktemp('tiles')
+    paths = []
+    for i in range(80):
+        w, h = TILE_SIZES[i % len(TILE_SIZES)]
+        gradient = np.linspace(-40, 40, w)[None, :, None] * rng.uniform(-1, 1, 3)
+        tile = np.clip(rng.integers(0, 256, 3) + gradient + rng.normal(0, 12, (h, w, 3)), 0, 255).astype(np.uint8)
+        paths.append(str(tile_dir / f't{i}.png'))
+        Image.fromarray(tile).save(paths[-1])
+    return target, paths
+
+
+def build(builder_class, images, workers, **params):
+    target, paths = images
+    params = {'resolution': 16, 'granularity': 3, 'tile_count': 60, 'repetitions': 1,
+              'cost_memory_budget': 64 * 1024, 'workers': workers, **params}  # small budget, so costs are chunked
+    builder = builder_class(photo=target, params=params)
+    if builder_class is BlockMosaicBuilder:
+        builder.set_block_size(20).set_workers(workers)
+    mosaic = builder.set_tile_images(paths).build()
+    return np.asarray(mosaic.mosaic), np.asarray(mosaic.assignment)
+
+
+@pytest.mark.parametrize('builder_class', [MosaicBuilder, BlockMosaicBuilder])
+@pytest.mark.parametrize('crop_count', [1, 3])
+@pytest.mark.parametrize('color_space', ['RGB', 'CIELAB_WEIGHTED'])
+def test_parallel_build_is_identical(images, builder_class, crop_count, color_space):
+    serial = build(builder_class, images, 1, crop_count=crop_count, color_space=color_space)
+    parallel = build(builder_class, images, 2, crop_count=crop_count, color_space=color_space)
+    assert np.array_equal(serial[1], parallel[1])
+    assert np.array_equal(serial[0], parallel[0])
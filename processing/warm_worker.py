@@ -0,0 +1,69 @@
+"""
+warm_worker.py
+
+RQ worker that keeps its state across jobs.
+
+The default rq worker forks a work horse for every job, which throws away everything the job loaded or cached.
+WarmWorker runs the jobs in its own process instead (like rq's SimpleWorker). It imports the image processing
+libraries and computes the color lookup tables once at startup, and it enables the in-memory cache of worker.py
+(collection listings and fitted thumbnails, limited to WARM_CACHE_MAX_BYTES).
+
+Usage:
+    rq worker --worker-class warm_worker.WarmWorker --url redis://redis:6379 small
+
+A job that crashes the process takes the worker down with it, so run it with a restart policy that also restarts workers
+that exit cleanly: the heap of a long-lived process keeps growing through fragmentation, so the worker stops after
+WARM_WORKER_MAX_JOBS jobs or as soon as it holds more than WARM_WORKER_MAX_RSS_BYTES after a job, and is replaced by a
+fresh one.
+"""
+
+import time
+from datetime import datetime
+import numpy as np
+from rq import SimpleWorker
+import worker
+import indexer  # noqa: F401 -- index jobs run on the same workers, so their modules are loaded at startup too
+from config import COLOR_LUT_BITS, WARM_CACHE_MAX_BYTES, WARM_WORKER_MAX_JOBS, WARM_WORKER_MAX_RSS_BYTES
+from metrics import read_rss
+from mosaic_creator import get_color_space_converter
+
+LUT_COLOR_SPACES = ['CIELAB', 'CIELAB_WEIGHTED']  # color spaces converted with a lookup table if COLOR_LUT_BITS is set
+
+
+class WarmWorker(SimpleWorker):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.executed_jobs = 0
+
+    def work(self, *args, **kwargs):
+        preload()
+        return super().work(*args, **kwargs)
+
+    def execute_job(self, job, queue):
+        try:
+            return super().execute_job(job, queue)
+        finally:
+            self.executed_jobs += 1
+            rss = read_rss()
+            print(f"[{datetime.now().isoformat(sep=' ', timespec='milliseconds')}] Warm cache: {len(worker.warm_cache)} "
+                  f"entries, {worker.warm_cache.nbytes / 1024 ** 2:.0f} / {WARM_CACHE_MAX_BYTES / 1024 ** 2:.0f} MiB, "
+                  f"RSS {rss / 1024 ** 2:.0f} MiB after {self.executed_jobs} jobs")
+            if should_recycle(self.executed_jobs, rss):
+                print(f"[{datetime.now().isoformat(sep=' ', timespec='milliseconds')}] Stopping to be replaced by a fresh worker")
+                self._stop_requested = True  # checked by rq before dequeuing the next job
+
+
+def should_recycle(executed_jobs: int, rss: int) -> bool:
+    return (0 < WARM_WORKER_MAX_JOBS <= executed_jobs) or (0 < WARM_WORKER_MAX_RSS_BYTES < rss)
+
+
+def preload():
+    """
+    Prepare everything that does not depend on a job: enable the warm cache and run the color conversions once, which
+    loads the lazily imported parts of scikit-image and computes the lookup tables.
+    """
+    start = time.perf_counter()
+    worker.warm_cache.max_bytes = WARM_CACHE_MAX_BYTES
+    for color_space in LUT_COLOR_SPACES:
+        get_color_space_converter(color_space, COLOR_LUT_BITS)(np.zeros((1, 1, 3)))
+    print(f"[{datetime.now().isoformat(sep=' ', timespec='milliseconds')}] Preloaded in {time.perf_counter() - start:.2f}s")
@@ -1,100 +1,483 @@
 import os
-import requests
+from config import *
 from model import EnqueueJobRequest, JobStatus
 from mosaic_creator import *
+from assignment import AssignmentSolver, HungarianSolver, AuctionSolver, LocalSearchSolver
+from deepzoom_cache import DeepZoomTileCache
+from deepzoom_archive import write_index
+from feature_store import TileFeatureStore, image_key, thumbnail_group, feature_group
+from collection_atlas import CollectionAtlas
+from status_reporter import StatusReporter, ReporterGroup, JobAborted, NullReporter
+from result_cache import ResultCache
+from metrics import JobMetrics
+from memory_cache import MemoryCache
+from rq import get_current_job
 from PIL import Image
 import pyvips
 import numpy as np
+import math
 import json
+import hashlib
 from datetime import datetime
 from typing import Union
 import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-BASE_PATH = os.getenv("BASE_PATH", "/app/images")
-BACKEND_CALLBACK_URL = os.getenv("BACKEND_CALLBACK_URL", "http://host.docker.internal:5243/jobs")
-TILE_RESOLUTION = 32
-DZ_TILE_RESOLUTION = 512
-LOAD_PROGRESS_FRACTION = 0.4  # how much of the progress indicator is used for (typically lazily) loading images
-DOWNSCALED_IMAGE_SUFFIX = "_sm.jpg"
+feature_store = TileFeatureStore(os.path.join(CACHE_PATH, "features"), FEATURE_STORE_MAX_BYTES)
+deepzoom_cache = DeepZoomTileCache(os.path.join(CACHE_PATH, "deepzoom"), DZ_CACHE_MAX_BYTES)
+result_cache = ResultCache(os.path.join(CACHE_PATH, "results"), RESULT_CACHE_MAX_BYTES)
+warm_cache = MemoryCache(0)  # collection listings and thumbnails, enabled by warm_worker.WarmWorker
 
 def process_job(request: EnqueueJobRequest):
+    reporter = StatusReporter(BACKEND_CALLBACK_URL, request.job_id, request.token, ABORT_POLL_INTERVAL)
+    metrics = JobMetrics(request.algorithm)
+    outcome = "failed"
     try:
         print(f"[{datetime.now().isoformat(sep=' ', timespec='milliseconds')}] Begin processing job {request.job_id}...")
-        send_status_update(JobStatus.Processing, request, 0)
+        reporter.update(JobStatus.Processing, 0)
 
-        target, tiles, tile_paths = read_images(request)
-
-        if request.algorithm == "LAP":
-            builder = init_LAP_builder(target, tiles, request.n, request.subdivisions, request.crop_count, request.repetitions, request.color_space)
-        else:
-            raise ValueError(f"Unknown algorithm: {request.algorithm}")
-
-        print(f"[{datetime.now().isoformat(sep=' ', timespec='milliseconds')}] Ready to build")
-        result = builder.build(lambda p: 
-                            send_status_update(JobStatus.Processing, request, LOAD_PROGRESS_FRACTION + (1-LOAD_PROGRESS_FRACTION) * p.progress))
-
-        print(f"[{datetime.now().isoformat(sep=' ', timespec='milliseconds')}] Saving mosaic")
-        job_dir = os.path.join(BASE_PATH, "users", request.username, "projects", request.project_id, "mosaics", request.job_id)
-        path_list = save_result(tile_paths, result, job_dir)
-        send_status_update(JobStatus.GeneratedPreview, request)
-
-        print(f"[{datetime.now().isoformat(sep=' ', timespec='milliseconds')}] Generating deepzoom")
-        dz_dir = os.path.join(job_dir, "dz")
-        save_deepzoom(path_list, result.shape[1], result.crop_count, dz_dir)
-        send_status_update(JobStatus.Finished, request)
+        with metrics.stage("load"):
+            target, tiles, tile_vals, tile_paths, input_key = read_images(request, reporter)
+        reporter.check_aborted()
 
+        create_mosaic(request, target, tiles, tile_vals, tile_paths, input_key, reporter, metrics)
+        outcome = "finished"
         print(f"[{datetime.now().isoformat(sep=' ', timespec='milliseconds')}] Finished processing")
+    except JobAborted:
+        outcome = "aborted"
+        print(f"[{datetime.now().isoformat(sep=' ', timespec='milliseconds')}] Stopped aborted job {request.job_id}")
     except Exception:
         traceback.print_exc()
-        send_status_update(JobStatus.Failed, request)
+        reporter.update(JobStatus.Failed)
         print(f"[{datetime.now().isoformat(sep=' ', timespec='milliseconds')}] Marked job as failed")
+    finally:
+        reporter.close()
+        job = get_current_job()
+        metrics.push(job.connection if job else None, outcome)
+
+
+def process_batch(requests: list[EnqueueJobRequest]):
+    """
+    Process several jobs with the same target and tiles (see POST /enqueue/batch). The tiles are fitted once per crop
+    count and their feature vectors computed once per subdivisions and color space. Jobs whose cost matrices match
+    (same grid, features and crop count) reuse them through the result cache. The status of every job is reported
+    separately, so a failed or aborted job does not affect the others.
+    """
+    # jobs sharing tiles, feature vectors and cost matrices run one after another, so only one set is kept in memory
+    requests = sorted(requests, key=lambda r: (max(1, r.crop_count), r.subdivisions, r.color_space, r.n, r.repetitions))
+    reporters = {r.job_id: StatusReporter(BACKEND_CALLBACK_URL, r.job_id, r.token, ABORT_POLL_INTERVAL) for r in requests}
+    batch_reporter = ReporterGroup(list(reporters.values()))
+    job = get_current_job()
+    connection = job.connection if job else None
+    print(f"[{datetime.now().isoformat(sep=' ', timespec='milliseconds')}] Begin processing batch of {len(requests)} jobs...")
+    try:
+        batch_reporter.update(JobStatus.Processing, 0)
+        targets = {}  # the size of the target depends on the number of cells and subdivisions, as in single jobs
+        # solvers keep state across jobs with the same cost matrix (the prices of the auction), so they are shared by the
+        # same key as the cached cost matrices plus the repetitions, which change the capacity of each column
+        solvers = {}
+        inputs = None
+        for request in requests:
+            reporter = reporters[request.job_id]
+            metrics = JobMetrics(request.algorithm)
+            outcome = "failed"
+            try:
+                reporter.check_aborted()
+                print(f"[{datetime.now().isoformat(sep=' ', timespec='milliseconds')}] Begin processing job {request.job_id}...")
+                with metrics.stage("load"):
+                    if inputs is None or inputs.crop_count != max(1, request.crop_count):
+                        inputs = None  # release the tiles of the previous crop count first
+                        inputs = load_tile_inputs(request, batch_reporter)
+                    tile_vals = inputs.get_tile_vals(request.subdivisions, request.color_space)
+                    target_key = (get_cell_count(request.n, len(inputs.tile_paths)), request.subdivisions)
+                    if target_key not in targets:
+                        targets[target_key] = load_target(request.target, *target_key)
+                reporter.check_aborted()
+                input_key = get_input_key(request.target, inputs.tile_keys)
+                solver = None
+                if request.algorithm in ("LAP", "AUCTION", "ANYTIME"):
+                    solver_key = (request.algorithm, request.time_budget, max(1, request.crop_count), request.subdivisions,
+                                  request.color_space, request.n, request.repetitions)
+                    solver = solvers.setdefault(solver_key, get_solver(request.algorithm, request.time_budget))
+                create_mosaic(request, targets[target_key], inputs.tiles, tile_vals, inputs.tile_paths, input_key, reporter, metrics, solver)
+                outcome = "finished"
+                print(f"[{datetime.now().isoformat(sep=' ', timespec='milliseconds')}] Finished processing job {request.job_id}")
+            except JobAborted:
+                outcome = "aborted"
+                print(f"[{datetime.now().isoformat(sep=' ', timespec='milliseconds')}] Stopped aborted job {request.job_id}")
+            except Exception:
+                traceback.print_exc()
+                reporter.update(JobStatus.Failed)
+                print(f"[{datetime.now().isoformat(sep=' ', timespec='milliseconds')}] Marked job {request.job_id} as failed")
+            finally:
+                batch_reporter.discard(reporter)
+                metrics.push(connection, outcome)
+    except JobAborted:
+        print(f"[{datetime.now().isoformat(sep=' ', timespec='milliseconds')}] Stopped batch, all jobs were aborted")
+    except Exception:
+        traceback.print_exc()
+        batch_reporter.update(JobStatus.Failed)
+        print(f"[{datetime.now().isoformat(sep=' ', timespec='milliseconds')}] Marked all jobs of the batch as failed")
+    finally:
+        for reporter in reporters.values():
+            reporter.close()
+
+
+def create_mosaic(request: EnqueueJobRequest, target: Image, tiles: np.ndarray, tile_vals: np.ndarray,
+                  tile_paths: list[str], input_key: str, reporter: StatusReporter, metrics: JobMetrics,
+                  solver: AssignmentSolver = None):
+    """
+    Build the mosaic of a job from its loaded inputs and save it together with its deep zoom image.
+    The solver of the LAP, AUCTION and ANYTIME algorithms may be passed in to keep its state across the jobs of a batch.
+    Raises JobAborted if the job is aborted in the meantime.
+    """
+    builder = init_builder(request, target, tiles, tile_vals, solver)
+    builder.set_result_cache(result_cache, input_key)
+    job_dir = os.path.join(BASE_PATH, "users", request.username, "projects", request.project_id, "mosaics", request.job_id)
+
+    rows, cols = shape_from_count(target, builder.tile_count)
+    if 0 < PREVIEW_MIN_CELLS <= rows * cols:
+        def on_preview(preview: Mosaic):
+            # the optimal assignment overwrites the preview, the backend keeps accepting progress updates until then
+            save_result(tile_paths, preview, job_dir)
+            progress = LOAD_PROGRESS_FRACTION + (1-LOAD_PROGRESS_FRACTION) * MosaicProgress.COMPUTED_COSTS.progress
+            reporter.update(JobStatus.GeneratedPreview, progress)
+            print(f"[{datetime.now().isoformat(sep=' ', timespec='milliseconds')}] Saved greedy preview")
+
+        builder.set_preview_callback(on_preview)
+
+    timer = MosaicTimer()
+
+    def on_progress(p: MosaicProgress):
+        timer.measure(p.value)
+        reporter.check_aborted()
+        reporter.update(JobStatus.Processing, LOAD_PROGRESS_FRACTION + (1-LOAD_PROGRESS_FRACTION) * p.progress)
+
+    if isinstance(builder.solver, LocalSearchSolver):
+        solver = builder.solver
+
+        def on_solver_progress(elapsed: float, cost: float):
+            # the time budget spans the progress between the cost matrix and the assignment
+            fraction = min(1.0, elapsed / solver.time_budget) if solver.time_budget > 0 else 1.0
+            p = MosaicProgress.COMPUTED_COSTS.progress + fraction * (MosaicProgress.FOUND_ASSIGNMENT.progress - MosaicProgress.COMPUTED_COSTS.progress)
+            reporter.check_aborted()
+            reporter.update(JobStatus.Processing, LOAD_PROGRESS_FRACTION + (1-LOAD_PROGRESS_FRACTION) * p)
+
+        solver.progress_callback = on_solver_progress
+
+    print(f"[{datetime.now().isoformat(sep=' ', timespec='milliseconds')}] Ready to build")
+    result = builder.build(on_progress)
+    if isinstance(builder.solver, LocalSearchSolver) and builder.solver.trajectory:
+        (_, first), (elapsed, last) = builder.solver.trajectory[0], builder.solver.trajectory[-1]
+        print(f"Local search: cost {first:.1f} -> {last:.1f} in {elapsed:.2f}s ({len(builder.solver.trajectory)} passes)")
+    metrics.add_build_stages(timer, builder.preview_seconds)
+    metrics.cost_shape = builder.cost_shape
+
+    print(f"[{datetime.now().isoformat(sep=' ', timespec='milliseconds')}] Saving mosaic")
+    with metrics.stage("save"):
+        path_list = save_result(tile_paths, result, job_dir)
+    reporter.update(JobStatus.GeneratedPreview, 1.0)
+    reporter.check_aborted()
+
+    print(f"[{datetime.now().isoformat(sep=' ', timespec='milliseconds')}] Generating deepzoom")
+    dz_dir = os.path.join(job_dir, "dz")
+    with metrics.stage("deepzoom"):
+        save_deepzoom(path_list, result.shape[1], result.crop_count, dz_dir, reporter)
+    reporter.check_aborted()
+    reporter.update(JobStatus.Finished)
+
+
+def init_builder(request: EnqueueJobRequest, target: Image, tiles: np.ndarray, tile_vals: np.ndarray,
+                 solver: AssignmentSolver = None) -> MosaicBuilder:
+    """
+    Return the builder of the algorithm of a job for its loaded inputs (see read_images).
+    """
+    if request.algorithm in ("LAP", "AUCTION", "ANYTIME"):
+        builder = init_LAP_builder(target, tiles, tile_vals, request.n, request.subdivisions, request.crop_count, request.repetitions, request.color_space)
+        return builder.set_solver(solver or get_solver(request.algorithm, request.time_budget))
+    elif request.algorithm == "SPARSE_LAP":
+        return init_sparse_LAP_builder(target, tiles, tile_vals, request.n, request.subdivisions, request.crop_count, request.repetitions, request.color_space)
+    elif request.algorithm == "BLOCK_LAP":
+        return init_block_LAP_builder(target, tiles, tile_vals, request.n, request.subdivisions, request.crop_count, request.repetitions, request.color_space)
+    else:
+        raise ValueError(f"Unknown algorithm: {request.algorithm}")
+
+
+def load_target(path: str, n: int, subdivisions: int) -> Image:
+    """
+    Load the target at the smallest size that suffices for a mosaic of n cells (see get_cell_count): every cell needs
+    TILE_RESOLUTION pixels for the score and the overlay and subdivisions pixels for its feature vector.
+    pyvips decodes JPEGs at a reduced scale and streams other formats while shrinking them, so the full image is never
+    held in memory. The size of the original is kept in info['original_size'] (see get_original_size).
+    """
+    abs_path = get_image_path(path)
+    header = pyvips.Image.new_from_file(abs_path)  # only reads the header
+    w, h = header.width, header.height
+    rows, cols = shape_from_size((w, h), max(1, n))
+    per_cell = max(TILE_RESOLUTION, subdivisions)
+    scale = max(cols * per_cell / w, rows * per_cell / h)
+    if scale >= 1:
+        return get_image(path)
+
+    # like Pillow, the EXIF orientation is ignored
+    img = pyvips.Image.thumbnail(abs_path, math.ceil(w * scale), height=math.ceil(h * scale), size="down", no_rotate=True)
+    if img.interpretation != "srgb":
+        img = img.colourspace("srgb")
+    target = Image.fromarray(img.extract_band(0, n=3).cast("uchar").numpy())
+    target.info['original_size'] = (w, h)
+    return target
+
+
+def get_image(path, prefer_small=False, min_size: int = None) -> Image:
+    img = Image.open(get_image_path(path, prefer_small))
+    if min_size:  # JPEGs are directly decoded at the smallest scale that is still large enough
+        img.draft("RGB", (min_size, min_size))
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    return img
 
 
-def get_image(path, prefer_small=False) -> Image:
+def get_image_path(path, prefer_small=False) -> str:
     abs_path = os.path.join(BASE_PATH, path)
     if prefer_small:  # drastically speeds up loading of tiles without impact on quality
         downscaled_path = get_downscaled_path(abs_path)
         abs_path = downscaled_path if os.path.exists(downscaled_path) else abs_path
+    return abs_path
+
+
+def read_images(request: EnqueueJobRequest, reporter: StatusReporter) -> tuple[Image, np.ndarray, np.ndarray, list[str], str]:
+    """
+    Return the target, the fitted tiles with their feature vectors, the tile paths and a key identifying all inputs.
+    """
+    inputs = load_tile_inputs(request, reporter)
+    target = load_target(request.target, get_cell_count(request.n, len(inputs.tile_paths)), request.subdivisions)
+    tile_vals = inputs.get_tile_vals(request.subdivisions, request.color_space)
+    return target, inputs.tiles, tile_vals, inputs.tile_paths, get_input_key(request.target, inputs.tile_keys)
+
+
+def get_input_key(target: str, tile_keys: list[str]) -> str:
+    return hashlib.sha1("|".join([image_key(get_image_path(target))] + tile_keys).encode()).hexdigest()
+
+
+class TileInputs:
+    """
+    The fitted tiles of a job for one crop count, from the feature store and from collection atlases, in the layout
+    expected by MosaicBuilder.set_prepared_tiles. Feature vectors are loaded separately for every subdivisions and
+    color space, so that the jobs of a batch share the tiles. Only the feature vectors loaded last are kept.
+    """
+    def __init__(self, crop_count: int, tile_paths: list[str], keys: list[str], thumbs: np.ndarray,
+                 atlases: list[tuple[str, CollectionAtlas]]):
+        self.crop_count = crop_count
+        self.tile_paths = tile_paths + [os.path.join(collection, name) for collection, atlas in atlases for name in atlas.names]
+        self.tile_keys = keys + [atlas.id for _, atlas in atlases]
+        self._keys = keys
+        self._thumbs = thumbs
+        self._atlases = [atlas for _, atlas in atlases]
+        parts = [thumbs.reshape(-1, TILE_RESOLUTION, TILE_RESOLUTION, 3)]
+        parts += [atlas.get(thumbnail_group(TILE_RESOLUTION, crop_count)).reshape(-1, TILE_RESOLUTION, TILE_RESOLUTION, 3)
+                  for atlas in self._atlases]
+        # a single source is used as is, so memory-mapped atlas arrays stay memory-mapped
+        self._nonempty = [i for i, tiles in enumerate(parts) if len(tiles) > 0] or [0]
+        parts = [parts[i] for i in self._nonempty]
+        self.tiles = parts[0] if len(parts) == 1 else TileSet(parts)
+        self._vals_key = None
+        self._vals = None
+
+    def get_tile_vals(self, subdivisions: int, color_space: str) -> np.ndarray:
+        if self._vals_key != (subdivisions, color_space):
+            self._vals = None
+            parts = [load_tile_vals(self._thumbs, self._keys, subdivisions, color_space)]
+            parts += [load_atlas_tile_vals(atlas, self.crop_count, subdivisions, color_space) for atlas in self._atlases]
+            # only the (much smaller) feature vectors are copied to join several sources
+            parts = [parts[i] for i in self._nonempty]
+            self._vals = parts[0] if len(parts) == 1 else np.concatenate(parts)
+            self._vals_key = (subdivisions, color_space)
+        return self._vals
+
+
+def load_tile_inputs(request: EnqueueJobRequest, reporter: StatusReporter) -> TileInputs:
+    """
+    Load the fitted tiles of a job. Indexed collections are used straight from their atlas, all other images go through
+    the feature store.
+    """
+    crop_count = max(1, request.crop_count)
+    tile_paths = list(request.tiles)
+    atlases = []
+    for collection in request.collections:
+        atlas = CollectionAtlas.open(os.path.join(BASE_PATH, collection))
+        if atlas is not None and atlas.has(thumbnail_group(TILE_RESOLUTION, crop_count)):
+            atlases.append((collection, atlas))
+        else:
+            tile_paths += get_collection_tile_paths([collection])
+    print(f'number of tiles: {len(tile_paths) + sum(len(atlas.names) for _, atlas in atlases)} ({len(atlases)} atlases)')
+    thumbs, keys = load_thumbnails(tile_paths, crop_count, request.tileCount, reporter)
+    return TileInputs(crop_count, tile_paths, keys, thumbs, atlases)
+
+
+def load_thumbnails(tile_paths: list[str], crop_count: int, tile_count: int, reporter: StatusReporter) -> tuple[np.ndarray, list[str]]:
+    """
+    Return the fitted crops of all tiles, shaped (tiles, crop_count, TILE_RESOLUTION, TILE_RESOLUTION, 3), together
+    with the feature store key of every tile.
+    Thumbnails are taken from the warm cache of the process, then from the feature store. Only images found in neither
+    are decoded. Their results are added to the store.
+    Raises JobAborted if the job is aborted while decoding.
+    """
+    keys = [image_key(get_image_path(t, prefer_small=True)) for t in tile_paths]
+    thumbs_group = thumbnail_group(TILE_RESOLUTION, crop_count)
+    thumbs = np.zeros((len(tile_paths), crop_count, TILE_RESOLUTION, TILE_RESOLUTION, 3), dtype=np.uint8)
+    cold = []
+    for i, key in enumerate(keys):
+        warm = warm_cache.get((thumbs_group, key))
+        if warm is not None:
+            thumbs[i] = warm
+        else:
+            cold.append(i)
 
-    img = Image.open(abs_path)
-    if img.mode != "RGB":
-        img = img.convert("RGB")
-    return img
+    cached_thumbs = feature_store.lookup(thumbs_group, [keys[i] for i in cold])
+    missing_thumbs = []
+    for i in cold:
+        if keys[i] in cached_thumbs:
+            thumbs[i] = cached_thumbs[keys[i]]
+        else:
+            missing_thumbs.append(i)
+
+    # Pillow releases the GIL while decoding and resizing, so threads decode tiles concurrently
+    loaded = len(tile_paths) - len(missing_thumbs)
+    with ThreadPoolExecutor(max_workers=LOAD_CONCURRENCY) as executor:
+        futures = {executor.submit(load_tile, tile_paths[i], crop_count): i for i in missing_thumbs}
+        for future in as_completed(futures):
+            thumbs[futures[future]] = future.result()
+            loaded += 1
+            if reporter.aborted:
+                executor.shutdown(wait=False, cancel_futures=True)
+                reporter.check_aborted()
+            if loaded % 50 == 0:
+                load_progress = loaded / tile_count
+                reporter.update(JobStatus.Processing, load_progress * LOAD_PROGRESS_FRACTION)
+    feature_store.add(thumbs_group, [keys[i] for i in missing_thumbs], thumbs[missing_thumbs])
+    if warm_cache.max_bytes > 0:
+        for i in cold:  # copies, so that the cache does not keep the array of the job alive
+            warm_cache.put((thumbs_group, keys[i]), thumbs[i].copy(), thumbs[i].nbytes)
+    print(f'feature store: {len(tile_paths) - len(missing_thumbs)} / {len(tile_paths)} tiles cached '
+          f'({len(tile_paths) - len(cold)} in memory)')
+    return thumbs, keys
+
+
+def load_tile_vals(thumbs: np.ndarray, keys: list[str], subdivisions: int, color_space: str) -> np.ndarray:
+    """
+    Return the feature vectors of thumbnails returned by load_thumbnails, from the feature store where possible.
+    """
+    crop_count = thumbs.shape[1]
+    g = subdivisions
+    vals_group = feature_group(TILE_RESOLUTION, crop_count, g, color_space, FEATURE_VERSION, COLOR_LUT_BITS)
+    cached_vals = feature_store.lookup(vals_group, keys)
+    vals = np.zeros((len(keys), crop_count, g, g, 3))
+    missing_vals = []
+    for i, key in enumerate(keys):
+        if key in cached_vals:
+            vals[i] = cached_vals[key]
+        else:
+            missing_vals.append(i)
+    if missing_vals:
+        vals[missing_vals] = compute_tile_vals(
+            thumbs[missing_vals].reshape(-1, TILE_RESOLUTION, TILE_RESOLUTION, 3), g, color_space, COLOR_LUT_BITS
+        ).reshape(len(missing_vals), crop_count, g, g, 3)
+        feature_store.add(vals_group, [keys[i] for i in missing_vals], vals[missing_vals])
+    return vals.reshape(-1, g, g, 3)
 
 
-def read_images(request: EnqueueJobRequest) -> tuple[Image, list[Image]]:
-    target = get_image(request.target)
+def load_atlas_tile_vals(atlas: CollectionAtlas, crop_count: int, subdivisions: int, color_space: str) -> np.ndarray:
+    """
+    Return the memory-mapped feature vectors of a collection atlas. Feature vectors that are not part of the atlas are
+    computed from its thumbnails.
+    """
+    vals = atlas.get(feature_group(TILE_RESOLUTION, crop_count, subdivisions, color_space, FEATURE_VERSION, COLOR_LUT_BITS))
+    if vals is None:
+        tiles = atlas.get(thumbnail_group(TILE_RESOLUTION, crop_count)).reshape(-1, TILE_RESOLUTION, TILE_RESOLUTION, 3)
+        vals = compute_tile_vals(tiles, subdivisions, color_space, COLOR_LUT_BITS)
+    return vals
 
-    tile_paths = request.tiles + get_collection_tile_paths(request.collections)
-    print(f'number of tiles: {len(tile_paths)}')
-    tiles = []
-    for i, t in enumerate(tile_paths):
-        tiles.append(get_image(t, prefer_small=True))
-        if (i+1) % 50 == 0:
-            load_progress = (i+1) / request.tileCount
-            send_status_update(JobStatus.Processing, request, load_progress * LOAD_PROGRESS_FRACTION)
-    return target, tiles, tile_paths
+
+def load_tile(path: str, crop_count: int) -> np.ndarray:
+    img = get_image(path, prefer_small=True, min_size=TILE_RESOLUTION * LOAD_OVERSAMPLING)
+    return fit_tile(img, TILE_RESOLUTION, crop_count)
 
 
 def get_collection_tile_paths(collections):
     paths = []
     for collection in collections:
-        for entry in os.listdir(os.path.join(BASE_PATH, collection)):
-            if not entry.endswith(DOWNSCALED_IMAGE_SUFFIX):
-                paths.append(os.path.join(collection, entry))
+        paths += list_collection_images(collection)
     return paths
 
 
-def init_LAP_builder(target: Image, tiles: list[Image], n: int, subdivisions: int, crop_count: int, repetitions: int, color_space: str) -> MosaicBuilder:
-    params = {
-        'resolution': 32,
+def list_collection_images(collection: str) -> list[str]:
+    # adding or removing images changes the modification time of the directory
+    key = ("listing", collection, os.stat(os.path.join(BASE_PATH, collection)).st_mtime_ns)
+    paths = warm_cache.get(key)
+    if paths is None:
+        paths = []
+        for entry in sorted(os.listdir(os.path.join(BASE_PATH, collection))):
+            # hidden entries include the atlas of the collection
+            if not entry.endswith(DOWNSCALED_IMAGE_SUFFIX) and not entry.startswith("."):
+                paths.append(os.path.join(collection, entry))
+        warm_cache.put(key, paths, sum(100 + len(path) for path in paths))  # about the size of the string objects
+    return list(paths)
+
+
+def get_cell_count(n: int, image_count: int) -> int:
+    """
+    Return the number of cells of a mosaic: the requested n, but never more than there are images.
+    """
+    return max(1, min(n, image_count))
+
+
+def get_builder_params(image_count: int, n: int, subdivisions: int, crop_count: int, repetitions: int, color_space: str) -> dict:
+    return {
+        'resolution': TILE_RESOLUTION,
         'granularity': subdivisions,
         'crop_count': max(1, crop_count),
         'repetitions': max(1, repetitions),
-        'tile_count': max(1, min(n, len(tiles))),
-        'color_space': color_space
+        'tile_count': get_cell_count(n, image_count),
+        'color_space': color_space,
+        'cost_dtype': COST_DTYPE,
+        'cost_memory_budget': COST_MEMORY_BUDGET,
+        'solver': HungarianSolver(TILED_COST_LIMIT),
+        'color_lut_bits': COLOR_LUT_BITS,
+        'workers': BUILD_WORKERS
     }
-    return MosaicBuilder(photo=target, tile_images=tiles, params=params)
+
+
+def get_solver(algorithm: str, time_budget: float = None) -> AssignmentSolver:
+    match algorithm:
+        case "LAP":
+            return HungarianSolver(TILED_COST_LIMIT)
+        case "AUCTION" if AUCTION_TOLERANCE <= 0:
+            return HungarianSolver(TILED_COST_LIMIT)  # the auction cannot reach the optimum in reasonable time
+        case "AUCTION":
+            return AuctionSolver(AUCTION_TOLERANCE, memory_budget=COST_MEMORY_BUDGET)
+        case "ANYTIME":
+            return LocalSearchSolver(ANYTIME_TIME_BUDGET if time_budget is None else time_budget, memory_budget=COST_MEMORY_BUDGET)
+        case _:
+            raise ValueError(f"Unknown algorithm: {algorithm}")
+
+
+def init_LAP_builder(target: Image, tiles: np.ndarray, tile_vals: np.ndarray, n: int, subdivisions: int, crop_count: int, repetitions: int, color_space: str) -> MosaicBuilder:
+    params = get_builder_params(len(tiles) // max(1, crop_count), n, subdivisions, crop_count, repetitions, color_space)
+    return MosaicBuilder(photo=target, params=params).set_prepared_tiles(tiles, tile_vals)
+
+
+def init_sparse_LAP_builder(target: Image, tiles: np.ndarray, tile_vals: np.ndarray, n: int, subdivisions: int, crop_count: int, repetitions: int, color_space: str) -> SparseMosaicBuilder:
+    params = get_builder_params(len(tiles) // max(1, crop_count), n, subdivisions, crop_count, repetitions, color_space)
+    params['candidate_count'] = SPARSE_CANDIDATE_COUNT
+    params['gap_check_limit'] = SPARSE_GAP_CHECK_LIMIT
+    return SparseMosaicBuilder(photo=target, params=params).set_prepared_tiles(tiles, tile_vals)
+
+
+def init_block_LAP_builder(target: Image, tiles: np.ndarray, tile_vals: np.ndarray, n: int, subdivisions: int, crop_count: int, repetitions: int, color_space: str) -> BlockMosaicBuilder:
+    params = get_builder_params(len(tiles) // max(1, crop_count), n, subdivisions, crop_count, repetitions, color_space)
+    params['block_size'] = BLOCK_SIZE
+    params['workers'] = BLOCK_WORKERS
+    return BlockMosaicBuilder(photo=target, params=params).set_prepared_tiles(tiles, tile_vals)
 
 
 def get_assignment_descriptor(path_list: Union[list[str], list[list[str]]], shape: tuple[int, int], crop_count: int):
@@ -110,13 +493,17 @@ def get_assignment_descriptor(path_list: Union[list[str], list[list[str]]], shap
 
 def save_result(tiles: list[str], result: Mosaic, job_dir: str):
     os.makedirs(job_dir, exist_ok=True)
+    # files are replaced atomically, as a preview may be downloaded while it is overwritten
     mosaic_path = os.path.join(job_dir, "mosaic.jpg")
-    result.mosaic.save(mosaic_path, format="JPEG")
+    result.mosaic.save(mosaic_path + ".tmp", format="JPEG")
+    os.replace(mosaic_path + ".tmp", mosaic_path)
 
     path_list = assignment_to_path_list(result.assignment, tiles)
-    with open(os.path.join(job_dir, "assignment.json"), 'w') as f:
+    assignment_path = os.path.join(job_dir, "assignment.json")
+    with open(assignment_path + ".tmp", 'w') as f:
         descriptor = get_assignment_descriptor(path_list, result.shape, result.crop_count)
         json.dump(descriptor, f)
+    os.replace(assignment_path + ".tmp", assignment_path)
     return path_list
     
 
@@ -126,11 +513,70 @@ def assignment_to_path_list(assignment: np.ndarray, paths: list[str]) -> Union[l
     return [(paths[row[0]], int(row[1])) for row in assignment]  # each assignment becomes a pair (path, crop_idx)
 
 
-def save_deepzoom(path_list: Union[list[str], list[list[str]]], ncols: int, crop_count: int, dz_dir: str):
+def save_deepzoom(path_list: Union[list[str], list[list[str]]], ncols: int, crop_count: int, dz_dir: str,
+                  reporter: StatusReporter = NullReporter()):
+    """
+    Save the deep zoom image of a mosaic, given the (path, crop_idx) of each cell in row-major order.
+    Raises JobAborted if the job is aborted while the cells are loaded or the pyramid is written.
+    """
     os.makedirs(dz_dir, exist_ok=True)
-    tiles = [load_vips_tile(path, crop_count) for path in path_list]
+    # cells showing the same crop share a single decoded image, as long as they fit into the memory budget,
+    # and every crop is looked up in the tile cache only once, since each lookup touches the shared volume
+    uses = {}
+    cached_paths = {}
+    for path in path_list:
+        key = get_cell_key(path, crop_count)
+        if key not in cached_paths:
+            reporter.check_aborted()  # creating missing cache entries decodes the originals
+            cached_paths[key] = get_cached_tile_path(path, crop_count)
+        uses[key] = uses.get(key, 0) + 1
+    shared_budget = DZ_SHARED_TILE_BUDGET // (DZ_TILE_RESOLUTION * DZ_TILE_RESOLUTION * 3)
+    shared = {}
+    tiles = []
+    for path in path_list:
+        key = get_cell_key(path, crop_count)
+        if key in shared:
+            tiles.append(shared[key])
+        elif uses[key] > 1 and len(shared) < shared_budget:
+            # sequential images can only be read once, so shared ones are decoded to memory
+            shared[key] = pyvips.Image.new_from_file(cached_paths[key], access="random").copy_memory()
+            tiles.append(shared[key])
+        else:
+            tiles.append(pyvips.Image.new_from_file(cached_paths[key], access="sequential"))
     mosaic = pyvips.Image.arrayjoin(tiles, across=ncols)
-    mosaic.dzsave(os.path.join(dz_dir, "dz.jpg"), tile_size=512)
+    mosaic.set_progress(True)
+    mosaic.signal_connect("eval", lambda image, progress: image.set_kill(True) if reporter.aborted else None)
+    concurrency = pyvips.concurrency_get()
+    if DZ_CONCURRENCY > 0:
+        pyvips.concurrency_set(DZ_CONCURRENCY)
+    try:
+        suffix = f".jpeg[Q={DZ_JPEG_QUALITY}]"
+        if DZ_CONTAINER == "zip":
+            # tiles are stored uncompressed, so that they can be served by range reads (see deepzoom_archive.py)
+            archive_path = os.path.join(dz_dir, "dz.jpg.zip")
+            mosaic.dzsave(archive_path, tile_size=512, suffix=suffix, container="zip", compression=0)
+            write_index(archive_path)
+        else:
+            mosaic.dzsave(os.path.join(dz_dir, "dz.jpg"), tile_size=512, suffix=suffix)
+    except pyvips.Error:
+        reporter.check_aborted()  # the eval handler killed the computation
+        raise
+    finally:
+        pyvips.concurrency_set(concurrency)
+    deepzoom_cache.evict()
+
+
+def get_cell_key(path: Union[str, list[str]], crop_count: int) -> tuple[str, int]:
+    return (path, 0) if crop_count == 1 else (path[0], int(path[1]))
+
+
+def get_cached_tile_path(path: Union[str, list[str]], crop_count: int) -> str:
+    """
+    Return the path of the square crop of a cell in the deep zoom tile cache, creating the cache entry if necessary.
+    """
+    image_path, crop_idx = get_cell_key(path, crop_count)
+    return deepzoom_cache.get_path(os.path.join(BASE_PATH, image_path), crop_idx, crop_count, DZ_TILE_RESOLUTION,
+                                   lambda: load_vips_tile(path, crop_count))
 
 
 def load_vips_tile(path: Union[str, list[str]], crop_count: int) -> pyvips.Image:
@@ -170,32 +616,6 @@ def load_vips_tile(path: Union[str, list[str]], crop_count: int) -> pyvips.Image
     return resized_image
 
 
-def send_status_update(status: JobStatus, request: EnqueueJobRequest, progress: float = None):
-    # Notify ASP.NET backend that job is done
-    payload = {
-        "status": status.value
-    }
-    if progress is not None:
-        payload["progress"] = progress
-
-    try:
-        headers = {
-            "X-Job-Secret": request.token,
-            "Content-Type": "application/json"
-            }
-        result = requests.post(f"{BACKEND_CALLBACK_URL}/{request.job_id}/status", json=payload, headers=headers)
-        if not result.ok:
-            print(f"[{datetime.now().isoformat(sep=' ', timespec='milliseconds')}] Request failed. Server response:")
-            # Attempt to print the response body, which may contain error details
-            try:
-                print(f"[{datetime.now().isoformat(sep=' ', timespec='milliseconds')}] Response Body (JSON): {result.json()}")
-            except requests.exceptions.JSONDecodeError:
-                print(f"[{datetime.now().isoformat(sep=' ', timespec='milliseconds')}] Response Body (Text): {result.text}")
-
-    except Exception as e:
-        print(f"[{datetime.now().isoformat(sep=' ', timespec='milliseconds')}] Failed to notify backend: {e}")
-
-
 def get_downscaled_path(original_path: str) -> str:
     dir_name = os.path.dirname(original_path)
     filename_without_ext = os.path.splitext(os.path.basename(original_path))[0]